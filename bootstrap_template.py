@@ -24,6 +24,8 @@ def bootstrap_template(src, dest, old_word, new_word):
         # Save new document
         doc.save(dest)
         print(f"[+] Successfully created {dest} with text replaced.")
+        import template_registry
+        template_registry.sync()  # register the new template as a version right away
         
         # Extract variables using docxtpl
         tpl = DocxTemplate(dest)
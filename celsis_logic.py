@@ -1,7 +1,9 @@
 # filename: celsis_logic.py
 import streamlit as st
 import re
-from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative
+import narratives
+import justification
+from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative, fragment
 
 # --- 1. CONFIG & KEYS (前后端数据契约) ---
 FIELD_KEYS = [
@@ -61,8 +63,82 @@ def validate_inputs():
                 errors.append(f"❌ Date Error: '{d_val}' invalid. Use DDMMMYY (e.g. 17Mar26).")
     return errors, warnings
 
+# --- 2b. EM OBSERVATION MATRIX (phase × 采样类型 × 日期) ---
+EM_PHASES = ("pro_", "alq_")
+EM_TYPES = ("pers", "surf", "sett", "air_wk", "room_wk")  # 前三项为 daily，后两项为 weekly
+EM_DAYS = ("be_", "on_", "af_")
+_DAILY_TYPES = 3
+_EM_CAT = {"pers": "personnel sampling", "surf": "surface sampling", "sett": "settling plates", "air_wk": "active air sampling", "room_wk": "surface sampling"}
+_DAILY_TIMING = {"be_": "the date before testing", "on_": "the date of testing", "af_": "the date after testing"}
+_WEEKLY_TIMING = {"be_": "the week prior to testing", "on_": "the week of testing", "af_": "the week after testing"}
+
+class EMCell:
+    """单个 EM 读数 (phase, 采样类型, 日期)"""
+    __slots__ = ("phase", "stype", "day", "daily", "obs", "etx", "org_id")
+
+    def __init__(self, phase, stype, day, obs, etx, org_id):
+        self.phase, self.stype, self.day = phase, stype, day
+        self.daily = EM_TYPES.index(stype) < _DAILY_TYPES
+        self.obs, self.etx, self.org_id = obs, etx, org_id
+
+    @property
+    def timing(self):
+        return (_DAILY_TIMING if self.daily else _WEEKLY_TIMING)[self.day]
+
+    def facts(self):
+        """叙述模板 (celsis_em_phase) 所需字段"""
+        return {"timing": self.timing, "obs": self.obs, "cat": _EM_CAT[self.stype], "etx": self.etx, "id": self.org_id}
+
+class EMMatrix:
+    """
+    Celsis EM 观察矩阵：一次读取 2 × 5 × 3 = 30 个 pro/alq 读数。
+    cells 按 phase → 采样类型 → 日期 展开 (即报告文案的顺序)，fail 为对应的失败掩码，
+    所有失败列表 / 首个失败 / 判定规则都从这一结构计算，不再反复扫描 session_state。
+    """
+    __slots__ = ("cells", "fail")
+
+    def __init__(self, state):
+        self.cells = [EMCell(p, t, d, state.get(f"{p}{d}obs_{t}", 'No growth'), state.get(f"{p}{d}etx_{t}"), state.get(f"{p}{d}id_{t}"))
+                      for p in EM_PHASES for t in EM_TYPES for d in EM_DAYS]
+        self.fail = bytes(is_em_failure(c.obs) for c in self.cells)
+
+    @staticmethod
+    def index(phase, stype, day):
+        return (EM_PHASES.index(phase) * len(EM_TYPES) + EM_TYPES.index(stype)) * len(EM_DAYS) + EM_DAYS.index(day)
+
+    def cell(self, phase, stype, day):
+        return self.cells[self.index(phase, stype, day)]
+
+    def failures(self, phase=None, daily=None, day=None):
+        """失败读数 (按文案顺序)，可按 phase / daily|weekly / 日期过滤"""
+        return [c for c, f in zip(self.cells, self.fail)
+                if f and (phase is None or c.phase == phase) and (daily is None or c.daily == daily) and (day is None or c.day == day)]
+
+    def first_failure(self, phase=None, daily=None, day=None):
+        found = self.failures(phase, daily, day)
+        return found[0] if found else None
+
+    def any_failure(self, phase=None, daily=None, day=None):
+        return self.first_failure(phase, daily, day) is not None
+
+def is_em_failure(obs):
+    """'No growth' (不区分大小写) 与空白视为通过"""
+    obs = str(obs).lower()
+    return obs != 'no growth' and obs.strip() != ''
+
 # --- 3. TEXT GENERATION LOGIC (重型文案生成引擎) ---
 
+@fragment()
+def celsis_bsc_paragraph(bsc_id_str, a_bsc="1798"):
+    """BSC 清洁 / 认证段落：只随处理 BSC 与分装 BSC 变化，按 (bsc, a_bsc) 缓存"""
+    t_room, t_suite, t_suffix, t_loc = u_grl(bsc_id_str)
+    t_suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
+    if bsc_id_str == a_bsc:
+        return f"The ISO 5 BSC E00{bsc_id_str}, located in the {t_loc}, ({t_suite_phrase}), was used for both sample processing and aliquoting steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{bsc_id_str} was certified and approved by both the Engineering and Quality Assurance teams."
+    a_room, a_suite, a_suffix, a_loc = u_grl(a_bsc)
+    a_suite_phrase = f"Suite {a_suite}{a_suffix}" if a_suite != "L-Suite" else "L-Suite"
+    return f"The ISO 5 BSC E00{bsc_id_str}, located in the {t_loc}, ({t_suite_phrase}), and ISO 5 BSC E00{a_bsc}, located in the {a_loc}, ({a_suite_phrase}), were thoroughly cleaned and disinfected prior to their respective procedures in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, the BSCs used throughout testing, E00{bsc_id_str} for sample processing and E00{a_bsc} for the aliquoting step, were certified and approved by both the Engineering and Quality Assurance teams."
+
 def generate_celsis_equipment_text():
     """
     根据标准话术 (SOP 像素级复刻):
@@ -93,7 +169,7 @@ def generate_celsis_equipment_text():
     bsc_id_str = str(st.session_state.bsc_id).strip()
     
     if bsc_id_str == a_bsc:
-        part2 = f"The ISO 5 BSC E00{bsc_id_str}, located in the {t_loc}, ({t_suite_phrase}), was used for both sample processing and aliquoting steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{bsc_id_str} was certified and approved by both the Engineering and Quality Assurance teams."
+        part2 = celsis_bsc_paragraph(bsc_id_str, a_bsc)
         
         # --- 在这里加入了绝杀的 as per SOP 2.600.059 ---
         if analyst == aliquoter:
@@ -104,115 +180,41 @@ def generate_celsis_equipment_text():
         return f"{part1}\n\n{part2} {usage_sent}"
         
     else:
-        part2 = f"The ISO 5 BSC E00{bsc_id_str}, located in the {t_loc}, ({t_suite_phrase}), and ISO 5 BSC E00{a_bsc}, located in the {a_loc}, ({a_suite_phrase}), were thoroughly cleaned and disinfected prior to their respective procedures in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, the BSCs used throughout testing, E00{bsc_id_str} for sample processing and E00{a_bsc} for the aliquoting step, were certified and approved by both the Engineering and Quality Assurance teams."
+        part2 = celsis_bsc_paragraph(bsc_id_str, a_bsc)
         
         # --- 在这里加入了绝杀的 as per SOP 2.600.059 ---
         usage_sent = f"Sample processing was conducted in the ISO 5 BSC E00{bsc_id_str} in the {t_loc}, ({t_suite_phrase}) by {analyst} on {p_date}, and the aliquoting step was conducted in the ISO 5 BSC E00{a_bsc} in the {a_loc}, ({a_suite_phrase}) by {aliquoter} on {t_date} as per SOP 2.600.059."
         
         return f"{part1}\n\n{part2} {usage_sent}"
 
-def generate_celsis_narrative_and_details():
-    import streamlit as st
-    import re
-    def any_fail(*keys): return any(str(st.session_state.get(k, 'No growth')).lower() != 'no growth' and str(st.session_state.get(k, 'No growth')).strip() != '' for k in keys)
-    def first_fail(variants):
-        for v in variants:
-            obs = str(st.session_state.get(v[0], 'No growth')).lower()
-            if obs != 'no growth' and obs.strip() != '':
-                return (st.session_state.get(v[0]), st.session_state.get(v[1]), st.session_state.get(v[2]), v[3], v[4])
-        return None
-
-    def get_phase_text(p): return "processing" if p == "pro_" else "aliquoting"
-    def get_daily_time(d): return "the date before testing" if d == "be_" else "the date after testing" if d == "af_" else "the date of testing"
-    def get_weekly_time(d): return "the week prior to testing" if d == "be_" else "the week after testing" if d == "af_" else "the week of testing"
-
-    # Separate processing and aliquoting variants
-    pro_pers = [(f"pro_{d}obs_pers", f"pro_{d}etx_pers", f"pro_{d}id_pers", "processing", get_daily_time(d)) for d in ["be_","on_","af_"]]
-    pro_surf = [(f"pro_{d}obs_surf", f"pro_{d}etx_surf", f"pro_{d}id_surf", "processing", get_daily_time(d)) for d in ["be_","on_","af_"]]
-    pro_sett = [(f"pro_{d}obs_sett", f"pro_{d}etx_sett", f"pro_{d}id_sett", "processing", get_daily_time(d)) for d in ["be_","on_","af_"]]
-    pro_air  = [(f"pro_{d}obs_air_wk", f"pro_{d}etx_air_wk", f"pro_{d}id_air_wk", "processing", get_weekly_time(d)) for d in ["be_","on_","af_"]]
-    pro_room = [(f"pro_{d}obs_room_wk", f"pro_{d}etx_room_wk", f"pro_{d}id_room_wk", "processing", get_weekly_time(d)) for d in ["be_","on_","af_"]]
-
-    alq_pers = [(f"alq_{d}obs_pers", f"alq_{d}etx_pers", f"alq_{d}id_pers", "aliquoting", get_daily_time(d)) for d in ["be_","on_","af_"]]
-    alq_surf = [(f"alq_{d}obs_surf", f"alq_{d}etx_surf", f"alq_{d}id_surf", "aliquoting", get_daily_time(d)) for d in ["be_","on_","af_"]]
-    alq_sett = [(f"alq_{d}obs_sett", f"alq_{d}etx_sett", f"alq_{d}id_sett", "aliquoting", get_daily_time(d)) for d in ["be_","on_","af_"]]
-    alq_air  = [(f"alq_{d}obs_air_wk", f"alq_{d}etx_air_wk", f"alq_{d}id_air_wk", "aliquoting", get_weekly_time(d)) for d in ["be_","on_","af_"]]
-    alq_room = [(f"alq_{d}obs_room_wk", f"alq_{d}etx_room_wk", f"alq_{d}id_room_wk", "aliquoting", get_weekly_time(d)) for d in ["be_","on_","af_"]]
-    
-    def generate_phase_narrative(phase_title, pers, surf, sett, air, room, analyst_init, bsc_id):
-        all_daily = pers + surf + sett
-        all_weekly = air + room
-        
-        daily_fails = []
-        for v in all_daily:
-            obs = str(st.session_state.get(v[0], 'No growth')).lower()
-            if obs != 'no growth' and obs.strip() != '':
-                daily_fails.append(v)
-                
-        weekly_fails = []
-        for v in all_weekly:
-            obs = str(st.session_state.get(v[0], 'No growth')).lower()
-            if obs != 'no growth' and obs.strip() != '':
-                weekly_fails.append(v)
-
-        if not daily_fails:
-            daily_str = f"After reviewing the Environmental Monitoring results for the relevant testing dates, no microbial growth was detected on the personnel monitoring plates (analyst {analyst_init}) or on the ISO 5 BSC (E00{bsc_id}) settling and surface plates for the date of testing, the preceding date, or the subsequent date."
-        else:
-            daily_str = f"After reviewing the Environmental Monitoring results for the relevant testing dates, microbial growth was detected during daily sampling."
-            for v in daily_fails:
-                cat = "personnel sampling" if "pers" in v[0] else "surface sampling" if "surf" in v[0] else "settling plates"
-                daily_str += f" Specifically, on {v[4]}, {st.session_state.get(v[0])} was detected on {cat}. The organism was submitted under ID {st.session_state.get(v[1])} and identified as {st.session_state.get(v[2])}."
+def celsis_justification_case(state, em=None):
+    """Smart Justification 输入：两个阶段的全部 EM 失败记录 + 样品分离菌"""
+    if em is None:
+        em = EMMatrix(state)
+    failures = tuple(justification.FailureRecord(c.phase, c.daily, c.day, c.org_id or "") for c in em.failures())
+    return justification.JustificationCase("Celsis", state.get("positive_org", "N/A").strip(), failures,
+                                           justification.other_samples_clean(state))
 
-        if not weekly_fails:
-            weekly_str = "No growth was observed on weekly surface and active air sampling plates for either the week prior to testing or the week of testing."
-        else:
-            weekly_str = "However, microbial growth was observed during weekly sampling."
-            for v in weekly_fails:
-                cat = "active air sampling" if "air" in v[0] else "surface sampling"
-                weekly_str += f" During {v[4]}, {st.session_state.get(v[0])} was detected on weekly {cat} plates. The organism was submitted under ID {st.session_state.get(v[1])} and identified as {st.session_state.get(v[2])}."
+def generate_celsis_narrative_and_details():
+    em = EMMatrix(st.session_state)
 
-        return f"Environmental Monitoring from Celsis Sterility {phase_title.capitalize()}: {daily_str}\n\n{weekly_str}"
+    def generate_phase_narrative(phase_title, phase, analyst_init, bsc_id):
+        return narratives.render("celsis_em_phase", {
+            "phase_title": phase_title, "analyst_init": analyst_init, "bsc_id": bsc_id,
+            "daily_fails": [c.facts() for c in em.failures(phase, daily=True)],
+            "weekly_fails": [c.facts() for c in em.failures(phase, daily=False)],
+        })
 
     a_init = st.session_state.get('analyst_initial', '').strip()
     alq_init = st.session_state.get('aliquoting_initial', '').strip()
     pro_bsc = st.session_state.get('bsc_id', '').strip()
     alq_bsc = "1798"
     
-    em_pro_narrative = generate_phase_narrative("Processing", pro_pers, pro_surf, pro_sett, pro_air, pro_room, a_init, pro_bsc)
-    em_alq_narrative = generate_phase_narrative("Aliquoting", alq_pers, alq_surf, alq_sett, alq_air, alq_room, alq_init, alq_bsc)
-    
-    # Collect ALL failures for the Smart Justification Engine
-    failures = []
-    all_vars = pro_pers + pro_surf + pro_sett + pro_air + pro_room + alq_pers + alq_surf + alq_sett + alq_air + alq_room
-    for v in all_vars:
-        obs = str(st.session_state.get(v[0], 'No growth')).lower()
-        if obs != 'no growth' and obs.strip() != '':
-            time_type = 'daily' if v in pro_pers+pro_surf+pro_sett+alq_pers+alq_surf+alq_sett else 'weekly'
-            failures.append({"id": st.session_state.get(v[2], ""), "time": time_type, "timing": v[4]})
-
-    # SMART JUSTIFICATION ENGINE
-    smart_just = ""
-    positive_org = st.session_state.get("positive_org", "N/A").strip()
+    em_pro_narrative = generate_phase_narrative("Processing", "pro_", a_init, pro_bsc)
+    em_alq_narrative = generate_phase_narrative("Aliquoting", "alq_", alq_init, alq_bsc)
     
-    if not failures:
-        smart_just = "Based on the observations outlined above, the cleanroom environment was in optimal condition with no microbial growth detected. Therefore, it is highly unlikely that the failing results were due to reagents, supplies, the cleanroom environment, the process, or analyst involvement. Consequently, the possibility of laboratory error contributing to this failure is minimal, and the original result is deemed to be valid."
-    else:
-        just_parts = []
-        
-        all_em_ids = [f['id'].lower() for f in failures]
-        if positive_org.lower() not in all_em_ids and "pending" not in positive_org.lower():
-            just_parts.append(f"Notably, the colony morphology of all microorganisms recovered from the processing cleanroom environments differed from that of the microorganism isolated from the test sample ({positive_org}). This observation indicates that the environmental monitoring findings and the test sample contamination were likely isolated and unrelated events.")
-        
-        has_weekly = any(f['time'] == 'weekly' for f in failures)
-        if has_weekly:
-            just_parts.append("Also, while microbial growth was detected during weekly monitoring, it is important to note that these organisms were detected in the ISO 8 background room environment, whereas the sample manipulation occurred strictly within the ISO 5 primary engineering control.")
-            
-        has_daily_testing_day_failure = any(f['time'] == 'daily' and 'of testing' in f['timing'].lower() for f in failures)
-        if not has_daily_testing_day_failure:
-            just_parts.append("Also, the absence of contamination on analyst glove plates and work surface monitoring indicates that no viable transfer pathway existed from the ISO 8 areas to the ISO 5 BSCs where processing and aliquoting were performed.")
-            
-        just_parts.append("Furthermore, the lack of contamination in other samples supports the fact that the testing environment was operating under optimal conditions.")
-        smart_just = "\\n\\n".join(just_parts)
+    # SMART JUSTIFICATION ENGINE (4-step shielding rules, justification.py)
+    smart_just = justification.justify(celsis_justification_case(st.session_state, em))
 
     return em_pro_narrative, em_alq_narrative, smart_just
 
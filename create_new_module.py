@@ -37,6 +37,7 @@ def create_module(module_name, sop_ref="2.600.XXX", description="New Test Module
             print(f"  [1/4] Created template: {dst}")
         else:
             print(f"  [1/4] Warning: Source template {src} not found.")
+    print(f"  [1/4] Register them in template_registry.MANIFEST as '{module_lower}/p1/docx' and '{module_lower}/p1/pdf'.")
             
     # 2. Extract Variable Contract
     if os.path.exists(target_docx):
@@ -6,6 +6,11 @@ import json
 import io
 import sys
 from datetime import datetime, timedelta
+import narratives
+import mem_profile
+import pdf_schema
+import pdf_fit
+import template_registry
 
 # ReportLab for dynamic Page 7 Table Generation
 from reportlab.lib.pagesizes import letter
@@ -16,9 +21,13 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT
 
 # --- 1. Central Utilities ---
 try:
-    from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative
+    from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative, resolve_bsc, get_suite_info, scan_equipment_tokens, find_bsc_number
 except ImportError:
     def u_grl(i): return "Unknown", "000", "", "Unknown"
+    def resolve_bsc(b): return None
+    def get_suite_info(s): return None
+    def scan_equipment_tokens(t): return []
+    def find_bsc_number(t, kinds=()): return ""
     def get_full_name(i): return i
     def ordinal(n): return str(n)
     def num_to_words(n): return str(n)
@@ -41,6 +50,23 @@ FIELD_KEYS = [
     "date_of_weekly_surf", "weekly_surf_analyst", "room_surf_obs", "room_surf_etx", "room_surf_id"
 ]
 
+# Table 2 keys that may be filled from the local EM results store
+EM_TABLE2_KEYS = [
+    f"{prefix}_{field}_{when}"
+    for prefix in ["pers", "bsc_surf", "bsc_sett"]
+    for field in ["obs", "etx", "id"]
+    for when in ["before", "during", "after"]
+] + [
+    "air_obs", "air_etx", "air_id", "date_of_weekly_air", "weekly_air_analyst",
+    "room_surf_obs", "room_surf_etx", "room_surf_id", "date_of_weekly_surf", "weekly_surf_analyst",
+]
+
+def clear_table2(s=None):
+    """Drops the store-filled Table 2 cells, so they don't carry over into the next case"""
+    s = st.session_state if s is None else s
+    for key in EM_TABLE2_KEYS:
+        s.pop(key, None)
+
 def auto_fill_name(initial_key, name_key):
     initial = st.session_state.get(initial_key, "")
     current_name = st.session_state.get(name_key, "")
@@ -121,9 +147,9 @@ def parse_em_text(text):
             except: pass
             
         # Extract BSC / Equipment ID
-        bsc_match = re.search(r"(?:BSC|E00)?(\d{4})", p_name, re.IGNORECASE)
-        if bsc_match:
-            data["bsc_id"] = f"BSC E00{bsc_match.group(1)}"
+        bsc_num = find_bsc_number(p_name, kinds=("bsc", "equipment", "number"))
+        if bsc_num:
+            data["bsc_id"] = f"BSC E00{bsc_num}"
             
         # Extract Setup Analyst Initial
         analyst_match = re.search(r"(?:ScanC/O|ScanCO|Scan|Sterility|EM)\s+([A-Z]{2,3})\b", p_name, re.IGNORECASE)
@@ -179,6 +205,27 @@ def parse_em_text(text):
 
     return data
 
+def _parse_em_date(test_date_str):
+    """Parses an EM setup date (DDMMMYY / DDMMMYYYY / YYYYMMDD); returns None if invalid"""
+    clean_d = re.sub(r'[\s\-]', '', str(test_date_str).strip())
+    for fmt in ["%d%b%Y", "%d%b%y", "%Y%m%d"]:
+        try:
+            return datetime.strptime(clean_d, fmt)
+        except: pass
+    return None
+
+def _parse_etx_date(etx_id):
+    """Extracts the final read date encoded in an ETX ID (ETX-YYMMDD-NNNN)"""
+    if not etx_id:
+        return None
+    etx_match = re.search(r'ETX-(\d{2})(\d{2})(\d{2})-\d+', str(etx_id), re.IGNORECASE)
+    if etx_match:
+        yy, mm, dd = etx_match.groups()
+        try:
+            return datetime.strptime(f"20{yy}{mm}{dd}", "%Y%m%d")
+        except: pass
+    return None
+
 def compute_em_dates(test_date_str, etx_id=""):
     """
     Computes standard EM incubation milestones and OOS initiation/incident dates.
@@ -187,22 +234,8 @@ def compute_em_dates(test_date_str, etx_id=""):
     - 5-Day Read / Date of Incident / Date Initiated (20-25°C in E001034):
       NLT 5 days later (concluding on business day).
     """
-    clean_d = re.sub(r'[\s\-]', '', str(test_date_str).strip())
-    d_obj = None
-    for fmt in ["%d%b%Y", "%d%b%y", "%Y%m%d"]:
-        try:
-            d_obj = datetime.strptime(clean_d, fmt)
-            break
-        except: pass
-
-    dt_etx = None
-    if etx_id:
-        etx_match = re.search(r'ETX-(\d{2})(\d{2})(\d{2})-\d+', str(etx_id), re.IGNORECASE)
-        if etx_match:
-            yy, mm, dd = etx_match.groups()
-            try:
-                dt_etx = datetime.strptime(f"20{yy}{mm}{dd}", "%Y%m%d")
-            except: pass
+    d_obj = _parse_em_date(test_date_str)
+    dt_etx = _parse_etx_date(etx_id)
 
     if d_obj:
         test_d_std = d_obj.strftime("%d-%b-%Y")
@@ -272,6 +305,99 @@ def compute_em_dates(test_date_str, etx_id=""):
         "after_d_full": after_d_full
     }
 
+# --- 2b. BATCH INCUBATION PLANNER (whole week of plate setups) ---
+EM_INCUBATORS = {
+    "48h": "E001031",  # 30-35°C, minimum 48 hours
+    "5d": "E001034",   # 20-25°C, NLT 5 days
+}
+
+def parse_em_setups(text):
+    """Planner text, one plate per line: "Plate Name, Setup Date[, ETX]" (comma or tab separated)"""
+    setups = []
+    for line in (text or "").splitlines():
+        parts = [p.strip() for p in re.split(r"[,\t]", line)]
+        if len(parts) >= 2 and parts[0] and parts[1]:
+            setups.append({"sample_name": parts[0], "test_date": parts[1], "event_number": parts[2] if len(parts) > 2 else ""})
+    return setups
+
+def plan_em_batch(setups):
+    """
+    Vectorized version of compute_em_dates for a batch of plate setups.
+    `setups` is a list of dicts with "sample_name", "test_date" and optional "event_number".
+    Returns a dict of numpy datetime64[D] arrays (NaT where the setup date is invalid)
+    using exactly the same weekday rules as compute_em_dates.
+    """
+    import numpy as np
+
+    names = [str(row.get("sample_name", "")) for row in setups]
+    raw_dates = [str(row.get("test_date", "")) for row in setups]
+    start = np.array([_parse_em_date(row.get("test_date", "")) or "NaT" for row in setups], dtype="datetime64[D]")
+    etx = np.array([_parse_etx_date(row.get("event_number", "")) or "NaT" for row in setups], dtype="datetime64[D]")
+
+    # 1970-01-01 was a Thursday -> shift so that 0=Mon ... 6=Sun
+    w = (start.astype("int64") + 3) % 7
+    d_48h = start + np.where((w == 3) | (w == 4), 4, 2)
+    d_final = np.where(np.isnat(etx), start + np.where(w == 3, 11, np.where(w == 4, 10, 7)), etx)
+    d_final = np.where(np.isnat(start), np.datetime64("NaT"), d_final).astype("datetime64[D]")
+    before = start - np.where(w == 0, 3, 1)
+    after = start + np.where(w == 4, 3, 1)
+
+    return {
+        "sample_name": names,
+        "test_date": raw_dates,
+        "d_start": start,
+        "d_48h": d_48h,
+        "d_5d": d_final,
+        "before_d": before,
+        "after_d": after,
+    }
+
+def em_dates_from_plan(plan, idx):
+    """Formats one row of a batch plan into the same dict as compute_em_dates (for pre-populating an OOS)"""
+    import numpy as np
+
+    if np.isnat(plan["d_start"][idx]):
+        return compute_em_dates(plan["test_date"][idx])
+
+    def as_dt(key):
+        return plan[key][idx].astype(datetime)
+
+    d_obj, d_48h_dt, d_final_dt = as_dt("d_start"), as_dt("d_48h"), as_dt("d_5d")
+    before_dt, after_dt = as_dt("before_d"), as_dt("after_d")
+    return {
+        "test_date_std": d_obj.strftime("%d-%b-%Y"),
+        "d_start": d_obj.strftime("%d %b %Y"),
+        "d_start_full": d_obj.strftime("%d %B %Y"),
+        "d_48h": d_48h_dt.strftime("%d %b %Y"),
+        "d_48h_full": d_48h_dt.strftime("%d %B %Y"),
+        "d_5d": d_final_dt.strftime("%d %b %Y"),
+        "d_5d_full": d_final_dt.strftime("%d %B %Y"),
+        "date_initiated": d_final_dt.strftime("%d-%b-%Y"),
+        "date_of_incident": d_final_dt.strftime("%d-%b-%Y"),
+        "before_d": before_dt.strftime("%d %b %Y"),
+        "before_d_full": before_dt.strftime("%d %B %Y"),
+        "after_d": after_dt.strftime("%d %b %Y"),
+        "after_d_full": after_dt.strftime("%d %B %Y")
+    }
+
+def build_incubator_schedule(plan):
+    """
+    Groups a batch plan into a read schedule per incubator:
+    {"E001031": [("06 Jun 2026", [plate, ...]), ...], "E001034": [...]}
+    """
+    import numpy as np
+
+    schedule = {}
+    for milestone, incubator in EM_INCUBATORS.items():
+        dates = plan["d_48h"] if milestone == "48h" else plan["d_5d"]
+        valid = ~np.isnat(dates)
+        rows = []
+        for day in np.unique(dates[valid]):
+            plates = [plan["sample_name"][i] for i in np.flatnonzero(dates == day)]
+            rows.append((day.astype(datetime).strftime("%d %b %Y"), plates))
+        schedule[incubator] = rows
+    return schedule
+
 def get_cleanroom_info(sample_name="", bsc_id=""):
     """
     Infers Cleanroom Suite, Room Number, and Equipment ID:
@@ -279,58 +405,40 @@ def get_cleanroom_info(sample_name="", bsc_id=""):
     - CR116 (BSCs 1311, 1312) -> CR116 (E001738)
     - CR117 (BSCs 1309, 1310) -> CR117 (E001739)
     - CR114 (BSCs 1316, 1798) -> CR114 (E001736)
-    - L-Suite (BSCs 1938, 1317, 1319) -> CR145 (E001979)
+    - L-Suite (BSCs 1938, 1317, 1319, 1937, 1988) -> CR145 (E001979)
+    Suites, rooms and E-numbers come from facility_topology.json.
     """
     combined = (str(sample_name) + " " + str(bsc_id)).upper()
     
-    # Check BSC Number specifically preceded by BSC or E00, avoid 2026/2025/etc.
-    bsc_num_match = re.search(r'(?:BSC|E00)\s*(\d{4})', combined)
-    if bsc_num_match and not bsc_num_match.group(1).startswith("20"):
-        bsc_num = bsc_num_match.group(1)
-    else:
-        all_bsc = re.findall(r'\b(1309|1310|1311|1312|1313|1314|1316|1798|1938|1317|1319|1988|1937)\b', combined)
-        bsc_num = all_bsc[0] if all_bsc else ""
-    
+    # Year-like numbers (2026/2025/etc.) are never taken as BSCs. The Equipment / BSC field wins:
+    # the plate name is only used for what the field does not name (its BSC / equipment, its room).
+    field_tokens = scan_equipment_tokens(str(bsc_id).upper())
+    plate_tokens = scan_equipment_tokens(str(sample_name).upper())
+    tokens = field_tokens if any(t["kind"] in ("bsc", "equipment", "room") for t in field_tokens) else plate_tokens
+    bsc_num = (next((t["value"] for t in tokens if t["kind"] in ("bsc", "equipment") and t["prefixed"]), "")
+               or next((t["value"] for t in tokens if t["kind"] == "bsc"), ""))
     bsc_e_id = f"BSC E00{bsc_num}" if bsc_num else ""
-    
-    if bsc_num in ["1314", "1313"] or "115" in combined:
-        room_num = "115B" if bsc_num == "1314" else ("115A" if bsc_num == "1313" else ("115B" if "115B" in combined else "115A"))
-        suite_num = "115"
-        cr_suite = "CR115"
-        cr_display = "CR115 (E001737)"
-        cr_exp = "December 2026"
-        if not bsc_e_id:
-            bsc_e_id = f"Cleanroom Suite {room_num}"
-    elif bsc_num in ["1312", "1311"] or "116" in combined:
-        room_num = "116B" if bsc_num == "1312" else ("116A" if bsc_num == "1311" else ("116B" if "116B" in combined else "116A"))
-        suite_num = "116"
-        cr_suite = "CR116"
-        cr_display = "CR116 (E001738)"
-        cr_exp = "December 2026"
-        if not bsc_e_id:
-            bsc_e_id = f"Cleanroom Suite {room_num}"
-    elif bsc_num in ["1310", "1309"] or "117" in combined:
-        room_num = "117B" if bsc_num == "1310" else ("117A" if bsc_num == "1309" else ("117B" if "117B" in combined else "117A"))
-        suite_num = "117"
-        cr_suite = "CR117"
-        cr_display = "CR117 (E001739)"
-        cr_exp = "December 2026"
-        if not bsc_e_id:
-            bsc_e_id = f"Cleanroom Suite {room_num}"
-    elif bsc_num in ["1316", "1798"] or "114" in combined:
-        room_num = "114B" if bsc_num == "1316" else ("114A" if bsc_num == "1798" else ("114B" if "114B" in combined else "114A"))
-        suite_num = "114"
-        cr_suite = "CR114"
-        cr_display = "CR114 (E001736)"
-        cr_exp = "December 2026"
-        if not bsc_e_id:
-            bsc_e_id = f"Cleanroom Suite {room_num}"
-    elif bsc_num in ["1938", "1317", "1319", "1988", "1937"] or "145" in combined or "L-SUITE" in combined:
-        room_num = "145" if bsc_num in ["1938", "1317", "1319"] else "144"
-        suite_num = "L-Suite"
-        cr_suite = "L-Suite"
-        cr_display = "CR145 (E001979)"
-        cr_exp = "December 2026"
+
+    # Resolve through the facility model: registered BSC first, then a room/suite token in the text
+    bsc_info = resolve_bsc(bsc_num) if bsc_num else None
+    room_tok = next((t for t in field_tokens + plate_tokens if t["kind"] == "room"), None)
+    suite_num = ""
+    if bsc_info:
+        suite_num, room_num = bsc_info["suite"], bsc_info["room"]
+    elif room_tok:
+        suite_num = room_tok["suite"]
+        if suite_num == "L-Suite":
+            room_num = room_tok["room"] or "144"
+        elif room_tok["room"] != suite_num:
+            room_num = room_tok["room"]
+        else:
+            room_num = f"{suite_num}B" if f"{suite_num}B" in combined else f"{suite_num}A"
+
+    suite_info = get_suite_info(suite_num) if suite_num else None
+    if suite_info:
+        cr_suite = suite_info["cr_label"]
+        cr_display = f"CR{suite_info['cr_room']} (E00{suite_info['e_number']})"
+        cr_exp = suite_info["cert_expiry"]
         if not bsc_e_id:
             bsc_e_id = f"Cleanroom Suite {room_num}"
     else:
@@ -353,43 +461,22 @@ def get_cleanroom_info(sample_name="", bsc_id=""):
     }
 
 # --- 3. NARRATIVE GENERATION LOGIC (RS Approved Gold Standard) ---
-def generate_em_narrative():
-    """Generates the standardized 3-part Phase I narrative for Environmental Monitoring OOS matching RS approved gold standard"""
-    s = st.session_state
+def em_narrative_facts(s):
+    """Structured facts behind the 3-part Phase I narrative (any mapping of EM fields: session state or a saved case)"""
     analyst_name = s.get("analyst_name", "Guanchen (David) Li")
-    analyst_init = s.get("analyst_initial", "GL")
     reader_name = s.get("reader_name", "Maraya Chukwumerije and Simin Mohammad")
     sampling_type = s.get("sampling_type", "Surface Sampling")
     bsc_id = s.get("bsc_id", "BSC E001314")
     plate_name = s.get("sample_name", "Sterility GL E001314 S1 04JUN2026")
     test_date = s.get("test_date", "04 Jun 2026")
     event_id = s.get("event_number", "ETX-260615-0424")
-    cfu_count = s.get("cfu_count", "1")
     org_identified = s.get("manual_org", "colony-like artifact")
-    monthly_cleaning_date = s.get("monthly_cleaning_date", "26 April 2026")
-    cleaner_name = s.get("cleaner_name", "Rey Estrada")
-    test_method = s.get("test_method", "Sterility" if "Sterility" in plate_name else "SCAN RDI")
 
     # Cleanroom & Equipment Mapping
     cr_info = get_cleanroom_info(plate_name, bsc_id)
-    bsc_e_id = cr_info["bsc_e_id"]
-    room_num = cr_info["room_num"]
-    suite_num = cr_info["suite_num"]
-    cr_suite = cr_info["cr_suite"]
 
     # Compute Incubation & Milestone Dates
     dates = compute_em_dates(test_date, event_id)
-    d_start = dates["d_start"]
-    d_start_full = dates["d_start_full"]
-    d_48h = dates["d_48h"]
-    d_48h_full = dates["d_48h_full"]
-    d_5d = dates["d_5d"]
-    d_5d_full = dates["d_5d_full"]
-    before_d_full = dates["before_d_full"]
-    after_d_full = dates["after_d_full"]
-
-    is_cleanroom_weekly = any(k in sampling_type.lower() or k in plate_name.lower() for k in ["weekly", "air", "cart", "floor", "cleanroom"])
-    is_artifact = any(k in org_identified.lower() for k in ["artifact", "anomaly", "nonviable", "no growth upon subculture", "could not be confirmed"])
 
     # Determine reader names split
     if "Maraya" in reader_name and "Simin" in reader_name:
@@ -397,137 +484,37 @@ def generate_em_narrative():
     else:
         reader_1, reader_2 = reader_name, reader_name
 
-    # --- 1. Interview & Storage Block (Field 49) ---
-    sampling_lower = sampling_type.lower()
-    
-    if is_artifact:
-        cfu_obs_desc = f"one colony-like artifact was observed on {plate_name.split()[3] if len(plate_name.split()) > 3 else 'Surface Plate #1'}"
-        artifact_block = (
-            f"The observed artifact was submitted for microbial identification under {event_id}. "
-            f"However, following transfer or inoculation onto fresh media, no growth was observed. "
-            f"Therefore, the observed artifact could not be confirmed as a viable microbial colony or reported as a confirmed colony forming unit (CFU). "
-            f"The lack of growth upon subculture indicates that the observation may have been nonviable material, an artifact associated with agar preparation or pouring, or another non-microbial artifact."
-        )
-        recovery_nature = "recovery"
-    else:
-        cfu_obs_desc = f"{cfu_count} colony forming unit (CFU) was observed on {plate_name.split()[3] if len(plate_name.split()) > 3 else sampling_type}"
-        artifact_block = (
-            f"Based on the observations in Table 1, the {sampling_lower} plate recovery was submitted for microbial identification under {event_id}. "
-            f"The recovered microorganism was identified as {org_identified}."
-        )
-        recovery_nature = "organism identified was transient or recurring"
-
-    if is_cleanroom_weekly:
-        interview_block = (
-            f"The analyst involved in the {sampling_lower} plate setup, {analyst_name} ({analyst_init}), and the analysts involved in "
-            f"reading the plate, {reader_name}, were interviewed comprehensively. Their responses are documented throughout this investigation.\n\n"
-            f"The EM plates were stored in accordance with the supplier's recommendations, visually inspected before use, and verified to be within their assigned expiration dates. "
-            f"All materials and supplies were disinfected in accordance with MICRO-SOP-9, Cleaning and Disinfecting Procedure for Microbiology. "
-            f"The functionality of the incubators was verified through review of data generated by the in-house continuous monitoring system.\n\n"
-            f"{sampling_type} was performed by {analyst_name} during weekly environmental monitoring in Cleanroom Suite {room_num} on the date of testing ({d_start_full}), "
-            f"in accordance with MICRO-SOP-2, Environmental Monitoring of the Cleanroom Facility.\n\n"
-            f"The plates were initially incubated at a temperature of 30-35°C in incubator E001031 for a minimum duration of 48 hours, commencing on {d_start_full}. "
-            f"Following completion of the minimum 48 hours of incubation on {d_48h_full}, no microbial growth was observed. The plates were subsequently "
-            f"incubated for a minimum of 5 days at 20-25°C in incubator E001034, with incubation ending on {d_5d_full}. At completion of the second incubation period, "
-            f"{cfu_obs_desc}. The plate was read by {reader_1} after the initial incubation period and by {reader_2} after the second incubation period. "
-            f"Please see Table 1 for detailed information on the observations during the respective incubations.\n\n"
-            f"{artifact_block}\n\n"
-            f"To determine whether the recovery was transient or recurring, personnel-monitoring plates for {analyst_name} and Cleanroom Suite {room_num} "
-            f"environmental-monitoring plates were bracketed to include the date before testing ({before_d_full}), the date of testing ({d_start_full}), and the date after testing ({after_d_full}), as detailed in Table 2."
-        )
-    else:
-        interview_block = (
-            f"The analyst involved in the {sampling_lower} plate setup, {analyst_name} ({analyst_init}), and the analysts involved in "
-            f"reading the plate, {reader_name}, were interviewed comprehensively. Their responses are documented throughout this investigation.\n\n"
-            f"The EM plates were stored in accordance with the supplier's recommendations, visually inspected before use, and verified to be within their assigned expiration dates. "
-            f"All materials and supplies were disinfected in accordance with MICRO-SOP-9, Cleaning and Disinfecting Procedure for Microbiology. "
-            f"The functionality of the incubators was verified through review of data generated by the in-house continuous monitoring system.\n\n"
-            f"{sampling_type} was performed by {analyst_name} in ISO 5 {bsc_e_id} located in room {room_num} in suite {cr_suite} on the date of testing ({d_start_full}), "
-            f"in accordance with MICRO-SOP-2, Environmental Monitoring of the Cleanroom Facility.\n\n"
-            f"The plates were initially incubated at a temperature of 30-35°C in incubator E001031 for a minimum duration of 48 hours, commencing on {d_start_full}. "
-            f"Following completion of the minimum 48 hours of incubation on {d_48h_full}, no microbial growth was observed. The plates were subsequently "
-            f"incubated for a minimum of 5 days at 20-25°C in incubator E001034, with incubation ending on {d_5d_full}. At completion of the second incubation period, "
-            f"{cfu_obs_desc}. The plate was read by {reader_1} after the initial incubation period and by {reader_2} after the second incubation period. "
-            f"Please see Table 1 for detailed information on the observations during the respective incubations.\n\n"
-            f"{artifact_block}\n\n"
-            f"To determine whether the {recovery_nature} was transient or recurring, personnel-monitoring plates for {analyst_name} and ISO 5 {bsc_e_id} "
-            f"environmental-monitoring plates were bracketed to include the date before testing ({before_d_full}), the date of testing ({d_start_full}), and the date after testing ({after_d_full}), as detailed in Table 2."
-        )
-
-    # --- 2. EM Records Block (Field 50) ---
-    if is_cleanroom_weekly:
-        records_block = (
-            f"Environmental Monitoring Summary:\n"
-            f"Weekly surface and active air sampling for {cr_suite} for the previous week and following week of testing showed no microbial growth.\n\n"
-            f"However, the {sampling_type} for {cr_suite} for the week of testing, performed on {d_start_full} by analyst {analyst_init}, exhibited {cfu_count} CFUs on {plate_name}, "
-            f"which were identified as {org_identified}. Routine monitoring on the date of testing showed no growth across other monitored locations.\n\n"
-            f"During the interview with the analyst, they indicated that no obvious abnormalities or deviations in the testing procedure were observed. "
-            f"All materials were disinfected prior to testing. Moreover, the cleanroom suites in {cr_suite} were thoroughly cleaned and prepared before initiating testing as per MICRO-SOP-2 and MICRO-SOP-9.\n\n"
-            f"Monthly cleaning and disinfection of the cleanroom suite, including the ISO 8 anteroom ({suite_num}), ISO 7 buffer room ({suite_num}A), ISO 7 cleanroom ({suite_num}B), "
-            f"and the ISO 5 biosafety cabinets located within Room {suite_num}B, were performed on {monthly_cleaning_date} by Analyst - {cleaner_name} - in accordance with MICRO-SOP-9, "
-            f"Cleaning and Disinfecting Procedure for Microbiology. All H2O2 indicators passed, confirming the successful completion and effectiveness of the monthly cleaning and disinfection activities "
-            f"within Rooms {suite_num}, {suite_num}A, and {suite_num}B. Additionally, routine cleaning and disinfection were performed before and after the testing activity in accordance with MICRO-SOP-9.\n\n"
-            f"It is important to note that no samples processed within that week in {cr_suite} failed {test_method} testing that week.\n\n"
-            f"Based on the available evidence, the recovery of {cfu_count} CFU of {org_identified} from {plate_name} in {room_num} on the date of testing ({d_start_full}) appears to be an isolated event. "
-            f"This assessment is supported by the absence of microbial recovery from surrounding monitored areas and negative routine monitoring results throughout the bracketing period.\n\n"
-            f"The negative settling, personnel, and bracketing surface monitoring results demonstrate that the critical environment remained in a state of control. "
-            f"The available data do not support migration, persistence, or recurrence of contamination within {cr_suite}. Collectively, the evidence supports that the recovery was an isolated, "
-            f"transient, and non-recurring event, while established cleaning, disinfection, and aseptic controls remained effective."
-        )
-    else:
-        if is_artifact:
-            obs_assessment = (
-                f"Based on the available evidence, one colony-like artifact was observed on {plate_name} in ISO 5 {bsc_e_id} on the date of testing ({d_start_full}). "
-                f"However, the observation could not be confirmed as a viable microbial CFU because no growth was obtained following inoculation onto fresh media. "
-                f"Therefore, the observation may represent a nonviable or non-microbial artifact, including a potential artifact associated with agar preparation or the agar-pouring process.\n\n"
-                f"If the observed artifact had represented a viable CFU, it would appear to be an isolated event. This assessment is supported by the absence of microbial recovery from "
-                f"{analyst_name}'s personnel-monitoring plates on the date before testing ({before_d_full}), the date of testing ({d_start_full}), and the date after testing ({after_d_full}); "
-                f"the absence of growth from {bsc_e_id} surface samples collected on the date before testing and the date after testing; and the absence of growth from ISO 5 settling plates throughout the bracketing period."
-            )
-        else:
-            obs_assessment = (
-                f"Based on the available evidence, the recovery of {cfu_count} CFU of {org_identified} from {plate_name} in ISO 5 {bsc_e_id} on the date of testing ({d_start_full}) appears to be an isolated event. "
-                f"This assessment is supported by the absence of microbial recovery from {analyst_name}'s personnel-monitoring plates on the date before testing ({before_d_full}) and the date of testing ({d_start_full}); "
-                f"the absence of growth from {bsc_e_id} surface samples collected on the date before testing and the subsequent available monitoring date after testing ({after_d_full}); "
-                f"and the absence of growth from ISO 5 settling plates throughout the bracketing period."
-            )
-
-        records_block = (
-            f"Environmental Monitoring Summary:\n"
-            f"Personnel monitoring plates for {analyst_name}, including left- and right-touch plates, showed no microbial growth on the date before testing ({before_d_full}), "
-            f"the date of testing ({d_start_full}), and the date after testing ({after_d_full}).\n\n"
-            f"For ISO 5 {bsc_e_id}, daily surface sampling of four locations showed no microbial growth on the date before testing ({before_d_full}). "
-            f"On the date of testing ({d_start_full}), {cfu_count} CFU was recovered from {plate_name.split()[3] if len(plate_name.split()) > 3 else 'Surface #1'} associated with {analyst_name}. "
-            f"The recovery was documented under {event_id}; microbial identification indicated {org_identified}. Surface sampling performed on the date after testing ({after_d_full}) showed no microbial growth.\n\n"
-            f"Settling sampling of ISO 5 {bsc_e_id}, including two locations, showed no microbial growth on the date before testing ({before_d_full}), "
-            f"the date of testing ({d_start_full}), and the date after testing ({after_d_full}).\n\n"
-            f"Weekly active-air monitoring of Suite {suite_num} conducted during the week before testing and the week of testing showed no microbial growth.\n\n"
-            f"Weekly surface monitoring of the anteroom and cleanroom areas associated with Suite {suite_num} showed no microbial growth during the week before testing or the week of testing.\n\n"
-            f"During the interview, the analyst indicated that no obvious abnormalities or deviations occurred during the testing process. All materials were disinfected before testing, "
-            f"and the relevant cleanroom and ISO 5 BSC were cleaned and prepared before testing in accordance with MICRO-SOP-2 and MICRO-SOP-9.\n\n"
-            f"Monthly cleaning and disinfection of the cleanroom suite, including the ISO 8 anteroom ({suite_num}), ISO 7 buffer room ({suite_num}A), ISO 7 cleanroom ({suite_num}B), "
-            f"and the ISO 5 biosafety cabinets located within Room {suite_num}B, were performed on {monthly_cleaning_date} by Analyst - {cleaner_name} - in accordance with MICRO-SOP-9, "
-            f"Cleaning and Disinfecting Procedure for Microbiology. All H2O2 indicators passed, confirming the successful completion and effectiveness of the monthly cleaning and disinfection activities "
-            f"within Rooms {suite_num}, {suite_num}A, and {suite_num}B. Additionally, routine cleaning and disinfection were performed before and after the testing activity in accordance with MICRO-SOP-9.\n\n"
-            f"It is also important to note that no samples processed by {analyst_name} in ISO 5 {bsc_e_id} on the date of testing ({d_start}) failed {test_method} testing.\n\n"
-            f"{obs_assessment}\n\n"
-            f"The negative ISO 5 settling, personnel, and bracketing surface monitoring results demonstrate that the {bsc_e_id} critical environment remained in a state of control. "
-            f"The available data do not support migration, persistence, or recurrence of contamination within ISO 5 {bsc_e_id}. Collectively, the evidence supports that the recovery was an isolated, "
-            f"transient, and non-recurring event, while established cleaning, disinfection, and aseptic controls remained effective."
-        )
-
-    # --- 3. Phase I Summary / Defensive Conclusion (Field 51 - RS Gold Standard) ---
-    summary_block = (
-        "Accordingly, no systemic environmental control deficiencies were identified, and no additional corrective or preventive actions "
-        "are warranted at this time beyond continued routine environmental monitoring and adherence to approved cleaning, disinfection, and aseptic procedures."
-    )
+    plate_parts = plate_name.split()
+    return {
+        "analyst_name": analyst_name,
+        "analyst_init": s.get("analyst_initial", "GL"),
+        "reader_name": reader_name, "reader_1": reader_1, "reader_2": reader_2,
+        "sampling_type": sampling_type, "sampling_lower": sampling_type.lower(),
+        "plate_name": plate_name, "plate_loc": plate_parts[3] if len(plate_parts) > 3 else None,
+        "event_id": event_id,
+        "cfu_count": s.get("cfu_count", "1"),
+        "org_identified": org_identified,
+        "monthly_cleaning_date": s.get("monthly_cleaning_date", "26 April 2026"),
+        "cleaner_name": s.get("cleaner_name", "Rey Estrada"),
+        "test_method": s.get("test_method", "Sterility" if "Sterility" in plate_name else "SCAN RDI"),
+        "bsc_e_id": cr_info["bsc_e_id"], "room_num": cr_info["room_num"],
+        "suite_num": cr_info["suite_num"], "cr_suite": cr_info["cr_suite"],
+        "d_start": dates["d_start"], "d_start_full": dates["d_start_full"],
+        "d_48h_full": dates["d_48h_full"], "d_5d_full": dates["d_5d_full"],
+        "before_d_full": dates["before_d_full"], "after_d_full": dates["after_d_full"],
+        "is_weekly": any(k in sampling_type.lower() or k in plate_name.lower() for k in ["weekly", "air", "cart", "floor", "cleanroom"]),
+        "is_artifact": any(k in org_identified.lower() for k in ["artifact", "anomaly", "nonviable", "no growth upon subculture", "could not be confirmed"]),
+    }
 
-    return interview_block, records_block, summary_block
+def generate_em_narrative(s=None):
+    """Generates the standardized 3-part Phase I narrative for Environmental Monitoring OOS matching RS approved gold standard"""
+    # Field 49 (interview & storage), Field 50 (EM records), Field 51 (summary): locked wording in narratives.py
+    return narratives.render_all(("em_interview", "em_records", "em_summary"), em_narrative_facts(st.session_state if s is None else s))
 
-def build_em_context():
-    """Builds a complete context dictionary for rendering DOCX and PDF templates"""
-    s = st.session_state
-    interview_block, records_block, summary_block = generate_em_narrative()
+def build_em_context(s=None):
+    """Builds a complete context dictionary for rendering DOCX and PDF templates (s: session_state or a field payload)"""
+    s = st.session_state if s is None else s
+    interview_block, records_block, summary_block = generate_em_narrative(s)
 
     analyst_name = s.get('analyst_name', 'Guanchen (David) Li')
     analyst_init = s.get('analyst_initial', 'GL')
@@ -655,8 +642,22 @@ def build_em_context():
         "writer_name": writer_name,
         "manager_name": manager_name
     }
+
+    # Table 2 cells filled from the EM results store (em_store.em_table2_fields); the OOS plate's own cell keeps priority
+    own_prefix = "bsc_surf_" if "Surface" in sampling_type else ("bsc_sett_" if "Settling" in sampling_type else "")
+    for key in EM_TABLE2_KEYS:
+        if s.get(key) and not (own_prefix and key.startswith(own_prefix) and key.endswith("_during")):
+            ctx[key] = s[key]
     return ctx
 
+def recurrence_flags(s=None):
+    """Recurrence flags (em_trends) for the room / BSC of the case, shown on the EM page"""
+    s = st.session_state if s is None else s
+    import em_trends
+    cr_info = get_cleanroom_info(s.get('sample_name', ''), s.get('bsc_id', ''))
+    as_of = compute_em_dates(s.get('test_date', ''), s.get('event_number', ''))["test_date_std"]
+    return em_trends.case_flags(as_of, suite=cr_info["suite_num"], room=cr_info["room_num"], bsc=cr_info["bsc_num"])
+
 # --- 4. DYNAMIC PAGE 7 ATTACHMENT GENERATOR (ReportLab) ---
 def generate_em_tables_page_pdf(ctx):
     """Generates vector Page 7 containing Table 1 & Table 2 matching official QA standards"""
@@ -846,37 +847,53 @@ def generate_em_tables_page_pdf(ctx):
     return buf
 
 # --- 5. REPORT GENERATION ENGINE (DOCX & 7-Page PDF) ---
-def generate_em_reports():
-    """Generates both the official DOCX and complete 7-Page interactive PDF reports"""
-    ctx = build_em_context()
-    interview_block, records_block, summary_block = generate_em_narrative()
+# Headings of the narrative fields on the pdf_fit continuation page
+EM_PDF_LABELS = {'Text Field49': "Interview Narrative", 'Text Field50': "Records Review", 'Text Field51': "Investigation Summary"}
+
+def export_fields(s=None):
+    """JSON field payload of a case (Save Session keys plus Table 2 cells filled from the EM results store)"""
+    s = st.session_state if s is None else s
+    return {k: s[k] for k in dict.fromkeys(FIELD_KEYS + EM_TABLE2_KEYS) if k in s}
+
+@mem_profile.profiled("EM generate_em_reports")
+def generate_em_reports(s=None, report_error=None, load_template=None):
+    """
+    Generates both the official DOCX and complete 7-Page interactive PDF reports.
+    s / report_error / load_template let report_service render a field payload outside Streamlit
+    (load_template(name) returns the template stream of a template_registry name).
+    """
+    report_error = report_error or st.error
+    load_template = load_template or template_registry.open_template
+    ctx = build_em_context(s)
+    interview_block, records_block, summary_block = generate_em_narrative(s)
+    mem_profile.checkpoint("context & narrative")
 
     docx_buf = io.BytesIO()
     pdf_buf = io.BytesIO()
 
     # 1. Generate Word Document
-    target_docx = "EM OOS P1 template.docx"
-    if not os.path.exists(target_docx):
-        target_docx = "EM OOS P1 template 0.docx"
-
-    if os.path.exists(target_docx):
+    docx_template = template_registry.resolve("em/p1/docx")
+    if docx_template is not None:
         try:
             from docxtpl import DocxTemplate
-            doc = DocxTemplate(target_docx)
+            doc = DocxTemplate(load_template(docx_template.key))
             doc.render(ctx)
             doc.save(docx_buf)
             docx_buf.seek(0)
         except Exception as e:
-            st.error(f"Error rendering Word template: {e}")
+            report_error(f"Error rendering Word template: {e}")
             docx_buf = None
     else:
         docx_buf = None
+    mem_profile.checkpoint("DOCX render")
 
     # 2. Generate Complete 7-Page PDF
-    target_pdf = "EM OOS P1 template.pdf"
-    if os.path.exists(target_pdf):
+    pdf_template = template_registry.resolve("em/p1/pdf")
+    if pdf_template is not None:
         try:
             from pypdf import PdfWriter, PdfReader
+            # Schema of the registry blob that is filled below, not of whatever the file on disk holds now
+            target_pdf = pdf_schema.blob_schema(template_registry.blob(pdf_template.sha256), pdf_template.sha256, pdf_template.path)
             
             # Map 157 Form 3.100.019.F01 fields
             pdf_map = {
@@ -941,27 +958,31 @@ def generate_em_reports():
             }
 
             # Checkbox Yes/No defaults matching production PDF QA standards (EM is internal facility testing)
+            # Only the boxes the form has (Check Box0..92), taken from its schema instead of a blind range(100)
             yes_boxes = {4, 9, 10, 13, 16, 19, 24, 27, 28, 33, 36, 39, 42, 43, 48, 51, 52, 55, 60, 63, 66, 69, 72, 73, 78, 79, 87}
-            for i in range(100):
-                if i in yes_boxes:
-                    pdf_map[f'Check Box{i}'] = '/Yes'
-                else:
-                    pdf_map[f'Check Box{i}'] = ''
+            for name in pdf_schema.field_names(target_pdf, "checkbox"):
+                i = int(name.replace('Check Box', ''))
+                pdf_map[name] = '/Yes' if i in yes_boxes else ''
+            pdf_schema.validate_pdf_map(target_pdf, pdf_map)
 
             # Fill Form 1-6
-            writer = PdfWriter(clone_from=target_pdf)
-            for page in writer.pages:
-                writer.update_page_form_field_values(page, pdf_map)
+            writer = PdfWriter(clone_from=load_template(pdf_template.key))
+            overflow = pdf_fit.fill_form(writer, target_pdf, pdf_map)
+            mem_profile.checkpoint("PDF clone & form fill")
                 
             # Generate Page 7 Attachment Table
             page7_pdf_buf = generate_em_tables_page_pdf(ctx)
             p7_reader = PdfReader(page7_pdf_buf)
             writer.add_page(p7_reader.pages[0])
+            mem_profile.checkpoint("Page 7 tables (ReportLab)")
+
+            # Narrative text that does not fit its field even at the minimum size continues after Page 7
+            pdf_fit.append_continuation(writer, overflow, EM_PDF_LABELS)
 
             writer.write(pdf_buf)
             pdf_buf.seek(0)
         except Exception as e:
-            st.error(f"Error rendering PDF template: {e}")
+            report_error(f"Error rendering PDF template: {e}")
             pdf_buf = None
     else:
         pdf_buf = None
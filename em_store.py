@@ -0,0 +1,335 @@
+# filename: em_store.py
+"""
+Local EM results store (SQLite).
+Loads exported EM spreadsheets (CSV / XLSX) into an indexed table and answers one
+range query per case to fill the bracketing blocks of EM, ScanRDI, USP71 and Celsis.
+"""
+import os
+import re
+import csv
+import sqlite3
+from datetime import datetime, date, timedelta
+
+try:
+    from utils import resolve_bsc, scan_equipment_tokens, get_full_name
+except ImportError:
+    def resolve_bsc(b): return None
+    def scan_equipment_tokens(t): return []
+    def get_full_name(i): return ""
+
+# --- 1. CONFIG & SCHEMA ---
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "em_results.db")
+DB_ENV = "EM_RESULTS_DB"  # overrides DB_FILE (load_test / golden scratch runs)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS em_results (
+    id          INTEGER PRIMARY KEY,
+    sample_date TEXT NOT NULL,          -- ISO YYYY-MM-DD
+    suite       TEXT NOT NULL DEFAULT '',
+    room        TEXT NOT NULL DEFAULT '',
+    bsc         TEXT NOT NULL DEFAULT '',
+    analyst     TEXT NOT NULL DEFAULT '',
+    category    TEXT NOT NULL,          -- pers / surf / sett / air / room
+    observation TEXT NOT NULL DEFAULT 'No Growth',
+    etx         TEXT NOT NULL DEFAULT '',
+    org_id      TEXT NOT NULL DEFAULT '',
+    UNIQUE (sample_date, suite, room, bsc, analyst, category, etx)
+);
+CREATE INDEX IF NOT EXISTS ix_em_suite_date   ON em_results (suite, sample_date);
+CREATE INDEX IF NOT EXISTS ix_em_room_date    ON em_results (room, sample_date);
+CREATE INDEX IF NOT EXISTS ix_em_bsc_date     ON em_results (bsc, sample_date);
+CREATE INDEX IF NOT EXISTS ix_em_analyst_date ON em_results (analyst, sample_date);
+"""
+
+CATEGORIES = ("pers", "surf", "sett", "air", "room")
+WEEKLY_CATEGORIES = ("air", "room")
+SLOTS = ("be", "on", "af")
+
+# Spreadsheet header aliases -> column
+COLUMN_ALIASES = {
+    "sample_date": ["sample date", "date", "date sampled", "sampling date", "test date"],
+    "room": ["room", "location", "cleanroom", "suite"],
+    "bsc": ["bsc", "equipment", "equipment id", "bsc id"],
+    "analyst": ["analyst", "initials", "analyst initials", "sampled by"],
+    "category": ["category", "sample type", "sampling type", "type"],
+    "observation": ["observation", "result", "cfu", "obs"],
+    "etx": ["etx", "etx id", "event", "event number", "plate etx id"],
+    "org_id": ["microbial id", "organism", "identification", "id"],
+}
+
+def db_file():
+    """The store path: $EM_RESULTS_DB if set, else DB_FILE next to this module"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    """Opens (and creates if needed) the EM results database"""
+    conn = sqlite3.connect(db_path or db_file())
+    conn.row_factory = sqlite3.Row
+    _migrate_unique_key(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+def _migrate_unique_key(conn):
+    """Stores created before room joined the UNIQUE key are rebuilt in place (rows kept)"""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'em_results'").fetchone()
+    if not row or "suite, room, bsc" in row[0]:
+        return
+    conn.executescript("ALTER TABLE em_results RENAME TO em_results_old;"
+                       "DROP INDEX IF EXISTS ix_em_suite_date; DROP INDEX IF EXISTS ix_em_room_date;"
+                       "DROP INDEX IF EXISTS ix_em_bsc_date; DROP INDEX IF EXISTS ix_em_analyst_date;" + SCHEMA +
+                       "INSERT INTO em_results SELECT * FROM em_results_old; DROP TABLE em_results_old;")
+
+# --- 2. NORMALIZATION HELPERS ---
+def parse_date(value):
+    """Returns a datetime.date for DDMMMYY / DDMMMYYYY / DD-Mon-YYYY / YYYY-MM-DD / MM/DD/YYYY, else None"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    raw = str(value or "").strip()
+    if not raw:
+        return None
+    for candidate, fmts in [(raw.split(" ")[0], ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y"]),
+                            (re.sub(r"[\s\-]", "", raw), ["%d%b%Y", "%d%b%y", "%Y%m%d"])]:
+        for fmt in fmts:
+            try:
+                return datetime.strptime(candidate, fmt).date()
+            except ValueError:
+                continue
+    return None
+
+def normalize_category(text):
+    """Maps free-text sample types to pers / surf / sett / air / room"""
+    t = str(text or "").lower()
+    if "air" in t:
+        return "air"
+    if "weekly" in t or "room" in t or "floor" in t or "cart" in t:
+        return "room"
+    if "sett" in t:
+        return "sett"
+    if "pers" in t or "glove" in t or "touch" in t:
+        return "pers"
+    if "surf" in t or "contact" in t:
+        return "surf"
+    return ""
+
+def normalize_observation(text):
+    t = str(text or "").strip()
+    if not t or t in ["0", "0 CFU"] or t.lower() in ["no growth", "ng", "none", "n/a"]:
+        return "No Growth"
+    if t.isdigit():
+        return f"{t} CFU"
+    return t
+
+def _locate(bsc_text, room_text):
+    """Resolves (suite, room, bsc) from the BSC / room columns through the facility model"""
+    bsc, suite, room = "", "", ""
+    for tok in scan_equipment_tokens(f"{bsc_text} {room_text}"):
+        if tok["kind"] == "bsc" and not bsc:
+            bsc, suite, room = tok["value"], tok["suite"], tok["room"]
+        elif tok["kind"] == "room" and not suite:
+            suite, room = tok["suite"], tok["room"]
+        elif tok["kind"] == "equipment" and not bsc:
+            bsc = tok["value"]
+    return suite, room, bsc
+
+def normalize_row(raw):
+    """Converts one spreadsheet row (header -> value) into an em_results record, or None if unusable"""
+    lowered = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+    rec = {}
+    for col, aliases in COLUMN_ALIASES.items():
+        rec[col] = next((lowered[a] for a in aliases if a in lowered and lowered[a] not in (None, "")), "")
+
+    d = parse_date(rec["sample_date"])
+    category = normalize_category(rec["category"])
+    if not d or not category:
+        return None
+    suite, room, bsc = _locate(rec["bsc"], rec["room"])
+    etx = str(rec["etx"]).strip()
+    org = str(rec["org_id"]).strip()
+    return {
+        "sample_date": d.isoformat(),
+        "suite": suite,
+        "room": room,
+        "bsc": bsc,
+        "analyst": str(rec["analyst"]).strip().upper(),
+        "category": category,
+        "observation": normalize_observation(rec["observation"]),
+        "etx": "" if etx.upper() == "N/A" else etx,
+        "org_id": "" if org.upper() == "N/A" else org,
+    }
+
+# --- 3. SPREADSHEET IMPORT ---
+def read_spreadsheet(path):
+    """Yields header -> value dicts from a CSV or XLSX export"""
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = [str(h).strip() if h is not None else "" for h in next(rows, [])]
+            for values in rows:
+                yield dict(zip(header, values))
+        finally:
+            wb.close()
+    else:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                yield row
+
+def upsert_results(conn, records, commit=True):
+    """
+    Inserts or replaces normalized records and refreshes the trend aggregates for their days; returns
+    the number written. commit=False leaves the transaction open for the caller (trax_import commits
+    each batch together with its checkpoint).
+    """
+    records = [r for r in records if r]
+    conn.executemany(
+        "INSERT OR REPLACE INTO em_results (sample_date, suite, room, bsc, analyst, category, observation, etx, org_id) "
+        "VALUES (:sample_date, :suite, :room, :bsc, :analyst, :category, :observation, :etx, :org_id)",
+        records,
+    )
+    import em_trends
+    em_trends.refresh_days(conn, {r["sample_date"] for r in records})
+    if commit:
+        conn.commit()
+    return len(records)
+
+def import_em_results(path, db_path=None):
+    """Loads an exported EM spreadsheet into the store; returns the number of rows imported"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    conn = connect(db_path)
+    try:
+        return upsert_results(conn, (normalize_row(r) for r in read_spreadsheet(path)))
+    finally:
+        conn.close()
+
+# --- 4. BRACKETING QUERY ---
+def bracket_dates(test_date):
+    """Daily before/after dates (same weekday rules as the EM module) and Monday of the test week"""
+    w = test_date.weekday()
+    before = test_date - timedelta(days=3 if w == 0 else 1)
+    after = test_date + timedelta(days=3 if w == 4 else 1)
+    week_start = test_date - timedelta(days=w)
+    return before, after, week_start
+
+def query_bracket(test_date, bsc="", analyst="", suite="", db_path=None):
+    """
+    One indexed range query covering the daily (before/of/after) and weekly (prior/of/after)
+    windows around test_date. Returns {(slot, category): {"obs", "etx", "id", "date" (ISO), "analyst"}}
+    with slot in be/on/af and every slot filled ("No Growth" / "N/A" when nothing was recorded).
+    """
+    t_date = parse_date(test_date)
+    empty = {(slot, cat): {"obs": "No Growth", "etx": "N/A", "id": "N/A", "date": "", "analyst": ""}
+             for slot in SLOTS for cat in CATEGORIES}
+    db_path = db_path or db_file()
+    if not t_date or not os.path.exists(db_path):
+        return empty
+
+    bsc = re.sub(r"^(?:BSC)?\s*(?:E00)?", "", str(bsc or "").strip().upper())
+    analyst = str(analyst or "").strip().upper()
+    if not suite:
+        info = resolve_bsc(bsc) if bsc else None
+        suite = info["suite"] if info else ""
+
+    before, after, week_start = bracket_dates(t_date)
+    lo, hi = week_start - timedelta(days=7), week_start + timedelta(days=13)
+    daily_slots = {before.isoformat(): "be", t_date.isoformat(): "on", after.isoformat(): "af"}
+
+    conn = connect(db_path)
+    try:
+        if suite:
+            rows = conn.execute(
+                "SELECT * FROM em_results WHERE suite = ? AND sample_date BETWEEN ? AND ? ORDER BY sample_date",
+                (suite, lo.isoformat(), hi.isoformat())).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT * FROM em_results WHERE bsc = ? AND sample_date BETWEEN ? AND ? ORDER BY sample_date",
+                (bsc, lo.isoformat(), hi.isoformat())).fetchall()
+    finally:
+        conn.close()
+
+    result = dict(empty)
+    for row in rows:
+        cat = row["category"]
+        if cat in WEEKLY_CATEGORIES:
+            offset = (date.fromisoformat(row["sample_date"]) - week_start).days
+            slot = "be" if offset < 0 else ("on" if offset < 7 else "af")
+        else:
+            slot = daily_slots.get(row["sample_date"])
+            if not slot:
+                continue
+            if cat == "pers" and analyst and row["analyst"] != analyst:
+                continue
+            if cat in ("surf", "sett") and bsc and row["bsc"] and row["bsc"] != bsc:
+                continue
+
+        cur = result[(slot, cat)]
+        if cur["date"] and (cur["obs"] != "No Growth" or row["observation"] == "No Growth"):
+            # keep the first growth already recorded for this slot
+            continue
+        result[(slot, cat)] = {
+            "obs": row["observation"],
+            "etx": row["etx"] or "N/A",
+            "id": row["org_id"] or "N/A",
+            "date": row["sample_date"],
+            "analyst": row["analyst"],
+        }
+    return result
+
+def has_growth(slot):
+    return slot["obs"].strip().lower() not in ("", "no growth")
+
+# --- 5. MODULE ADAPTERS (bracket -> session_state keys) ---
+def celsis_bracket_fields(bracket, phase):
+    """Celsis: {phase}{be_|on_|af_}{obs|etx|id}_{pers|surf|sett|air_wk|room_wk}"""
+    fields = {}
+    for (slot, cat), v in bracket.items():
+        em_type = f"{cat}_wk" if cat in WEEKLY_CATEGORIES else cat
+        for field, key in [("obs", "obs"), ("etx", "etx"), ("id", "id")]:
+            fields[f"{phase}{slot}_{field}_{em_type}"] = v[key]
+    return fields
+
+GROWTH_EVENT_CATEGORIES = {
+    "pers": "Personnel Obs", "surf": "Surface Obs", "sett": "Settling Obs",
+    "air": "Weekly Air Obs", "room": "Weekly Surf Obs",
+}
+
+def growth_event_fields(bracket):
+    """ScanRDI / USP71: test-day and week-of growth as em_growth_* / em_cat_i / em_obs_i / em_etx_i / em_id_i"""
+    events = [(cat, bracket[("on", cat)]) for cat in CATEGORIES if has_growth(bracket[("on", cat)])]
+    fields = {"em_growth_observed": "Yes" if events else "No", "em_growth_count": max(len(events), 1)}
+    for i, (cat, v) in enumerate(events):
+        fields.update({f"em_cat_{i}": GROWTH_EVENT_CATEGORIES[cat], f"em_obs_{i}": v["obs"],
+                       f"em_etx_{i}": v["etx"], f"em_id_{i}": v["id"]})
+    return fields
+
+def em_table2_fields(bracket):
+    """EM module Table 2 (before / during / after + weekly air and room surface)"""
+    names = {"be": "before", "on": "during", "af": "after"}
+    fields = {}
+    for slot, name in names.items():
+        for cat, prefix in [("pers", "pers"), ("surf", "bsc_surf"), ("sett", "bsc_sett")]:
+            v = bracket[(slot, cat)]
+            fields[f"{prefix}_obs_{name}"] = v["obs"] if has_growth(v) else "No growth"
+            fields[f"{prefix}_etx_{name}"] = v["etx"]
+            fields[f"{prefix}_id_{name}"] = v["id"]
+    for cat, prefix, date_key, analyst_key in [("air", "air", "date_of_weekly_air", "weekly_air_analyst"),
+                                               ("room", "room_surf", "date_of_weekly_surf", "weekly_surf_analyst")]:
+        v = bracket[("on", cat)]
+        fields[f"{prefix}_obs"] = v["obs"] if has_growth(v) else "No growth"
+        fields[f"{prefix}_etx"] = v["etx"]
+        fields[f"{prefix}_id"] = v["id"]
+        if v["date"]:
+            fields[date_key] = date.fromisoformat(v["date"]).strftime("%d %b %Y")
+        # The store holds initials: only a full name replaces the template's default analyst
+        analyst = v["analyst"].title() if " " in v["analyst"].strip() else get_full_name(v["analyst"])
+        if analyst:
+            fields[analyst_key] = analyst
+    return fields
+
+if __name__ == "__main__":
+    import sys
+    for export_path in sys.argv[1:]:
+        print(f"[+] {export_path}: imported {import_em_results(export_path)} EM results into {db_file()}")
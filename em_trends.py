@@ -0,0 +1,180 @@
+# filename: em_trends.py
+"""
+EM excursion trend analytics.
+Keeps per-day sample / excursion counts with running totals for every suite, room, BSC,
+sampling type and organism in the EM results store, so any rolling window (30 / 90 / 180 days)
+is the difference of two indexed lookups. The totals are refreshed incrementally for the days
+touched by each import (em_store.upsert_results calls refresh_days). The EM page warns when the
+location of the case under investigation is a recurrence (case_flags).
+"""
+import os
+import sqlite3
+from datetime import timedelta
+
+import em_store
+from em_store import parse_date
+
+# --- 1. CONFIG & SCHEMA ---
+WINDOWS = (30, 90, 180)
+DIMENSIONS = ("all", "suite", "room", "bsc", "category", "organism")
+RECURRENCE_LEVEL = 2  # excursions at one location within the shortest window that count as a recurrence
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS em_trend_daily (
+    dim            TEXT NOT NULL,        -- all / suite / room / bsc / category / organism
+    key            TEXT NOT NULL,        -- '*' for dim 'all'
+    day            TEXT NOT NULL,        -- ISO YYYY-MM-DD
+    samples        INTEGER NOT NULL,
+    excursions     INTEGER NOT NULL,
+    cum_samples    INTEGER NOT NULL,     -- running totals up to and including `day`
+    cum_excursions INTEGER NOT NULL,
+    PRIMARY KEY (dim, key, day)
+) WITHOUT ROWID;
+"""
+
+# One aggregate per dimension: (dimension, key expression, extra filter)
+_GROWTH = "lower(observation) != 'no growth'"
+_DAILY_SQL = {
+    "all": ("'*'", ""),
+    "suite": ("suite", "AND suite != ''"),
+    "room": ("room", "AND room != ''"),
+    "bsc": ("bsc", "AND bsc != ''"),
+    "category": ("category", ""),
+    "organism": ("org_id", f"AND org_id != '' AND {_GROWTH}"),
+}
+
+def connect(db_path=None):
+    """Opens the EM results database with the trend table in place"""
+    conn = em_store.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+# --- 2. INCREMENTAL REFRESH ---
+def refresh_days(conn, days):
+    """
+    Recomputes the daily buckets for `days` (ISO strings) from em_results and rolls the running
+    totals forward from the earliest touched day, only for the keys those days affect. No commit.
+    """
+    days = {d for d in days if d}
+    if not days:
+        return 0
+    conn.execute(SCHEMA)  # single statement: unlike executescript, does not commit the caller's batch
+    if not conn.execute("SELECT 1 FROM em_trend_daily LIMIT 1").fetchone():
+        days.update(r[0] for r in conn.execute("SELECT DISTINCT sample_date FROM em_results"))  # first use on an existing store
+    days = sorted(days)
+    marks = ",".join("?" * len(days))
+    touched = {(r[0], r[1]) for r in conn.execute(f"SELECT dim, key FROM em_trend_daily WHERE day IN ({marks})", days)}
+    conn.execute(f"DELETE FROM em_trend_daily WHERE day IN ({marks})", days)
+    for dim, (key_expr, extra) in _DAILY_SQL.items():
+        rows = conn.execute(
+            f"SELECT {key_expr}, sample_date, COUNT(*), SUM(CASE WHEN {_GROWTH} THEN 1 ELSE 0 END) "
+            f"FROM em_results WHERE sample_date IN ({marks}) {extra} GROUP BY 1, 2", days).fetchall()
+        conn.executemany("INSERT INTO em_trend_daily VALUES (?, ?, ?, ?, ?, 0, 0)",
+                         [(dim, k, d, n, x) for k, d, n, x in rows])
+        touched.update((dim, k) for k, _, _, _ in rows)
+    for dim, key in touched:
+        _roll_forward(conn, dim, key, days[0])
+    return len(touched)
+
+def _roll_forward(conn, dim, key, start_day):
+    base = conn.execute("SELECT cum_samples, cum_excursions FROM em_trend_daily WHERE dim = ? AND key = ? AND day < ? "
+                        "ORDER BY day DESC LIMIT 1", (dim, key, start_day)).fetchone() or (0, 0)
+    cum_n, cum_x, updates = base[0], base[1], []
+    for day, n, x in conn.execute("SELECT day, samples, excursions FROM em_trend_daily WHERE dim = ? AND key = ? AND day >= ? "
+                                  "ORDER BY day", (dim, key, start_day)).fetchall():
+        cum_n, cum_x = cum_n + n, cum_x + x
+        updates.append((cum_n, cum_x, dim, key, day))
+    conn.executemany("UPDATE em_trend_daily SET cum_samples = ?, cum_excursions = ? WHERE dim = ? AND key = ? AND day = ?", updates)
+
+def rebuild(db_path=None):
+    """Full recompute (e.g. for a results store created before trend tracking); returns the number of keys"""
+    conn = connect(db_path)
+    try:
+        conn.execute("DELETE FROM em_trend_daily")
+        days = [r[0] for r in conn.execute("SELECT DISTINCT sample_date FROM em_results")]
+        n = refresh_days(conn, days)
+        conn.commit()
+        return n
+    finally:
+        conn.close()
+
+# --- 3. WINDOW QUERIES ---
+def _cum_at(conn, dim, key, day_iso):
+    row = conn.execute("SELECT cum_samples, cum_excursions FROM em_trend_daily WHERE dim = ? AND key = ? AND day <= ? "
+                       "ORDER BY day DESC LIMIT 1", (dim, key, day_iso)).fetchone()
+    return row if row else (0, 0)
+
+def _window(conn, dim, key, as_of, days):
+    hi = _cum_at(conn, dim, key, as_of.isoformat())
+    lo = _cum_at(conn, dim, key, (as_of - timedelta(days=days)).isoformat())
+    samples, excursions = hi[0] - lo[0], hi[1] - lo[1]
+    return {"samples": samples, "excursions": excursions,
+            "rate": round(100.0 * excursions / samples, 2) if samples and dim != "organism" else None}
+
+def trend_facts(as_of, suite="", room="", bsc="", category="", organism="", db_path=None):
+    """
+    Rolling counts ending on `as_of` for the facility and each given location / type / organism:
+    {dim: {"key": k, 30: {samples, excursions, rate}, 90: {...}, 180: {...}}}
+    """
+    d = parse_date(as_of)
+    if not d:
+        return {}
+    wanted = {"all": "*", "suite": suite, "room": room, "bsc": bsc, "category": em_store.normalize_category(category) or category, "organism": organism}
+    conn = connect(db_path)
+    try:
+        return {dim: {"key": key, **{w: _window(conn, dim, key, d, w) for w in WINDOWS}}
+                for dim, key in wanted.items() if key}
+    finally:
+        conn.close()
+
+def recurrence_flags(facts, level=RECURRENCE_LEVEL):
+    """Locations (room / BSC) or organisms with `level`+ excursions in the shortest window"""
+    w = WINDOWS[0]
+    return [f"{dim} {v['key']}: {v[w]['excursions']} excursions in {w} days"
+            for dim, v in facts.items() if dim in ("room", "bsc", "organism") and v[w]["excursions"] >= level]
+
+def leaderboard(dim, as_of, limit=25, db_path=None):
+    """Keys of one dimension ranked by excursions in the longest window (dashboard view)"""
+    d = parse_date(as_of)
+    if not d or dim not in DIMENSIONS:
+        return []
+    conn = connect(db_path)
+    try:
+        keys = [r[0] for r in conn.execute("SELECT DISTINCT key FROM em_trend_daily WHERE dim = ?", (dim,))]
+        rows = []
+        for key in keys:
+            row = {dim: key}
+            for w in WINDOWS:
+                win = _window(conn, dim, key, d, w)
+                row[f"{w}d excursions"] = win["excursions"]
+                row[f"{w}d samples"] = win["samples"]
+            rows.append(row)
+    finally:
+        conn.close()
+    rows.sort(key=lambda r: (-r[f"{WINDOWS[-1]}d excursions"], -r[f"{WINDOWS[0]}d excursions"], str(r[dim])))
+    return rows[:limit]
+
+def daily_series(dim, key, as_of, days=WINDOWS[-1], db_path=None):
+    """Per-day excursions for one key over the last `days` days: [(date, samples, excursions)]"""
+    d = parse_date(as_of)
+    if not d:
+        return []
+    conn = connect(db_path)
+    try:
+        return conn.execute("SELECT day, samples, excursions FROM em_trend_daily WHERE dim = ? AND key = ? AND day > ? AND day <= ? "
+                            "ORDER BY day", (dim, key, (d - timedelta(days=days)).isoformat(), d.isoformat())).fetchall()
+    finally:
+        conn.close()
+
+# --- 4. CASE FLAGS (EM page) ---
+def case_flags(as_of, suite="", room="", bsc="", db_path=None):
+    """Recurrence flags for the location of an EM investigation; [] without a results store"""
+    if not os.path.exists(db_path or em_store.db_file()):
+        return []
+    try:
+        return recurrence_flags(trend_facts(as_of, suite=suite, room=room, bsc=bsc, db_path=db_path))
+    except sqlite3.Error:
+        return []
+
+if __name__ == "__main__":
+    print(f"[+] Rebuilt EM trend aggregates for {rebuild()} keys")
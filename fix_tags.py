@@ -17,6 +17,8 @@ def fix_tags(filepath):
                     if 'subculture _initial' in p.text:
                         p.text = p.text.replace('subculture _initial', 'subculture_initial')
     doc.save(filepath)
+    import template_registry
+    template_registry.sync()  # register the rewritten template as a new version right away
 
 if __name__ == "__main__":
     fix_tags('USP71 OOS P1 template 0.docx')
@@ -0,0 +1,384 @@
+# filename: golden.py
+"""
+Golden-output regression check for the module reports.
+Every module page is driven headless with its fixture email, and the DOCX / PDF artifacts it offers
+for download are compared with the goldens in golden/<module>.json, so template, context and
+performance work can land without silently changing the locked report verbiage. Only the pages'
+own widgets are used, so the goldens can be recorded from the code before a change (--tree) and
+the change checked against them.
+Artifacts are compared in a canonical form that ignores what Word and the PDF writer change from
+save to save:
+    DOCX  document.xml, headers and footers, one entry per paragraph: its text and a hash of its
+          C14N XML with rsid / paraId attributes, proofing marks and bookmarks removed and adjacent
+          runs of identical formatting merged
+    PDF   form field values and the extracted text of every page
+Each artifact also carries a digest of its canonical form, so a match costs one comparison; only a
+mismatch is walked to its first differing paragraph / field / line. Modules run in parallel, one
+worker process each.
+
+    python golden.py                      # check every module (exit code 1 on any difference)
+    python golden.py --modules EM USP71 --keep out/
+    python golden.py --update             # accept the current output as the new goldens
+    python golden.py --tree <rev> --update  # record the goldens from a git revision (or a directory)
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import multiprocessing
+from itertools import zip_longest
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+if ROOT not in sys.path:  # the workers import the pages' logic modules from the repo root
+    sys.path.insert(0, ROOT)
+
+# --- 1. CONFIG ---
+GOLDEN_DIR = os.path.join(ROOT, "golden")
+GOLDEN_VERSION = 1  # bump when the canonical form changes (then run --update)
+WORKERS = min(4, os.cpu_count() or 2)
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+DOCX_PARTS = re.compile(r"^word/(document|header\d*|footer\d*)\.xml$")
+NOISE_ATTRS = re.compile(r"^(rsid\w*|paraId|textId)$")
+NOISE_TAGS = {W + "proofErr", W + "bookmarkStart", W + "bookmarkEnd", W + "lastRenderedPageBreak"}
+
+def _digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+def _natural(name):
+    """Field order of pdf_schema (not imported: a recorded revision may predate it)"""
+    return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", name)]
+
+# --- 2. CANONICAL FORMS ---
+def _strip_noise(root):
+    for el in list(root.iter()):
+        if el.tag in NOISE_TAGS:
+            el.getparent().remove(el)
+            continue
+        for attr in [a for a in el.attrib if NOISE_ATTRS.match(a.split("}")[-1])]:
+            del el.attrib[attr]
+
+def _merge_runs(p):
+    """Joins adjacent text-only runs of identical formatting (Word splits runs differently on every save)"""
+    from lxml import etree
+    prev, prev_fmt = None, None
+    for r in list(p.iterchildren(W + "r")):
+        kids = [k for k in r if k.tag != W + "rPr"]
+        if len(kids) != 1 or kids[0].tag != W + "t":
+            prev = None
+            continue
+        rpr = r.find(W + "rPr")
+        fmt = etree.tostring(rpr, method="c14n") if rpr is not None else b""
+        if prev is not None and fmt == prev_fmt and r.getprevious() is prev:
+            t = prev.find(W + "t")
+            t.text = (t.text or "") + (kids[0].text or "")
+            t.set(XML_SPACE, "preserve")
+            p.remove(r)
+        else:
+            prev, prev_fmt = r, fmt
+
+def _paragraph_text(p):
+    parts = []
+    for el in p.iter(W + "t", W + "tab", W + "br"):
+        if next(el.iterancestors(W + "p")) is not p:
+            continue  # text of a nested text-box paragraph: listed on its own
+        parts.append((el.text or "") if el.tag == W + "t" else "\t" if el.tag == W + "tab" else "\n")
+    return "".join(parts)
+
+def canonical_docx(data):
+    """{"kind", "digest", "parts": {part: [[text, xml hash], ...]}} of a rendered .docx"""
+    from lxml import etree
+    parts = {}
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for part in sorted(n for n in zf.namelist() if DOCX_PARTS.match(n)):
+            root = etree.fromstring(zf.read(part))
+            _strip_noise(root)
+            paragraphs = []
+            for p in root.iter(W + "p"):
+                if any(a.tag == MC_FALLBACK for a in p.iterancestors()):
+                    continue  # VML copy of a text box that mc:Choice already holds
+                _merge_runs(p)
+                xml = etree.tostring(p, method="c14n")
+                paragraphs.append([_paragraph_text(p), hashlib.sha256(xml).hexdigest()[:12]])
+            parts[part] = paragraphs
+    return {"kind": "docx", "digest": _digest(parts), "parts": parts}
+
+def canonical_pdf(data):
+    """{"kind", "digest", "fields": {name: value}, "pages": [[line, ...], ...]} of a rendered PDF"""
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    raw = reader.get_fields() or {}
+    fields = {k: str(raw[k].get("/V") or "") for k in sorted(raw, key=_natural)}
+    pages = [[line.rstrip() for line in (page.extract_text() or "").splitlines()] for page in reader.pages]
+    return {"kind": "pdf", "digest": _digest([fields, pages]), "fields": fields, "pages": pages}
+
+def canonical(name, data):
+    return canonical_pdf(data) if name.endswith(".pdf") else canonical_docx(data)
+
+# --- 3. COMPARISON ---
+def _diff(where, golden, actual, note=""):
+    return {"where": where, "golden": golden, "actual": actual, "note": note}
+
+def first_difference(golden, actual):
+    """{"where", "golden", "actual", "note"} of the first difference between two canonical artifacts, None when equal"""
+    if golden["digest"] == actual["digest"]:
+        return None
+    if golden["kind"] == "docx":
+        for part in sorted(set(golden["parts"]) | set(actual["parts"])):
+            g_paras, a_paras = golden["parts"].get(part, []), actual["parts"].get(part, [])
+            for i, (g, a) in enumerate(zip_longest(g_paras, a_paras), start=1):
+                if g != a:
+                    note = "same text, formatting differs" if g and a and g[0] == a[0] else ""
+                    return _diff(f"{part} paragraph {i}", g[0] if g else None, a[0] if a else None, note)
+    else:
+        for name in sorted(set(golden["fields"]) | set(actual["fields"]), key=_natural):
+            g, a = golden["fields"].get(name), actual["fields"].get(name)
+            if g != a:
+                return _diff(f"field '{name}'", g, a)
+        for page, (g_lines, a_lines) in enumerate(zip_longest(golden["pages"], actual["pages"]), start=1):
+            for line, (g, a) in enumerate(zip_longest(g_lines or [], a_lines or []), start=1):
+                if g != a:
+                    return _diff(f"page {page} line {line}", g, a, "" if g_lines is not None and a_lines is not None else "page count differs")
+    return _diff("canonical form", None, None, "digest differs (regenerate the goldens after a GOLDEN_VERSION change)")
+
+# --- 4. GOLDEN FILES ---
+def golden_path(module):
+    return os.path.join(GOLDEN_DIR, f"{module}.json")
+
+def dump_golden(golden):
+    """JSON with one line per paragraph / field / text line, so a verbiage change is a readable diff"""
+    j = lambda v: json.dumps(v, ensure_ascii=False)
+    out = ["{", f'  "module": {j(golden["module"])},', f'  "version": {golden["version"]},', '  "artifacts": {']
+    arts = []
+    for name, art in golden["artifacts"].items():
+        lines = [f'    {j(name)}: {{', f'      "kind": {j(art["kind"])},', f'      "digest": {j(art["digest"])},']
+        if art["kind"] == "docx":
+            parts = [f'        {j(part)}: [\n' + ",\n".join(f"          {j(p)}" for p in paras) + "\n        ]"
+                     for part, paras in art["parts"].items()]
+            lines.append('      "parts": {\n' + ",\n".join(parts) + "\n      }")
+        else:
+            lines.append('      "fields": {\n' + ",\n".join(f"        {j(k)}: {j(v)}" for k, v in art["fields"].items()) + "\n      },")
+            pages = ["        [\n" + ",\n".join(f"          {j(line)}" for line in page) + "\n        ]" for page in art["pages"]]
+            lines.append('      "pages": [\n' + ",\n".join(pages) + "\n      ]")
+        arts.append("\n".join(lines) + "\n    }")
+    out.append(",\n".join(arts))
+    out += ["  }", "}"]
+    return "\n".join(out) + "\n"
+
+def load_golden(module):
+    try:
+        with open(golden_path(module), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_golden(golden):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with open(golden_path(golden["module"]), "w", encoding="utf-8") as f:
+        f.write(dump_golden(golden))
+
+# --- 5. RUN (one worker per module) ---
+def _artifact_name(label, file_name):
+    """report / tables / p2 + extension of a download button (the session backup .txt is not an artifact)"""
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext not in (".docx", ".pdf"):
+        return None
+    return ("tables" if file_name.startswith("Tables ") else "p2" if "P2" in label else "report") + ext
+
+def _enter_tree(tree):
+    """Worker initializer: import the pages' logic modules from `tree` instead of this checkout"""
+    sys.path[:] = [tree] + [p for p in sys.path if os.path.abspath(p or ".") != ROOT]
+    os.chdir(tree)
+
+def capture_downloads(tree, spec, email):
+    """
+    Drives the module page of `tree` headless with the fixture email (parse, Generate, "Proceed Anyway";
+    ScanRDI also generates Phase 2) and returns {artifact name: bytes} of the download buttons it shows,
+    first render first. Only the page's own buttons are used, so any revision of the app can be recorded.
+    """
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    downloads = {}
+    download_button = st.download_button
+
+    def recording_download(label, data, file_name=None, *args, **kwargs):
+        name = _artifact_name(label, file_name or "")
+        if name and name not in downloads:  # reruns re-show the buttons: the first render is the golden
+            downloads[name] = data.getvalue() if hasattr(data, "getvalue") else data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        return download_button(label, data, file_name, *args, **kwargs)
+
+    def click(at, label):
+        button = next((b for b in at.button if label in b.label), None)
+        return button.click().run() if button is not None else at
+
+    st.download_button = recording_download
+    try:
+        at = AppTest.from_file(os.path.join(tree, "app.py"), default_timeout=spec["timeout"]).run()
+        at.switch_page(spec["page"]).run()
+        at.text_area[0].input(email)
+        at = click(at, spec["parse"])
+        at = click(at, spec["generate"])
+        at = click(at, spec["proceed"])
+        if spec.get("phase2"):
+            at.checkbox(key="include_phase2").check().run()
+            at = click(at, "GENERATE PHASE 2")
+    finally:
+        st.download_button = download_button
+    if not downloads:
+        problems = [e.message for e in at.exception] + [e.value for e in at.error]
+        raise RuntimeError(f"the page offered no report ({problems[0].splitlines()[0] if problems else 'no error shown'})")
+    return downloads
+
+def render_module(module, spec, email, tree=ROOT, keep=False):
+    """
+    Worker: renders the module of `tree` (this checkout, in a load_test scratch dir, or an extracted revision).
+    {"module", "artifacts": {name: canonical}, "errors", "raw": {name: bytes} (keep only), "seconds"}
+    """
+    import contextlib
+    t0 = time.perf_counter()
+    result = {"module": module, "artifacts": {}, "errors": [], "raw": {}}
+    try:
+        if tree == ROOT:
+            import load_test
+            context = load_test.scratch()
+        else:
+            context = contextlib.nullcontext()  # an extracted revision is a throwaway dir already
+        with context:
+            downloads = capture_downloads(tree, spec, email)
+        for name, data in downloads.items():
+            result["artifacts"][name] = canonical(name, data)
+            if keep:
+                result["raw"][name] = data
+    except Exception as e:
+        result["errors"].append(f"{type(e).__name__}: {e}")
+    result["seconds"] = round(time.perf_counter() - t0, 1)
+    return result
+
+def extract_tree(rev):
+    """Throwaway copy of a git revision (or of a directory) to record / check goldens against"""
+    import shutil
+    import tarfile
+    import tempfile
+    import subprocess
+    work = tempfile.mkdtemp(prefix="oos_golden_")
+    if os.path.isdir(rev):
+        shutil.copytree(rev, work, dirs_exist_ok=True, ignore=shutil.ignore_patterns("*.db", "*.db-*", "__pycache__", ".git"))
+    else:
+        archive = subprocess.run(["git", "-C", ROOT, "archive", "--format=tar", rev], check=True, capture_output=True).stdout
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(work)
+    return work
+
+def check(result):
+    """[(artifact, difference or message)] of a rendered module against its golden ([] when it matches)"""
+    golden = load_golden(result["module"])
+    if golden is None:
+        return [("", f"no golden ({os.path.relpath(golden_path(result['module']), ROOT)}); run with --update")]
+    if golden.get("version") != GOLDEN_VERSION:
+        return [("", f"golden is canonical form v{golden.get('version')}, this is v{GOLDEN_VERSION}; run with --update")]
+    problems = []
+    for name in sorted(set(golden["artifacts"]) | set(result["artifacts"])):
+        g, a = golden["artifacts"].get(name), result["artifacts"].get(name)
+        if g is None:
+            problems.append((name, "rendered, but not in the golden"))
+        elif a is None:
+            problems.append((name, "in the golden, but not rendered"))
+        else:
+            diff = first_difference(g, a)
+            if diff:
+                problems.append((name, diff))
+    return problems
+
+def _short(text, limit=300):
+    if text is None:
+        return "<missing>"
+    text = text.replace("\n", "\\n")
+    return text if len(text) <= limit else text[:limit] + " ..."
+
+def print_result(result, problems):
+    module = result["module"]
+    for err in result["errors"]:
+        print(f"[!] {module}: {err.splitlines()[0][:300]}")
+    if result["errors"] and not result["artifacts"]:
+        return
+    if not problems:
+        print(f"[+] {module}: {len(result['artifacts'])} artifacts match ({result['seconds']}s)")
+    for name, problem in problems:
+        if isinstance(problem, str):
+            print(f"[x] {module}{' ' + name if name else ''}: {problem}")
+            continue
+        print(f"[x] {module} {name}: first difference at {problem['where']}" + (f" ({problem['note']})" if problem["note"] else ""))
+        print(f"      golden: {_short(problem['golden'])}")
+        print(f"      actual: {_short(problem['actual'])}")
+
+def main(argv=None):
+    import argparse
+    import load_test
+    parser = argparse.ArgumentParser(description="Golden-output regression check of the module reports")
+    parser.add_argument("--modules", nargs="+", default=list(load_test.MODULES), choices=list(load_test.MODULES))
+    parser.add_argument("--update", action="store_true", help="write the current output as the goldens")
+    parser.add_argument("--keep", metavar="DIR", help="also write the rendered artifacts to DIR")
+    parser.add_argument("--tree", metavar="REV", help="render a git revision (or a directory) instead of this checkout, "
+                        "e.g. --tree <baseline> --update to record the goldens from the code before a change")
+    parser.add_argument("--jobs", type=int, default=WORKERS)
+    parser.add_argument("--json", help="also write the differences to this file")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    specs, emails = [], []
+    for module in args.modules:
+        m = load_test.MODULES[module]
+        specs.append({"page": m["page"], "parse": m["parse"], "generate": m["generate"], "proceed": load_test.PROCEED,
+                      "phase2": module == "ScanRDI", "timeout": load_test.TIMEOUT})
+        with open(os.path.join(load_test.FIXTURE_DIR, m["fixture"]), encoding="utf-8") as f:
+            emails.append(f.read())
+    tree = extract_tree(args.tree) if args.tree else ROOT
+    # Another tree needs fresh interpreters: a forked worker would keep this checkout's modules imported
+    pool = ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(args.modules))),
+                               **({"mp_context": multiprocessing.get_context("spawn"), "initializer": _enter_tree, "initargs": (tree,)} if args.tree else {}))
+    try:
+        with pool:
+            results = list(pool.map(render_module, args.modules, specs, emails, [tree] * len(specs), [bool(args.keep)] * len(specs)))
+    finally:
+        if args.tree:
+            import shutil
+            shutil.rmtree(tree, ignore_errors=True)
+
+    failed, report = False, {}
+    for result in results:
+        module = result["module"]
+        if args.keep:
+            os.makedirs(args.keep, exist_ok=True)
+            for name, data in result["raw"].items():
+                with open(os.path.join(args.keep, f"{module} {name}"), "wb") as f:
+                    f.write(data)
+        if args.update:
+            if result["errors"]:
+                print(f"[!] {module}: not updated ({result['errors'][0].splitlines()[0][:300]})")
+                failed = True
+            else:
+                save_golden({"module": module, "version": GOLDEN_VERSION, "artifacts": result["artifacts"]})
+                print(f"[+] {module}: golden written ({len(result['artifacts'])} artifacts, {result['seconds']}s)")
+            continue
+        problems = check(result)
+        print_result(result, problems)
+        failed = failed or bool(problems) or bool(result["errors"])
+        report[module] = {"errors": result["errors"], "differences": [{"artifact": n, **(p if isinstance(p, dict) else {"note": p})} for n, p in problems]}
+    print(f"[=] {len(results)} modules in {time.perf_counter() - t0:.1f}s" + (", differences found" if failed and not args.update else ""))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    # Run from the importable module: AppTest swaps sys.modules["__main__"] in the workers, so tasks
+    # pickled as __main__.render_module could not be found there
+    import golden
+    sys.exit(golden.main(sys.argv[1:]))
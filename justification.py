@@ -0,0 +1,134 @@
+# filename: justification.py
+"""
+Smart Justification Engine (4-step shielding mechanism, see OOS_Justification_Flowcharts.md).
+Each rule is a declarative predicate over the EM failure records of a case, a quantifier
+(any / none) and a locked sentence. Predicates are compiled once and evaluated column-wise with
+numpy over a whole batch of cases, so one pass justifies hundreds of EM excursions across Celsis,
+ScanRDI and USP <71>. The sentences are the approved Smart Justification verbiage: do not edit
+them without explicit permission.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+# --- 1. RECORDS ---
+class FailureRecord(NamedTuple):
+    """One EM excursion: phase (pro_ / alq_ / ''), daily vs weekly sampling, day (be_ / on_ / af_), organism ID"""
+    phase: str
+    daily: bool
+    day: str
+    org_id: str
+
+class JustificationCase(NamedTuple):
+    """
+    method: Celsis / ScanRDI / USP71; positive_org None when the test gives no identification (ScanRDI);
+    other_samples_clean False when other samples tested positive the same day (Rule 4 does not apply)
+    """
+    method: str
+    positive_org: object
+    failures: tuple
+    other_samples_clean: bool = True
+
+# --- 2. RULES (locked sentences) ---
+class Rule(NamedTuple):
+    name: str
+    when: str          # expression over the failure columns, None = always (once any failure exists)
+    quantifier: str    # "any": fires if a failure matches; "none": fires if no failure matches
+    sentence: str
+    needs_id: bool = False
+
+RULES = (
+    # Rule 1: isolate identical?
+    Rule("id_mismatch", "id_match", "none",
+         "Notably, the colony morphology of all microorganisms recovered from the processing cleanroom environments differed from that of the microorganism isolated from the test sample ({positive_org}). This observation indicates that the environmental monitoring findings and the test sample contamination were likely isolated and unrelated events.",
+         needs_id=True),
+    # Rule 2: ISO 8 background vs ISO 5 manipulation
+    Rule("iso8_isolation", "weekly", "any",
+         "Also, while microbial growth was detected during weekly monitoring, it is important to note that these organisms were detected in the ISO 8 background room environment, whereas the sample manipulation occurred strictly within the ISO 5 primary engineering control."),
+    # Rule 3: transfer pathway (analyst gloves / work surfaces clean on the testing day)
+    Rule("transfer_pathway", "daily & testing_day", "none",
+         "Also, the absence of contamination on analyst glove plates and work surface monitoring indicates that no viable transfer pathway existed from the ISO 8 areas to {iso5_where}."),
+    # Rule 4: macro-environment (only when the other samples of the session were clean)
+    Rule("macro_environment", "other_clean", "any",
+         "Furthermore, the lack of contamination in other samples supports the fact that the testing environment was operating under optimal conditions."),
+)
+
+CLEAN_SENTENCE = "Based on the observations outlined above, the cleanroom environment was in optimal condition with no microbial growth detected. Therefore, it is highly unlikely that the failing results were due to reagents, supplies, the cleanroom environment, the process, or analyst involvement. Consequently, the possibility of laboratory error contributing to this failure is minimal, and the original result is deemed to be valid."
+
+# Per-method workflow wording and paragraph separator (Celsis report fields use a literal "\n")
+METHODS = {
+    "Celsis": {"iso5_where": "the ISO 5 BSCs where processing and aliquoting were performed", "sep": "\\n\\n", "clean": CLEAN_SENTENCE},
+    "ScanRDI": {"iso5_where": "the ISO 5 BSCs where processing and changeover were performed", "sep": "\n\n", "clean": ""},
+    "USP71": {"iso5_where": "the ISO 5 BSC where processing was performed", "sep": "\n\n", "clean": ""},
+}
+
+_COMPILED = tuple((r, compile(r.when, r.name, "eval") if r.when else None) for r in RULES)
+
+# --- 3. VECTORIZED EVALUATION ---
+def _columns(cases):
+    owner, daily, testing_day, id_match, other_clean = [], [], [], [], []
+    for i, c in enumerate(cases):
+        pos = str(c.positive_org).lower() if c.positive_org is not None else None
+        for f in c.failures:
+            owner.append(i)
+            daily.append(bool(f.daily))
+            testing_day.append(f.day == "on_")
+            id_match.append(pos is not None and str(f.org_id or "").lower() == pos)
+            other_clean.append(bool(c.other_samples_clean))
+    daily = np.array(daily, dtype=bool)
+    return {"case": np.array(owner, dtype=np.intp), "daily": daily, "weekly": ~daily,
+            "testing_day": np.array(testing_day, dtype=bool), "id_match": np.array(id_match, dtype=bool),
+            "other_clean": np.array(other_clean, dtype=bool)}
+
+def evaluate(cases):
+    """{rule name: bool array over cases} plus "has_failures"; one numpy pass per rule for the whole batch"""
+    n = len(cases)
+    cols = _columns(cases)
+    has_fail = np.bincount(cols["case"], minlength=n) > 0
+    id_known = np.array([c.positive_org is not None and "pending" not in str(c.positive_org).lower() for c in cases], dtype=bool)
+    fired = {"has_failures": has_fail}
+    for rule, code in _COMPILED:
+        if code is None:
+            hit = has_fail.copy()
+        else:
+            matches = np.bincount(cols["case"][eval(code, {}, cols)], minlength=n)
+            hit = has_fail & ((matches > 0) if rule.quantifier == "any" else (matches == 0))
+        if rule.needs_id:
+            hit &= id_known
+        fired[rule.name] = hit
+    return fired
+
+def justify_batch(cases):
+    """Smart Justification paragraph for every case (same order)"""
+    cases = list(cases)
+    fired = evaluate(cases)
+    out = []
+    for i, c in enumerate(cases):
+        m = METHODS[c.method]
+        if not fired["has_failures"][i]:
+            out.append(m["clean"])
+            continue
+        parts = [r.sentence.format(positive_org=c.positive_org, iso5_where=m["iso5_where"]) for r in RULES if fired[r.name][i]]
+        out.append(m["sep"].join(parts))
+    return out
+
+def justify(case):
+    return justify_batch([case])[0]
+
+# --- 4. CASE FIELDS FROM THE PAGE STATE ---
+def other_samples_clean(state):
+    """Flowchart Rule 4 gate: no other sample of the session tested positive"""
+    return state.get("other_positives", "No") != "Yes"
+
+# --- 5. FAILURE RECORDS FROM FIXED EM FIELDS (ScanRDI / USP71) ---
+def fixed_field_failures(state, fields):
+    """
+    fields: [(obs_key, id_key, daily)] for single-phase methods. Their daily plates are the
+    day-of-testing plates, so daily excursions are recorded on day 'on_'.
+    """
+    records = []
+    for obs_key, id_key, daily in fields:
+        obs = state.get(obs_key, "No Growth")
+        if obs and str(obs).strip() and str(obs).strip().lower() != "no growth":
+            records.append(FailureRecord("", daily, "on_" if daily else "", str(state.get(id_key, "") or "")))
+    return tuple(records)
@@ -0,0 +1,242 @@
+# filename: load_test.py
+"""
+Load-test harness for the module pages.
+Drives N concurrent headless sessions (Streamlit AppTest) through pages/EM.py, ScanRDI.py,
+USP71.py and Celsis.py: paste the fixture email (fixtures/), parse, click Generate (and "Proceed
+Anyway" on the empty-field warning). AppTest's script runner cannot be driven from several
+threads of one process, so every concurrency slot is a worker process that runs its sessions
+back to back; RSS growth is measured per slot from the end of its first (warm-up) session to the
+end of its last one, so use --rounds 2 or more.
+Reports throughput, p50 / p95 / p99 latency and RSS growth per module.
+Sessions run in a scratch directory (templates linked in), so the local SQLite stores are untouched.
+
+    python load_test.py --sessions 8 --rounds 3
+    python load_test.py --modules EM ScanRDI --service http://127.0.0.1:8765 --json results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(ROOT, "fixtures")
+if ROOT not in sys.path:  # the pages import the logic modules from the repo root
+    sys.path.insert(0, ROOT)
+
+# --- 1. MODULE SCENARIOS ---
+MODULES = {
+    "EM": {"page": "pages/EM.py", "fixture": "em_email.txt", "parse": "Parse & Auto-Fill", "generate": "Generate Reports"},
+    "ScanRDI": {"page": "pages/ScanRDI.py", "fixture": "scanrdi_email.txt", "parse": "Parse / Restore", "generate": "GENERATE REPORT"},
+    "USP71": {"page": "pages/USP71.py", "fixture": "usp71_email.txt", "parse": "Smart Parse", "generate": "GENERATE USP 71"},
+    "Celsis": {"page": "pages/Celsis.py", "fixture": "celsis_email.txt", "parse": "Parse / Restore", "generate": "GENERATE CELSIS"},
+}
+PROCEED = "Proceed Anyway"
+TIMEOUT = 300
+
+# --- 2. MEASUREMENT ---
+def rss_mb():
+    """Current resident set size of this process (MB); peak RSS where /proc is unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def percentile(values, pct):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))]
+
+# --- 3. SESSION DRIVER ---
+def _button(at, label):
+    for b in at.button:
+        if label in b.label:
+            return b
+    return None
+
+def run_session(module, email):
+    """One headless session; {'session': s, 'generate': s, 'errors': [...]}"""
+    from streamlit.testing.v1 import AppTest
+    spec = MODULES[module]
+    t0 = time.perf_counter()
+    # Enter through app.py like a browser session, so the multipage navigation (st.page_link) resolves
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=TIMEOUT).run()
+    at.switch_page(spec["page"]).run()
+    at.text_area[0].input(email)
+    at = _button(at, spec["parse"]).click().run()
+    t1 = time.perf_counter()
+    at = _button(at, spec["generate"]).click().run()
+    proceed = _button(at, PROCEED)
+    if proceed is not None:
+        at = proceed.click().run()
+    t2 = time.perf_counter()
+    errors = [e.message for e in at.exception] + [e.value for e in at.error]
+    return {"session": t2 - t0, "generate": t2 - t1, "errors": errors}
+
+def _session_task(module, email):
+    """Worker-process entry point: one session plus this process's RSS after it"""
+    try:
+        r = run_session(module, email)
+    except Exception as e:
+        r = {"session": None, "generate": None, "errors": [f"{type(e).__name__}: {e}"]}
+    return {**r, "pid": os.getpid(), "rss": rss_mb()}
+
+def run_module(module, sessions, rounds):
+    with open(os.path.join(FIXTURE_DIR, MODULES[module]["fixture"]), encoding="utf-8") as f:
+        email = f.read()
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=sessions) as pool:
+        results = list(pool.map(_session_task, [module] * (sessions * rounds), [email] * (sessions * rounds)))
+    wall = time.perf_counter() - t0
+    ok = [r for r in results if r["session"] is not None and not r["errors"]]
+    gen = [r["generate"] for r in ok]
+    slots = {}  # pid -> (RSS after its first session, RSS after its last one); results come back in submission order
+    for r in results:
+        slots[r["pid"]] = (slots.get(r["pid"], (r["rss"],))[0], r["rss"])
+    rss_start = sum(a for a, _ in slots.values()) / len(slots)
+    rss_end = sum(b for _, b in slots.values()) / len(slots)
+    return {
+        "module": module, "sessions": len(results), "ok": len(ok), "failed": len(results) - len(ok),
+        "throughput_per_min": round(60 * len(ok) / wall, 2) if wall else None,
+        **{f"p{p}_s": round(percentile(gen, p), 3) if gen else None for p in (50, 95, 99)},
+        "session_p50_s": round(percentile([r["session"] for r in ok], 50), 3) if ok else None,
+        "rss_start_mb": round(rss_start, 1), "rss_end_mb": round(rss_end, 1), "rss_growth_mb": round(rss_end - rss_start, 1),
+        "rss_growth_max_mb": round(max(b - a for a, b in slots.values()), 1),
+        "first_error": next((r["errors"][0] for r in results if r["errors"]), ""),
+    }
+
+# --- 4. SCRATCH WORKING DIRECTORY ---
+# Stores anchored to the repo dir rather than the working dir, and the variable that relocates each
+SCRATCH_STORES = {
+    "EM_RESULTS_DB": "em_results.db",
+    "TEMPLATE_REGISTRY_DB": "templates.db",
+    "OOS_HISTORY_DB": "oos_history.db",
+    "PROCESSING_LOG_DB": "processing_log.db",
+    "REPORT_JOBS_DB": "report_jobs.db",
+    "INVESTIGATION_STATE_DB": "investigation_state.db",
+    "TRAX_EVENTS_DB": "trax_events.db",
+}
+
+def scratch_dir():
+    """Temp dir with every template / data file of the repo linked in (SQLite stores are created fresh)"""
+    work = tempfile.mkdtemp(prefix="oos_load_")
+    for name in os.listdir(ROOT):
+        src = os.path.join(ROOT, name)
+        if os.path.isfile(src) and not name.endswith((".db", ".db-wal", ".db-shm", ".py", "_state.json")):
+            try:
+                os.symlink(src, os.path.join(work, name))
+            except OSError:
+                shutil.copy2(src, work)
+    return work
+
+@contextlib.contextmanager
+def scratch():
+    """Runs the block in a scratch_dir() with the repo-anchored stores pointed into it; removed afterwards"""
+    work = scratch_dir()
+    saved = {var: os.environ.get(var) for var in SCRATCH_STORES}
+    os.environ.update({var: os.path.join(work, name) for var, name in SCRATCH_STORES.items()})
+    os.chdir(work)
+    try:
+        yield work
+    finally:
+        os.chdir(ROOT)
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        shutil.rmtree(work, ignore_errors=True)
+
+# --- 5. REPORT CAPTURE (template_lint) ---
+def capture_reports(module):
+    """
+    Drives the module page headless with its fixture email (ScanRDI also generates Phase 2) and
+    returns [{"module", "payload", "artifacts", "errors"}] for every report_service.render() call.
+    The payloads are rendered in-process, never by a running service that may hold other code.
+    """
+    import io
+    import report_service
+    from streamlit.testing.v1 import AppTest
+    spec = MODULES[module]
+    with open(os.path.join(FIXTURE_DIR, spec["fixture"]), encoding="utf-8") as f:
+        email = f.read()
+    reports = []
+    render = report_service.render
+
+    def recording_render(mod, payload, url=None):
+        payload = report_service._normalize(payload)
+        artifacts, errors = report_service.render_job(mod, payload)
+        reports.append({"module": mod, "payload": payload, "artifacts": artifacts, "errors": errors})
+        return {k: io.BytesIO(v) for k, v in artifacts.items()}, errors
+
+    report_service.render = recording_render
+    try:
+        with scratch():
+            at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=TIMEOUT).run()
+            at.switch_page(spec["page"]).run()
+            at.text_area[0].input(email)
+            at = _button(at, spec["parse"]).click().run()
+            at = _button(at, spec["generate"]).click().run()
+            proceed = _button(at, PROCEED)
+            if proceed is not None:
+                at = proceed.click().run()
+            if module == "ScanRDI":
+                at.checkbox(key="include_phase2").check().run()
+                at = _button(at, "GENERATE PHASE 2").click().run()
+    finally:
+        report_service.render = render
+    if not reports:
+        problems = [e.message for e in at.exception] + [e.value for e in at.error]
+        raise RuntimeError(f"the page rendered no report ({problems[0].splitlines()[0] if problems else 'no error shown'})")
+    return reports
+
+# --- 6. REPORT ---
+def print_table(rows):
+    cols = ["module", "sessions", "failed", "throughput_per_min", "p50_s", "p95_s", "p99_s", "rss_growth_mb"]
+    widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in cols]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        if r["first_error"]:
+            print(f"[!] {r['module']}: {r['failed']} failed session(s), first error: {r['first_error'][:200]}")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Concurrent headless session load test for the OOS pages")
+    parser.add_argument("--modules", nargs="+", default=list(MODULES), choices=list(MODULES))
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions per module")
+    parser.add_argument("--rounds", type=int, default=2, help="sessions per concurrency slot")
+    parser.add_argument("--service", help="report_service URL to render through (default: in-process fallback)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.service:
+        os.environ["REPORT_SERVICE_URL"] = args.service
+    json_path = os.path.abspath(args.json) if args.json else None
+    rows = []
+    with scratch():
+        for module in args.modules:
+            print(f"[+] {module}: {args.sessions} concurrent sessions x {args.rounds} rounds ...")
+            rows.append(run_module(module, args.sessions, args.rounds))
+    print_table(rows)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    # Run from the importable module: AppTest swaps sys.modules["__main__"] in the workers, so tasks
+    # pickled as __main__._session_task could not be found there
+    import load_test
+    load_test.main()
@@ -0,0 +1,194 @@
+# filename: mem_profile.py
+"""
+Opt-in memory profiling for the report generation pipelines (tracemalloc).
+Set OOS_MEM_PROFILE=1 before starting Streamlit (or call enable()) and every profiled run
+(generate_em_reports, generate_p2_docs, the USP71 / Celsis report handlers) snapshots allocations
+at each stage checkpoint. Each stage records the bytes it added, the peak reached during the stage
+and its top allocation sites. Each run records the bytes still retained at its end (e.g. the
+download buffers Streamlit keeps), summed per browser session so growth across reruns is visible.
+Disabled, begin / checkpoint / end cost one flag check.
+
+tracemalloc is process-wide: runs of concurrent sessions overlap, and rendering done in the
+report_service worker pool is not traced here (stop the service to profile it in-process).
+"""
+import os
+import gc
+import time
+import fnmatch
+import threading
+import tracemalloc
+from collections import deque
+from functools import wraps
+from typing import NamedTuple
+
+# --- 1. CONFIG ---
+ENV_FLAG = "OOS_MEM_PROFILE"
+FRAMES = int(os.environ.get("OOS_MEM_PROFILE_FRAMES", "1"))  # traceback depth per allocation
+TOP_SITES = 8
+KEEP_RUNS = 200
+
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+    tracemalloc.Filter(False, "<string>"),  # generated NamedTuple __new__ (the profiler's own stage / run records)
+)
+
+_enabled = False
+_local = threading.local()
+_runs = deque(maxlen=KEEP_RUNS)
+_lock = threading.Lock()
+
+def enable(frames=FRAMES):
+    global _enabled
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    for f in _FILTERS:  # compile the filter patterns (fnmatch cache) outside any run
+        fnmatch.fnmatch("", f.filename_pattern)
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def is_enabled():
+    return _enabled
+
+# --- 2. RECORDS ---
+class StageStats(NamedTuple):
+    stage: str
+    size_diff: int      # bytes allocated and still alive at the end of the stage
+    count_diff: int
+    peak: int           # traced peak during the stage, above the level at its start
+    seconds: float
+    top: tuple          # ((site, size_diff, count_diff), ...)
+
+class RunStats(NamedTuple):
+    name: str
+    session: str
+    started: str
+    stages: tuple
+    retained: int       # traced bytes at the end of the run minus at its start (after gc, profiler's own excluded)
+
+def _session_id():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    except Exception:
+        pass
+    return "cli"
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces(_FILTERS)
+
+def _traced(snap):
+    """Bytes of a filtered snapshot: traced memory without tracemalloc's and this module's own (run records)"""
+    return sum(t.size for t in snap.traces)
+
+# --- 3. RUN / STAGE API ---
+def begin(name, session=None):
+    """Starts a profiled run on this thread (replaces a run left open by an exception)"""
+    if not _enabled:
+        return
+    session = session or _session_id()  # first call imports streamlit's runtime: keep that out of the base
+    _local.run = None  # drop the snapshot of a run left open before measuring
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    snap = _snapshot()
+    _local.run = {"name": name, "session": session, "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "base": _traced(snap), "level": current, "snap": snap, "t": time.perf_counter(), "stages": []}
+
+def checkpoint(stage):
+    """Closes the current stage of this thread's run: allocation diff against the previous checkpoint"""
+    run = getattr(_local, "run", None) if _enabled else None
+    if run is None:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    snap = _snapshot()
+    diff = snap.compare_to(run["snap"], "traceback" if FRAMES > 1 else "lineno")
+    top = tuple((" <- ".join(f"{os.path.basename(fr.filename)}:{fr.lineno}" for fr in d.traceback), d.size_diff, d.count_diff)
+                for d in diff[:TOP_SITES] if d.size_diff)
+    run["stages"].append(StageStats(stage, sum(d.size_diff for d in diff), sum(d.count_diff for d in diff),
+                                    max(0, peak - run["level"]), time.perf_counter() - run["t"], top))
+    run.update(snap=snap, level=current, t=time.perf_counter())
+    tracemalloc.reset_peak()
+
+def end():
+    """Finishes this thread's run and stores it; returns the RunStats (None when disabled)"""
+    run = getattr(_local, "run", None) if _enabled else None
+    if run is None:
+        return None
+    _local.run = None
+    run["snap"] = None  # the profiler's own snapshot is not retained by the run
+    gc.collect()
+    retained = _traced(_snapshot()) - run["base"]
+    stats = RunStats(run["name"], run["session"], run["started"], tuple(run["stages"]), retained)
+    with _lock:
+        _runs.append(stats)
+    return stats
+
+def profiled(name):
+    """Decorator: the function body is one run (stages via checkpoint(); the rest is recorded as 'finish')"""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            begin(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                checkpoint("finish")
+                end()
+        return wrapper
+    return deco
+
+# --- 4. REPORTS ---
+def runs(session=None):
+    with _lock:
+        return [r for r in _runs if session is None or r.session == session]
+
+def session_summary():
+    """{session: {"runs", "retained" (sum over runs), "last_run"}}"""
+    out = {}
+    for r in runs():
+        s = out.setdefault(r.session, {"runs": 0, "retained": 0, "last_run": ""})
+        s["runs"] += 1
+        s["retained"] += r.retained
+        s["last_run"] = f"{r.name} @ {r.started}"
+    return out
+
+def _kb(n):
+    return f"{n / 1024:,.1f} KiB"
+
+def format_run(run):
+    lines = [f"{run.name} [{run.session[:8]}] {run.started}: retained {_kb(run.retained)}"]
+    for s in run.stages:
+        lines.append(f"  {s.stage}: +{_kb(s.size_diff)} ({s.count_diff:+} blocks), peak {_kb(s.peak)}, {s.seconds:.3f}s")
+        lines.extend(f"      {_kb(size):>14}  {count:+7}  {site}" for site, size, count in s.top)
+    return "\n".join(lines)
+
+def render_panel():
+    """Streamlit expander with this session's runs and the retained bytes of every session (only when enabled)"""
+    if not _enabled:
+        return
+    import streamlit as st
+    session = _session_id()
+    with st.expander("🧠 Memory Profile (tracemalloc)"):
+        current, peak = tracemalloc.get_traced_memory()
+        st.caption(f"Traced now {_kb(current)} · peak {_kb(peak)} since the last stage · process-wide, concurrent sessions overlap")
+        st.dataframe([{"session": k[:8] + (" (this)" if k == session else ""), "runs": v["runs"],
+                       "retained KiB": round(v["retained"] / 1024, 1), "last run": v["last_run"]}
+                      for k, v in session_summary().items()], hide_index=True)
+        for run in reversed(runs(session)[-5:]):
+            st.code(format_run(run), language=None)
+
+if os.environ.get(ENV_FLAG, "").strip().lower() in ("1", "true", "yes", "on"):
+    enable()
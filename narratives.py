@@ -0,0 +1,263 @@
+# filename: narratives.py
+"""
+Locked "RS Reviewed" narrative library.
+Every paragraph below is a Jinja template compiled once per process and rendered from a plain
+fact dict (or any object with attributes), so a report is a dict build plus a compiled-template
+call and many cases can be rendered in one batch. The wording is byte-identical to the f-strings
+it replaced: do not edit a template without RS review.
+"""
+from functools import lru_cache
+
+from jinja2 import DictLoader, Environment, StrictUndefined
+
+# --- 1. TEMPLATE SOURCES ---
+TEMPLATES = {}
+
+# EM module (em_logic.generate_em_narrative): Field 49 / 50 / 51
+TEMPLATES["em_interview"] = (
+    "The analyst involved in the {{ sampling_lower }} plate setup, {{ analyst_name }} ({{ analyst_init }}), and the analysts involved in "
+    "reading the plate, {{ reader_name }}, were interviewed comprehensively. Their responses are documented throughout this investigation.\n\n"
+    "The EM plates were stored in accordance with the supplier's recommendations, visually inspected before use, and verified to be within their assigned expiration dates. "
+    "All materials and supplies were disinfected in accordance with MICRO-SOP-9, Cleaning and Disinfecting Procedure for Microbiology. "
+    "The functionality of the incubators was verified through review of data generated by the in-house continuous monitoring system.\n\n"
+    "{% if is_weekly %}"
+    "{{ sampling_type }} was performed by {{ analyst_name }} during weekly environmental monitoring in Cleanroom Suite {{ room_num }} on the date of testing ({{ d_start_full }}), "
+    "{% else %}"
+    "{{ sampling_type }} was performed by {{ analyst_name }} in ISO 5 {{ bsc_e_id }} located in room {{ room_num }} in suite {{ cr_suite }} on the date of testing ({{ d_start_full }}), "
+    "{% endif %}"
+    "in accordance with MICRO-SOP-2, Environmental Monitoring of the Cleanroom Facility.\n\n"
+    "The plates were initially incubated at a temperature of 30-35°C in incubator E001031 for a minimum duration of 48 hours, commencing on {{ d_start_full }}. "
+    "Following completion of the minimum 48 hours of incubation on {{ d_48h_full }}, no microbial growth was observed. The plates were subsequently "
+    "incubated for a minimum of 5 days at 20-25°C in incubator E001034, with incubation ending on {{ d_5d_full }}. At completion of the second incubation period, "
+    "{% if is_artifact %}"
+    "one colony-like artifact was observed on {{ plate_loc or 'Surface Plate #1' }}"
+    "{% else %}"
+    "{{ cfu_count }} colony forming unit (CFU) was observed on {{ plate_loc or sampling_type }}"
+    "{% endif %}"
+    ". The plate was read by {{ reader_1 }} after the initial incubation period and by {{ reader_2 }} after the second incubation period. "
+    "Please see Table 1 for detailed information on the observations during the respective incubations.\n\n"
+    "{% if is_artifact %}"
+    "The observed artifact was submitted for microbial identification under {{ event_id }}. "
+    "However, following transfer or inoculation onto fresh media, no growth was observed. "
+    "Therefore, the observed artifact could not be confirmed as a viable microbial colony or reported as a confirmed colony forming unit (CFU). "
+    "The lack of growth upon subculture indicates that the observation may have been nonviable material, an artifact associated with agar preparation or pouring, or another non-microbial artifact."
+    "{% else %}"
+    "Based on the observations in Table 1, the {{ sampling_lower }} plate recovery was submitted for microbial identification under {{ event_id }}. "
+    "The recovered microorganism was identified as {{ org_identified }}."
+    "{% endif %}"
+    "\n\n"
+    "To determine whether the {{ 'recovery' if is_weekly or is_artifact else 'organism identified was transient or recurring' }} was transient or recurring, "
+    "personnel-monitoring plates for {{ analyst_name }} and {{ ('Cleanroom Suite ' ~ room_num) if is_weekly else ('ISO 5 ' ~ bsc_e_id) }} "
+    "environmental-monitoring plates were bracketed to include the date before testing ({{ before_d_full }}), the date of testing ({{ d_start_full }}), and the date after testing ({{ after_d_full }}), as detailed in Table 2."
+)
+
+_EM_MONTHLY_CLEANING = (
+    "Monthly cleaning and disinfection of the cleanroom suite, including the ISO 8 anteroom ({{ suite_num }}), ISO 7 buffer room ({{ suite_num }}A), ISO 7 cleanroom ({{ suite_num }}B), "
+    "and the ISO 5 biosafety cabinets located within Room {{ suite_num }}B, were performed on {{ monthly_cleaning_date }} by Analyst - {{ cleaner_name }} - in accordance with MICRO-SOP-9, "
+    "Cleaning and Disinfecting Procedure for Microbiology. All H2O2 indicators passed, confirming the successful completion and effectiveness of the monthly cleaning and disinfection activities "
+    "within Rooms {{ suite_num }}, {{ suite_num }}A, and {{ suite_num }}B. Additionally, routine cleaning and disinfection were performed before and after the testing activity in accordance with MICRO-SOP-9.\n\n"
+)
+
+TEMPLATES["em_records"] = (
+    "Environmental Monitoring Summary:\n"
+    "{% if is_weekly %}"
+    "Weekly surface and active air sampling for {{ cr_suite }} for the previous week and following week of testing showed no microbial growth.\n\n"
+    "However, the {{ sampling_type }} for {{ cr_suite }} for the week of testing, performed on {{ d_start_full }} by analyst {{ analyst_init }}, exhibited {{ cfu_count }} CFUs on {{ plate_name }}, "
+    "which were identified as {{ org_identified }}. Routine monitoring on the date of testing showed no growth across other monitored locations.\n\n"
+    "During the interview with the analyst, they indicated that no obvious abnormalities or deviations in the testing procedure were observed. "
+    "All materials were disinfected prior to testing. Moreover, the cleanroom suites in {{ cr_suite }} were thoroughly cleaned and prepared before initiating testing as per MICRO-SOP-2 and MICRO-SOP-9.\n\n"
+    + _EM_MONTHLY_CLEANING +
+    "It is important to note that no samples processed within that week in {{ cr_suite }} failed {{ test_method }} testing that week.\n\n"
+    "Based on the available evidence, the recovery of {{ cfu_count }} CFU of {{ org_identified }} from {{ plate_name }} in {{ room_num }} on the date of testing ({{ d_start_full }}) appears to be an isolated event. "
+    "This assessment is supported by the absence of microbial recovery from surrounding monitored areas and negative routine monitoring results throughout the bracketing period.\n\n"
+    "The negative settling, personnel, and bracketing surface monitoring results demonstrate that the critical environment remained in a state of control. "
+    "The available data do not support migration, persistence, or recurrence of contamination within {{ cr_suite }}. Collectively, the evidence supports that the recovery was an isolated, "
+    "transient, and non-recurring event, while established cleaning, disinfection, and aseptic controls remained effective."
+    "{% else %}"
+    "Personnel monitoring plates for {{ analyst_name }}, including left- and right-touch plates, showed no microbial growth on the date before testing ({{ before_d_full }}), "
+    "the date of testing ({{ d_start_full }}), and the date after testing ({{ after_d_full }}).\n\n"
+    "For ISO 5 {{ bsc_e_id }}, daily surface sampling of four locations showed no microbial growth on the date before testing ({{ before_d_full }}). "
+    "On the date of testing ({{ d_start_full }}), {{ cfu_count }} CFU was recovered from {{ plate_loc or 'Surface #1' }} associated with {{ analyst_name }}. "
+    "The recovery was documented under {{ event_id }}; microbial identification indicated {{ org_identified }}. Surface sampling performed on the date after testing ({{ after_d_full }}) showed no microbial growth.\n\n"
+    "Settling sampling of ISO 5 {{ bsc_e_id }}, including two locations, showed no microbial growth on the date before testing ({{ before_d_full }}), "
+    "the date of testing ({{ d_start_full }}), and the date after testing ({{ after_d_full }}).\n\n"
+    "Weekly active-air monitoring of Suite {{ suite_num }} conducted during the week before testing and the week of testing showed no microbial growth.\n\n"
+    "Weekly surface monitoring of the anteroom and cleanroom areas associated with Suite {{ suite_num }} showed no microbial growth during the week before testing or the week of testing.\n\n"
+    "During the interview, the analyst indicated that no obvious abnormalities or deviations occurred during the testing process. All materials were disinfected before testing, "
+    "and the relevant cleanroom and ISO 5 BSC were cleaned and prepared before testing in accordance with MICRO-SOP-2 and MICRO-SOP-9.\n\n"
+    + _EM_MONTHLY_CLEANING +
+    "It is also important to note that no samples processed by {{ analyst_name }} in ISO 5 {{ bsc_e_id }} on the date of testing ({{ d_start }}) failed {{ test_method }} testing.\n\n"
+    "{% if is_artifact %}"
+    "Based on the available evidence, one colony-like artifact was observed on {{ plate_name }} in ISO 5 {{ bsc_e_id }} on the date of testing ({{ d_start_full }}). "
+    "However, the observation could not be confirmed as a viable microbial CFU because no growth was obtained following inoculation onto fresh media. "
+    "Therefore, the observation may represent a nonviable or non-microbial artifact, including a potential artifact associated with agar preparation or the agar-pouring process.\n\n"
+    "If the observed artifact had represented a viable CFU, it would appear to be an isolated event. This assessment is supported by the absence of microbial recovery from "
+    "{{ analyst_name }}'s personnel-monitoring plates on the date before testing ({{ before_d_full }}), the date of testing ({{ d_start_full }}), and the date after testing ({{ after_d_full }}); "
+    "the absence of growth from {{ bsc_e_id }} surface samples collected on the date before testing and the date after testing; and the absence of growth from ISO 5 settling plates throughout the bracketing period."
+    "{% else %}"
+    "Based on the available evidence, the recovery of {{ cfu_count }} CFU of {{ org_identified }} from {{ plate_name }} in ISO 5 {{ bsc_e_id }} on the date of testing ({{ d_start_full }}) appears to be an isolated event. "
+    "This assessment is supported by the absence of microbial recovery from {{ analyst_name }}'s personnel-monitoring plates on the date before testing ({{ before_d_full }}) and the date of testing ({{ d_start_full }}); "
+    "the absence of growth from {{ bsc_e_id }} surface samples collected on the date before testing and the subsequent available monitoring date after testing ({{ after_d_full }}); "
+    "and the absence of growth from ISO 5 settling plates throughout the bracketing period."
+    "{% endif %}"
+    "\n\n"
+    "The negative ISO 5 settling, personnel, and bracketing surface monitoring results demonstrate that the {{ bsc_e_id }} critical environment remained in a state of control. "
+    "The available data do not support migration, persistence, or recurrence of contamination within ISO 5 {{ bsc_e_id }}. Collectively, the evidence supports that the recovery was an isolated, "
+    "transient, and non-recurring event, while established cleaning, disinfection, and aseptic controls remained effective."
+    "{% endif %}"
+)
+
+TEMPLATES["em_summary"] = (
+    "Accordingly, no systemic environmental control deficiencies were identified, and no additional corrective or preventive actions "
+    "are warranted at this time beyond continued routine environmental monitoring and adherence to approved cleaning, disinfection, and aseptic procedures."
+)
+
+# Celsis (celsis_logic.generate_celsis_narrative_and_details): one block per phase
+# daily_fails / weekly_fails: [{"timing", "obs", "cat", "etx", "id"}]
+TEMPLATES["celsis_em_phase"] = (
+    "Environmental Monitoring from Celsis Sterility {{ phase_title|capitalize }}: "
+    "{% if not daily_fails %}"
+    "After reviewing the Environmental Monitoring results for the relevant testing dates, no microbial growth was detected on the personnel monitoring plates (analyst {{ analyst_init }}) "
+    "or on the ISO 5 BSC (E00{{ bsc_id }}) settling and surface plates for the date of testing, the preceding date, or the subsequent date."
+    "{% else %}"
+    "After reviewing the Environmental Monitoring results for the relevant testing dates, microbial growth was detected during daily sampling."
+    "{% for f in daily_fails %}"
+    " Specifically, on {{ f.timing }}, {{ f.obs }} was detected on {{ f.cat }}. The organism was submitted under ID {{ f.etx }} and identified as {{ f.id }}."
+    "{% endfor %}"
+    "{% endif %}"
+    "\n\n"
+    "{% if not weekly_fails %}"
+    "No growth was observed on weekly surface and active air sampling plates for either the week prior to testing or the week of testing."
+    "{% else %}"
+    "However, microbial growth was observed during weekly sampling."
+    "{% for f in weekly_fails %}"
+    " During {{ f.timing }}, {{ f.obs }} was detected on weekly {{ f.cat }} plates. The organism was submitted under ID {{ f.etx }} and identified as {{ f.id }}."
+    "{% endfor %}"
+    "{% endif %}"
+)
+
+# ScanRDI (scan_logic / pages/ScanRDI.py generate_narrative_and_details)
+# pass_daily / pass_weekly: clean categories; failures: [{"cat", "obs", "etx", "id", "time", "plural", "gram"}]
+TEMPLATES["scan_em_narrative"] = (
+    "Upon analyzing the environmental monitoring results, "
+    "{% if pass_daily %}"
+    "no microbial growth was observed in {{ pass_daily|join_and(oxford=True) }}"
+    "{% if pass_weekly %}. Additionally, {{ pass_weekly|join_and }} showed no microbial growth{% endif %}."
+    "{% elif pass_weekly %}"
+    "no microbial growth was observed in {{ pass_weekly|join_and }}."
+    "{% else %}"
+    "microbial growth was observed in all sampled areas."
+    "{% endif %}"
+)
+
+TEMPLATES["scan_em_details"] = (
+    "{% if failures %}"
+    "{% set daily = failures|selectattr('time', 'equalto', 'daily')|map(attribute='cat')|list %}"
+    "{% set weekly = failures|selectattr('time', 'equalto', 'weekly')|map(attribute='cat')|list %}"
+    "However, microbial growth was observed during "
+    "{% if daily %}{{ daily|join(' and ') }} on the date{% if weekly %} and {% endif %}{% endif %}"
+    "{% if weekly %}{{ weekly|join(' and ') }} from week of testing{% endif %}. "
+    "{% for f in failures %}"
+    "{% if not loop.first %} {% endif %}"
+    "{{ ['Specifically', 'Additionally', 'Furthermore'][loop.index0] if loop.index0 < 3 else 'Also' }}, "
+    "{{ f.obs }} {{ 'were' if f.plural else 'was' }} detected during {{ f.cat }} and was submitted for "
+    "{{ 'differential staining' if f.gram else 'microbial identification' }} under sample ID {{ f.etx }}, "
+    "where the {{ 'organisms were' if f.plural else 'organism was' }} identified as {{ f.id }}."
+    "{% endfor %}"
+    "{% endif %}"
+)
+
+# ScanRDI Phase I Part 1 (pages/ScanRDI.py p1-p6); `equipment` is the rendered equipment paragraph
+TEMPLATES["scan_phase1_part1"] = (
+    "All analysts involved in the prepping, processing, and reading of the samples – {{ names_only_phrase }} – were interviewed and their answers are recorded throughout this document."
+    "\n\n"
+    "The sample was stored upon arrival according to the Client’s instructions. {{ prep_proc_noun }} {{ prep_proc_phrase }} confirmed the integrity of the samples throughout both the preparation and processing stages. "
+    "No leaks or turbidity were observed at any point, verifying the integrity of the sample."
+    "\n\n"
+    "All reagents and supplies mentioned in the material section above were stored according to the suppliers’ recommendations, and their integrity was visually verified before utilization. "
+    "Moreover, each reagent and supply had valid expiration dates."
+    "\n\n"
+    "During the preparation phase, {{ prepper_name }} disinfected the samples using acidified bleach and placed them into a pre-disinfected storage bin. "
+    "On {{ test_date }}, prior to sample processing, {{ analyst_name }} performed a second disinfection with acidified bleach, allowing a minimum contact time of 10 minutes before transferring the samples into the cleanroom suites. "
+    "A final disinfection step was completed immediately before the samples were introduced into the ISO 5 Biological Safety Cabinet (BSC), E00{{ bsc_id }}, located within the {{ t_loc }}, (Suite {{ t_suite }}{{ t_suffix }}), "
+    "All activities were performed in accordance with SOP 2.600.023, Rapid Scan RDI® Test Using FIFU Method."
+    "\n\n"
+    "{{ equipment }}"
+    "\n\n"
+    "The analyst, {{ reader_name }}, confirmed that the equipment was set up as per SOP 2.700.004 (Scan RDI® System – Operations (Standard C3 Quality Check and Microscope Setup and Maintenance), "
+    "and the negative control and the positive control for the analyst, {{ reader_name }}, yielded expected results."
+)
+
+# USP <71> (usp71_logic.generate_usp71_narrative_and_details); same facts as scan_em_*
+TEMPLATES["usp71_em_narrative"] = (
+    "Upon analyzing the environmental monitoring results, "
+    "{% if pass_daily %}"
+    "no microbial growth was observed in {{ pass_daily|join_and(oxford=True) }} during the processing and testing steps"
+    "{% if pass_weekly %}. Additionally, {{ pass_weekly|join_and }} showed no microbial growth{% endif %}."
+    "{% elif pass_weekly %}"
+    "no microbial growth was observed in {{ pass_weekly|join_and }}."
+    "{% else %}"
+    "microbial growth was observed in all sampled areas."
+    "{% endif %}"
+)
+
+TEMPLATES["usp71_em_details"] = (
+    "{% if failures %}"
+    "{% set daily = failures|selectattr('time', 'equalto', 'daily')|map(attribute='cat')|list %}"
+    "{% set weekly = failures|selectattr('time', 'equalto', 'weekly')|map(attribute='cat')|list %}"
+    "However, microbial growth was observed during "
+    "{% if daily %}{{ daily|join(' and ') }} during the processing and testing steps{% if weekly %} and {% endif %}{% endif %}"
+    "{% if weekly %}{{ weekly|join(' and ') }}{% endif %}. "
+    "{% for f in failures %}"
+    "{% if not loop.first %} {% endif %}"
+    "{{ 'Specifically' if loop.first else 'Additionally' }}, "
+    "{{ f.obs }} {{ 'were' if f.plural else 'was' }} detected during {{ f.cat }} and {{ 'were' if f.plural else 'was' }} submitted for microbial identification "
+    "under sample ID {{ f.etx }}, where the {{ 'organisms were' if f.plural else 'organism was' }} identified as {{ f.id }}."
+    "{% endfor %}"
+    "{% endif %}"
+)
+
+# --- 2. COMPILED ENVIRONMENT ---
+def join_and(items, oxford=False):
+    """a / a and b / a, b and c (a, b, and c with oxford=True)"""
+    items = [str(i) for i in items]
+    if len(items) < 2:
+        return "".join(items)
+    if len(items) == 2:
+        return f"{items[0]} and {items[1]}"
+    return ", ".join(items[:-1]) + (", and " if oxford else " and ") + items[-1]
+
+_ENV = Environment(loader=DictLoader(TEMPLATES), autoescape=False, keep_trailing_newline=True,
+                   undefined=StrictUndefined, cache_size=0)
+_ENV.filters["join_and"] = join_and
+
+@lru_cache(maxsize=None)
+def get_template(name):
+    """Compiles a narrative template on first use; later calls reuse the compiled object"""
+    return _ENV.get_template(name)
+
+def precompile():
+    """Compiles every template up front (e.g. before a batch run); returns the template names"""
+    for name in TEMPLATES:
+        get_template(name)
+    return list(TEMPLATES)
+
+# --- 3. RENDERING ---
+def _facts(facts):
+    if isinstance(facts, dict):
+        return facts
+    return dict(facts) if hasattr(facts, "keys") else vars(facts)
+
+def render(name, facts):
+    """Renders one locked narrative from a fact dict / object"""
+    return get_template(name).render(_facts(facts))
+
+def render_batch(name, facts_list):
+    """Renders the same narrative for many cases (one compiled template, one call per case)"""
+    tpl = get_template(name)
+    return [tpl.render(_facts(f)) for f in facts_list]
+
+def render_all(names, facts):
+    """Renders several narratives from one fact set (e.g. EM Field 49 / 50 / 51); returns a tuple"""
+    facts = _facts(facts)
+    return tuple(get_template(n).render(facts) for n in names)
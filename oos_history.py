@@ -0,0 +1,152 @@
+# filename: oos_history.py
+"""
+Local OOS case index (SQLite).
+One row per OOS case (client, analyte, test method, date, OOS ID) with a composite index,
+so the 6-month sample history sentence comes from a single range query when a case is opened.
+"""
+import os
+import re
+import sqlite3
+import calendar
+from datetime import date
+
+from em_store import parse_date, read_spreadsheet
+
+# --- 1. CONFIG & SCHEMA ---
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oos_history.db")
+DB_ENV = "OOS_HISTORY_DB"  # overrides DB_FILE (load_test / golden scratch runs)
+HISTORY_MONTHS = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS oos_cases (
+    oos_id      TEXT PRIMARY KEY,
+    client      TEXT NOT NULL,          -- normalized (lower-case, single spaces)
+    analyte     TEXT NOT NULL,          -- normalized sample name
+    test_method TEXT NOT NULL,          -- Celsis / USP71 / ScanRDI / EM
+    case_date   TEXT NOT NULL           -- ISO YYYY-MM-DD
+);
+CREATE INDEX IF NOT EXISTS ix_oos_history ON oos_cases (client, analyte, test_method, case_date);
+"""
+
+# Spreadsheet header aliases -> column
+COLUMN_ALIASES = {
+    "oos_id": ["oos", "oos id", "oos number", "oos #"],
+    "client": ["client", "client name", "customer"],
+    "analyte": ["analyte", "sample name", "product", "sample"],
+    "test_method": ["test method", "method", "test"],
+    "case_date": ["date", "test date", "date of incident", "date initiated"],
+}
+
+def db_file():
+    """The OOS case index path: $OOS_HISTORY_DB if set, else DB_FILE next to this module"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    """Opens (and creates if needed) the OOS case index"""
+    conn = sqlite3.connect(db_path or db_file())
+    conn.executescript(SCHEMA)
+    return conn
+
+# --- 2. NORMALIZATION ---
+def normalize_text(text):
+    """Case/space-insensitive key; bracketed annotations such as [Lot 2] are ignored"""
+    t = re.sub(r"\[[^\]]+\]", "", str(text or ""))
+    return re.sub(r"\s+", " ", t).strip().lower()
+
+def normalize_method(text):
+    t = str(text or "").lower().replace(" ", "")
+    if "celsis" in t:
+        return "Celsis"
+    if "71" in t or "ep2.6.1" in t:
+        return "USP71"
+    if "scan" in t:
+        return "ScanRDI"
+    if t.startswith("em") or "environmental" in t:
+        return "EM"
+    return str(text or "").strip()
+
+def normalize_oos_id(text):
+    m = re.search(r"(\d+)", str(text or ""))
+    return f"OOS-{m.group(1)}" if m else ""
+
+def months_back(d, months):
+    """Same day `months` calendar months earlier (clamped to month end)"""
+    y, m = divmod(d.year * 12 + d.month - 1 - months, 12)
+    return date(y, m + 1, min(d.day, calendar.monthrange(y, m + 1)[1]))
+
+# --- 3. WRITE ---
+def record_case(oos_id, client, analyte, test_method, case_date, db_path=None):
+    """Adds or updates one OOS case in the index (called when a report is generated)"""
+    d = parse_date(case_date)
+    oid = normalize_oos_id(oos_id)
+    if not d or not oid or not client or not analyte:
+        return False
+    conn = connect(db_path)
+    try:
+        conn.execute("INSERT OR REPLACE INTO oos_cases VALUES (?, ?, ?, ?, ?)",
+                     (oid, normalize_text(client), normalize_text(analyte), normalize_method(test_method), d.isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def import_cases(path, default_method="", db_path=None):
+    """Loads an exported OOS log (CSV / XLSX) into the index; returns the number of cases imported"""
+    records = []
+    for raw in read_spreadsheet(path):
+        lowered = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+        rec = {col: next((lowered[a] for a in aliases if lowered.get(a) not in (None, "")), "")
+               for col, aliases in COLUMN_ALIASES.items()}
+        d, oid = parse_date(rec["case_date"]), normalize_oos_id(rec["oos_id"])
+        if d and oid and rec["client"] and rec["analyte"]:
+            records.append((oid, normalize_text(rec["client"]), normalize_text(rec["analyte"]),
+                            normalize_method(rec["test_method"] or default_method), d.isoformat()))
+    conn = connect(db_path)
+    try:
+        conn.executemany("INSERT OR REPLACE INTO oos_cases VALUES (?, ?, ?, ?, ?)", records)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(records)
+
+# --- 4. READ ---
+def prior_failures(client, analyte, test_method, case_date, exclude_oos="", months=HISTORY_MONTHS, db_path=None):
+    """OOS IDs for the same client/analyte/method within `months` before case_date (oldest first)"""
+    d = parse_date(case_date)
+    if not d or not client or not analyte:
+        return []
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT oos_id FROM oos_cases WHERE client = ? AND analyte = ? AND test_method = ? "
+            "AND case_date >= ? AND case_date < ? AND oos_id != ? ORDER BY case_date",
+            (normalize_text(client), normalize_text(analyte), normalize_method(test_method),
+             months_back(d, months).isoformat(), d.isoformat(), normalize_oos_id(exclude_oos))).fetchall()
+    finally:
+        conn.close()
+    return [r[0] for r in rows]
+
+def history_fields(client, analyte, test_method, case_date, exclude_oos="", db_path=None):
+    """session_state values for the Sample History section (has_prior_failures / incidence_count / prior_oos_i)"""
+    pids = prior_failures(client, analyte, test_method, case_date, exclude_oos, db_path=db_path)
+    pids = pids[-10:]  # the Sample History section holds at most 10 references
+    fields = {"has_prior_failures": "Yes" if pids else "No", "incidence_count": max(len(pids), 1)}
+    for i, pid in enumerate(pids):
+        fields[f"prior_oos_{i}"] = pid
+    return fields
+
+def auto_fill_history(state, test_method, db_path=None):
+    """
+    Runs the history lookup once per opened case (client + sample + test date) and
+    fills the Sample History fields when the index has prior failures.
+    """
+    signature = (state.get("client_name", ""), state.get("sample_name", ""), state.get("test_date", ""))
+    if not all(signature) or state.get("_history_lookup") == list(signature):
+        return False
+    state["_history_lookup"] = list(signature)
+    fields = history_fields(signature[0], signature[1], test_method, signature[2], state.get("oos_id", ""), db_path=db_path)
+    if fields["has_prior_failures"] == "No":
+        return False
+    for k, v in fields.items():
+        state[k] = v
+    return True
@@ -51,24 +51,31 @@ def ensure_dependencies():
             time.sleep(1); st.rerun()
         except Exception as e: placeholder.error(f"Install failed: {e}")
 
-# --- 3. FILE PERSISTENCE & KEYS ---
-STATE_FILE = "celsis_investigation_state.json"
+# --- 3. STATE PERSISTENCE & KEYS ---
+import state_store
+import report_service
+import report_jobs
+import mem_profile
+STATE_MODULE = "Celsis"
 field_keys = cl.FIELD_KEYS if hasattr(cl, 'FIELD_KEYS') else []
 if "process_date" not in field_keys: field_keys.append("process_date")
 
 def load_saved_state():
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f: saved_data = json.load(f)
-            for key, value in saved_data.items():
-                if key in st.session_state: st.session_state[key] = value
-        except: pass
+    try: state_store.load_session(st.session_state, STATE_MODULE, field_keys)
+    except: pass
 
-def save_current_state():
-    try:
-        data = {k: v for k, v in st.session_state.items() if k in field_keys}
-        with open(STATE_FILE, "w") as f: json.dump(data, f)
+def save_current_state(label="Smart Parse / Restore"):
+    try: state_store.save_session(st.session_state, STATE_MODULE, field_keys)
     except: pass
+    state_store.snapshot_page(STATE_MODULE, field_keys, label)
+
+def confirm_report():
+    """Generate / "Proceed Anyway": everything done once per click (the report block reruns on every interaction)"""
+    st.session_state.report_generated = True
+    st.session_state.submission_warnings = []
+    oos_history.record_case(st.session_state.oos_id, st.session_state.client_name, st.session_state.sample_name, "Celsis", st.session_state.test_date)
+    state_store.snapshot_page(STATE_MODULE, field_keys, "Report generated")
+    st.session_state.report_submit = True  # one background job per Generate, not per rerun
 
 def clean_filename(text): 
     return re.sub(r'[\\/*?:"<>|]', '_', str(text)).strip() if text else ""
@@ -172,6 +179,7 @@ st.title("🧪 Celsis OOS Investigation")
 st.header("📧 Smart Email Import / 💾 Restore")
 email_input = st.text_area("Paste Celsis Email Content OR Save File here:", height=150)
 if st.button("🪄 Parse / Restore"): parse_email_text(email_input); st.success("Updated!"); st.rerun()
+state_store.render_version_panel(STATE_MODULE, field_keys)
 
 st.header("1. General Test Details")
 c1, c2, c3, c4 = st.columns(4)
@@ -289,6 +297,13 @@ for i in range(st.session_state.pos_bottle_count):
         st.text_input(f"Bottle #{i+1} Organism", key=f"pos_org_{i}", help="Pending or actual bug name")
 
 st.header("4. EM Observations")
+if st.button("🗄️ Auto-Fill EM Bracketing from Results Store"):
+    import em_store
+    pro = em_store.query_bracket(st.session_state.process_date, st.session_state.bsc_id, st.session_state.get("analyst_initial", ""))
+    alq = em_store.query_bracket(st.session_state.test_date, "1798", st.session_state.get("aliquoting_initial", ""))
+    st.session_state.update(em_store.celsis_bracket_fields(pro, "pro_"))
+    st.session_state.update(em_store.celsis_bracket_fields(alq, "alq_"))
+    st.success("✅ Processing & aliquoting EM bracketing filled from the results store.")
 st.radio("Microbial Growth Observed?", ["No","Yes"], key="em_growth_observed", horizontal=True)
 
 if st.session_state.em_growth_observed == "Yes":
@@ -316,21 +331,27 @@ if st.session_state.em_growth_observed == "Yes":
 
 st.header("5. Investigation Details")
 st.subheader("Sample History")
+import oos_history
+oos_history.auto_fill_history(st.session_state, "Celsis")
 st.radio("Prior failures in last 6 months?", ["No", "Yes"], key="has_prior_failures", horizontal=True)
 if st.session_state.has_prior_failures == "Yes":
     count = st.number_input("Number of Prior Failures", 1, 10, key="incidence_count")
     for i in range(count): st.text_input(f"Prior Failure #{i+1} OOS ID", key=f"prior_oos_{i}")
 
 st.subheader("Cross Contamination")
+import processing_log
+cross_conflicts = processing_log.auto_fill_cross_contam(st.session_state, st.session_state.get("process_date", ""))
+for msg in processing_log.conflict_messages(cross_conflicts):
+    st.warning(f"⚠️ {msg}")
 st.radio("Other samples tested positive same day?", ["No", "Yes"], key="other_positives", horizontal=True)
 if st.session_state.other_positives == "Yes":
     st.number_input("Total Positive Samples that day", 2, 20, key="total_pos_count_num")
-    st.number_input(f"Order of THIS Sample ({st.session_state.sample_id})", 1, 20, key="current_pos_order")
+    st.number_input(f"Order of THIS Sample ({st.session_state.sample_id})", 1, 99, key="current_pos_order")
     num_others = st.session_state.total_pos_count_num - 1
     for i in range(num_others):
         col1, col2 = st.columns(2)
         with col1: st.text_input(f"Other Sample #{i+1} ID", key=f"other_id_{i}")
-        with col2: st.number_input(f"Other Sample #{i+1} Order", 1, 20, key=f"other_order_{i}")
+        with col2: st.number_input(f"Other Sample #{i+1} Order", 1, 99, key=f"other_order_{i}")
 
 def create_table_pdf(data):
     from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
@@ -432,10 +453,12 @@ def create_table_pdf(data):
     buffer.seek(0)
     return buffer
 
-save_current_state()
+state_store.autosave_page(STATE_MODULE, field_keys)
 st.divider()
 
 # --- 7. GENERATION & VALIDATION ---
+st.checkbox("⏳ Build reports in background", key="report_background",
+            help="Queue the Word / PDF rendering as a background job and keep editing; downloads appear under Background Reports.")
 if st.button("🚀 GENERATE CELSIS REPORT", type="primary"):
     ensure_dependencies()
     errors, warnings = cl.validate_inputs()
@@ -445,18 +468,18 @@ if st.button("🚀 GENERATE CELSIS REPORT", type="primary"):
         st.session_state.submission_warnings = warnings
         st.rerun() 
     else:
-        st.session_state.report_generated = True
-        st.session_state.submission_warnings = [] 
+        confirm_report()
 
 if st.session_state.submission_warnings:
     st.warning(f"⚠️ The following fields are empty: {', '.join(st.session_state.submission_warnings)}")
     col_yes, col_no = st.columns([1, 5])
     if col_yes.button("✅ Yes, Proceed Anyway"):
-        st.session_state.report_generated = True; st.session_state.submission_warnings = []; st.rerun()
+        confirm_report(); st.rerun()
     if col_no.button("❌ No, Let me Fix"):
         st.session_state.submission_warnings = []; st.rerun()
 
 if st.session_state.report_generated:
+    mem_profile.begin("Celsis report handler")
     with st.spinner("Compiling Celsis logic..."):
         
         pos_media_list = [st.session_state.get(f"pos_media_{i}", "") for i in range(st.session_state.pos_bottle_count)]
@@ -486,7 +509,11 @@ if st.session_state.report_generated:
         st.session_state.positive_org = join_unique(pos_org_list)
 
         fresh_equip = cl.generate_celsis_equipment_text()
-        fresh_narr, fresh_det = cl.generate_celsis_narrative_and_details()
+        # Processing + aliquoting EM narratives (the Smart Justification gets its own paragraph). narrative_summary
+        # goes into the Word template, which takes real newlines like report_header; the literal "\\n\\n" joins
+        # further down only build the PDF field strings (smart_phase1_part1/2)
+        fresh_pro, fresh_alq, _ = cl.generate_celsis_narrative_and_details()
+        fresh_narr = "\n\n".join(n for n in (fresh_pro, fresh_alq) if n)
         fresh_history = cl.generate_celsis_history_text()
         fresh_cross = cl.generate_celsis_cross_contam_text()
         
@@ -640,7 +667,7 @@ if st.session_state.report_generated:
             'Text Field57': st.session_state.oos_id, 'Date Field0': pdf_date_str, 'Date Field1': pdf_date_str, 
             'Date Field2': pdf_date_str, 'Date Field3': pdf_date_str,
             'Text Field2': st.session_state.sample_id, 'Text Field6': st.session_state.lot_number, 
-            'Text Field4': st.session_state.sample_name + "\n\n\n\n", 'Text Field5': st.session_state.dosage_form, 
+            'Text Field4': st.session_state.sample_name, 'Text Field5': st.session_state.dosage_form, 
             'Text Field0': analyst_sig_text, 'Text Field3': smart_personnel_block, 'Text Field7': smart_incident_opening + "\n\n",
             'Text Field13': word_data["smart_comment_interview"], 'Text Field14': word_data["smart_comment_samples"], 
             'Text Field17': word_data["smart_comment_records"], 'Text Field21': word_data["smart_comment_storage"],
@@ -701,42 +728,34 @@ if st.session_state.report_generated:
         table_data["positive_media"] = st.session_state.get("positive_media", "N/A")
         table_data["positive_org"] = st.session_state.get("positive_org", "N/A")
 
-        # --- 1. RENDER MAIN DOCX ---
-        target_template = "Celsis OOS P1 template 0.docx"
-        if not os.path.exists(target_template): target_template = "Celsis OOS P1 template.docx"
-        if os.path.exists(target_template):
-            try:
-                from docxtpl import DocxTemplate
-                doc = DocxTemplate(target_template)
-                doc.render(word_data); docx_buf = io.BytesIO(); doc.save(docx_buf); docx_buf.seek(0)
-            except Exception as e: st.error(f"DOCX Error: {e}")
-        else: st.warning("⚠️ Could not find either 'Celsis OOS P1 template 0.docx' or 'Celsis OOS P1 template.docx'.")
-
-        # --- 2. RENDER TABLES DOCX ---
-        target_tables_template = "tables for celsis.docx"
-        if os.path.exists(target_tables_template):
-            try:
-                from docxtpl import DocxTemplate
-                doc_tbl = DocxTemplate(target_tables_template)
-                doc_tbl.render(table_data); tables_docx_buf = io.BytesIO(); doc_tbl.save(tables_docx_buf); tables_docx_buf.seek(0)
-            except Exception as e: st.error(f"Tables DOCX Error: {e}")
-        else: st.warning(f"⚠️ Could not find {target_tables_template}.")
-            
-        # --- 3. RENDER MAIN PDF ---
-        if os.path.exists("Celsis OOS P1 template.pdf"):
-            try:
-                from pypdf import PdfWriter
-                writer = PdfWriter(clone_from="Celsis OOS P1 template.pdf") 
-                for p in writer.pages: writer.update_page_form_field_values(p, pdf_map)
-                pdf_form_buf = io.BytesIO(); writer.write(pdf_form_buf); pdf_form_buf.seek(0)
-            except Exception as e: st.error(f"PDF Form Error: {e}")
+        mem_profile.checkpoint("narratives & contexts")
+
+        # --- 1-3. RENDER MAIN DOCX, TABLES DOCX & MAIN PDF (report_service, or a background job) ---
+        report_payload = {
+            "docx": [{"name": "report.docx", "label": "DOCX", "template": "celsis/p1/docx", "context": word_data},
+                     {"name": "tables.docx", "label": "Tables DOCX", "template": "celsis/tables/docx", "context": table_data}],
+            "pdf": [{"name": "report.pdf", "label": "PDF Form", "template": "celsis/p1/pdf", "fields": pdf_map}],
+        }
+        submit_job = st.session_state.pop("report_submit", False)
+        if st.session_state.get("report_background"):
+            if submit_job:
+                st.session_state.report_job_id = report_jobs.submit("celsis", report_payload, owner=state_store.owner_id(), label=safe_filename)
+        else:
+            artifacts, errors = report_service.render("celsis", report_payload)
+            for msg in errors: (st.warning if msg.startswith("⚠️") else st.error)(msg)
+            docx_buf, tables_docx_buf, pdf_form_buf = artifacts.get("report.docx"), artifacts.get("tables.docx"), artifacts.get("report.pdf")
+        mem_profile.checkpoint("DOCX / PDF render")
 
         # --- 4. RENDER TABLES PDF ---
         try:
             tables_pdf_buf = create_table_pdf(table_data)
         except Exception as e: st.error(f"Tables PDF Error: {e}")
+        mem_profile.checkpoint("tables PDF (ReportLab)")
 
-        st.success("✅ Celsis Reports and Tables Generated!")
+        if st.session_state.get("report_background"):
+            if st.session_state.get("report_job_id"): st.info(f"⏳ Word / PDF reports queued as job {st.session_state.report_job_id}. Keep editing; they appear under Background Reports when ready.")
+            else: st.info("⏳ Click Generate again to queue the Word / PDF reports in the background.")
+        else: st.success("✅ Celsis Reports and Tables Generated!")
         st.markdown("### 📂 Download Reports")
         c_dl1, c_dl2 = st.columns(2)
         with c_dl1:
@@ -749,3 +768,11 @@ if st.session_state.report_generated:
         st.markdown("---")
         current_data = {k: st.session_state[k] for k in field_keys if k in st.session_state}
         st.download_button("💾 Save Session Data (.txt)", json.dumps(current_data, indent=2), f"SAVE_{safe_filename}.txt", "text/plain")
+        mem_profile.checkpoint("download buttons")
+    mem_profile.end()
+
+# --- 8. BACKGROUND REPORT JOBS ---
+report_jobs.render_job_panel("celsis", state_store.owner_id(), job_ids=[st.session_state.get("report_job_id")])
+
+# --- 9. MEMORY PROFILE (OOS_MEM_PROFILE=1) ---
+mem_profile.render_panel()
@@ -10,6 +10,8 @@ from datetime import datetime
 try:
     from utils import apply_eagle_style, get_room_logic, get_full_name
     import em_logic as el
+    import report_service
+    import mem_profile
 except ImportError as e:
     st.error(f"Import Error: {e}")
     def apply_eagle_style(): pass
@@ -34,6 +36,7 @@ email_text = st.text_area(
 if st.button("🪄 Parse & Auto-Fill Form"):
     parsed = el.parse_em_text(email_text)
     if parsed:
+        el.clear_table2()
         for k, v in parsed.items():
             st.session_state[k] = v
         st.session_state["em_show_reports"] = False
@@ -42,6 +45,26 @@ if st.button("🪄 Parse & Auto-Fill Form"):
     else:
         st.warning("⚠️ No matching fields found in pasted text. Please enter details manually.")
 
+def _start_from_plan(setup):
+    """Callback: the widgets below are not instantiated yet, so their keys can still be set"""
+    el.clear_table2()
+    st.session_state.update(setup)
+    st.session_state["em_show_reports"] = False
+
+with st.expander("🗓️ Weekly Incubation Planner (read schedule per incubator)"):
+    setups = el.parse_em_setups(st.text_area(
+        "One plate per line: Plate Name, Setup Date (DDMMMYY)[, ETX]", key="em_plan_text", height=120,
+        placeholder="EM SMO 116A Air, 04Jun26\nEM GL 1314 Surface, 05Jun26, ETX-260615-0424"))
+    if setups:
+        plan = el.plan_em_batch(setups)
+        for incubator, rows in el.build_incubator_schedule(plan).items():
+            st.markdown(f"**{incubator}**")
+            st.dataframe([{"Read date": day, "Plates": ", ".join(plates)} for day, plates in rows], hide_index=True)
+        idx = st.selectbox("Plate", range(len(setups)), format_func=lambda i: setups[i]["sample_name"], key="em_plan_pick")
+        plate_dates = el.em_dates_from_plan(plan, idx)
+        st.caption(f"48h read: {plate_dates['d_48h']} · 5-day read / date of incident: {plate_dates['d_5d']}")
+        st.button("📋 Start the OOS from this plate", on_click=_start_from_plan, args=(setups[idx],))
+
 st.markdown("---")
 
 # --- 4. INPUT FORM ---
@@ -79,6 +102,31 @@ with r3:
 with r4:
     st.text_input("Organism(s) Identified", key="manual_org", placeholder="e.g. Kocuria palustris (Gram (+) cocci)...")
 
+st.markdown("---")
+st.markdown("### 🗄️ EM Results Store (Table 2 Bracketing)")
+s1, s2 = st.columns(2)
+with s1:
+    em_export = st.file_uploader("Import EM results export (CSV / XLSX)", type=["csv", "xlsx"], key="em_store_upload")
+    if em_export is not None and st.button("📥 Import into Results Store"):
+        import tempfile
+        import em_store
+        suffix = os.path.splitext(em_export.name)[1]
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+            tmp.write(em_export.getvalue())
+        try:
+            n_rows = em_store.import_em_results(tmp.name)
+            st.success(f"✅ Imported {n_rows} EM results.")
+        except Exception as e:
+            st.error(f"Import failed: {e}")
+        finally:
+            os.remove(tmp.name)
+with s2:
+    if st.button("🔄 Auto-Fill Table 2 from Results Store"):
+        import em_store
+        bracket = em_store.query_bracket(st.session_state.get("test_date", ""), st.session_state.get("bsc_id", ""), st.session_state.get("analyst_initial", ""))
+        st.session_state.update(em_store.em_table2_fields(bracket))
+        st.success("✅ Table 2 bracketing filled from the results store.")
+
 st.markdown("---")
 st.markdown("### 📝 Phase I Narrative & Report Generation")
 
@@ -93,9 +141,13 @@ if st.session_state.get("em_show_reports", False):
     else:
         if warnings:
             st.warning(f"⚠️ Missing recommended fields: {', '.join(warnings)}")
+        for flag in el.recurrence_flags():
+            st.warning(f"⚠️ Recurrence: {flag} (see the EM Trends page).")
         
         interview_block, records_block, summary_block = el.generate_em_narrative()
-        docx_buf, pdf_buf = el.generate_em_reports()
+        artifacts, errors = report_service.render("em", {"fields": el.export_fields()})
+        for msg in errors: st.error(msg)
+        docx_buf, pdf_buf = artifacts.get("report.docx"), artifacts.get("report.pdf")
         
         st.success("✅ EM Phase I Complete 7-Page Report Generated Successfully!")
         
@@ -146,3 +198,6 @@ if st.session_state.get("em_show_reports", False):
         
         st.subheader("3. Defensive Phase I Summary & Conclusion (Part 3)")
         st.success(summary_block)
+
+# --- 5. MEMORY PROFILE (OOS_MEM_PROFILE=1) ---
+mem_profile.render_panel()
@@ -0,0 +1,61 @@
+# filename: pages/EM_Trends.py
+import streamlit as st
+import os
+from datetime import date
+
+# --- 1. SAFE UTILS & LOGIC IMPORT ---
+try:
+    from utils import apply_eagle_style
+    import em_store
+    import em_trends as et
+except ImportError as e:
+    st.error(f"Import Error: {e}")
+    def apply_eagle_style(): pass
+
+# --- 2. PAGE CONFIG & STYLING ---
+st.set_page_config(page_title="EM Excursion Trends", layout="wide")
+apply_eagle_style()
+
+st.title("📈 EM Excursion Trends")
+st.caption("Rolling 30 / 90 / 180-day CFU excursion counts from the local EM results store (em_results.db)")
+
+if not os.path.exists(em_store.db_file()):
+    st.info("No EM results store yet. Import an EM results export on the EM page (🗄️ EM Results Store) first.")
+    st.stop()
+
+# --- 3. FILTERS ---
+c1, c2, c3 = st.columns(3)
+with c1:
+    as_of = st.date_input("As of", value=date.today(), key="trend_as_of")
+with c2:
+    dim = st.selectbox("Group by", ["suite", "room", "bsc", "category", "organism"], key="trend_dim")
+with c3:
+    if st.button("🔁 Rebuild Aggregates"):
+        st.success(f"✅ Rebuilt trend aggregates for {et.rebuild()} keys.")
+
+# --- 4. FACILITY SUMMARY ---
+facility = et.trend_facts(as_of).get("all", {})
+m_cols = st.columns(len(et.WINDOWS))
+for col, w in zip(m_cols, et.WINDOWS):
+    v = facility.get(w, {"samples": 0, "excursions": 0, "rate": None})
+    col.metric(f"Excursions ({w} days)", v["excursions"], help=f"{v['samples']} samples" + (f", {v['rate']}% excursion rate" if v["rate"] is not None else ""))
+
+# --- 5. LEADERBOARD & DRILL-DOWN ---
+rows = et.leaderboard(dim, as_of)
+if not rows:
+    st.info("No results in the store for this grouping.")
+    st.stop()
+
+st.subheader(f"Excursions by {dim}")
+st.dataframe(rows, hide_index=True)
+
+short = f"{et.WINDOWS[0]}d excursions"
+if dim in ("room", "bsc", "organism"):
+    for r in rows:
+        if r[short] >= et.RECURRENCE_LEVEL:
+            st.warning(f"⚠️ Recurrence: {dim} {r[dim]} had {r[short]} excursions in the last {et.WINDOWS[0]} days.")
+
+key = st.selectbox(f"Daily excursions for {dim}", [r[dim] for r in rows], key="trend_key")
+series = et.daily_series(dim, key, as_of)
+if series:
+    st.bar_chart({"excursions": {day: x for day, _, x in series}})
@@ -7,6 +7,7 @@ import sys
 import subprocess
 import time
 from datetime import datetime, timedelta
+import narratives
 
 # --- SAFE UTILS IMPORT ---
 try:
@@ -135,8 +136,12 @@ def create_table_pdf(data):
     doc.build(elements); buffer.seek(0)
     return buffer
 
-# --- FILE PERSISTENCE ---
-STATE_FILE = "investigation_state.json"
+# --- STATE PERSISTENCE ---
+import state_store
+import report_service
+import report_jobs
+import mem_profile
+STATE_MODULE = "ScanRDI"
 field_keys = [
     "oos_id", "client_name", "sample_id", "test_date", "sample_name", "lot_number", 
     "dosage_form", "monthly_cleaning_date", 
@@ -166,19 +171,21 @@ for i in range(20):
     field_keys.extend([f"other_id_{i}", f"other_order_{i}", f"prior_oos_{i}", f"em_cat_{i}", f"em_obs_{i}", f"em_etx_{i}", f"em_id_{i}"])
 
 def load_saved_state():
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f:
-                saved_data = json.load(f)
-            for key, value in saved_data.items():
-                if key in st.session_state: st.session_state[key] = value
-        except: pass
+    try: state_store.load_session(st.session_state, STATE_MODULE, field_keys)
+    except: pass
 
-def save_current_state():
-    try:
-        data = {k: v for k, v in st.session_state.items() if k in field_keys}
-        with open(STATE_FILE, "w") as f: json.dump(data, f)
+def save_current_state(label="Smart Parse / Restore"):
+    try: state_store.save_session(st.session_state, STATE_MODULE, field_keys)
     except: pass
+    state_store.snapshot_page(STATE_MODULE, field_keys, label)
+
+def confirm_report():
+    """Generate / "Proceed Anyway": everything done once per click (the report block reruns on every interaction)"""
+    st.session_state.report_generated = True
+    st.session_state.submission_warnings = []
+    oos_history.record_case(st.session_state.oos_id, st.session_state.client_name, st.session_state.sample_name, "ScanRDI", st.session_state.test_date)
+    state_store.snapshot_page(STATE_MODULE, field_keys, "Report generated")
+    st.session_state.report_submit = True  # one background job per Generate, not per rerun
 
 # --- HELPERS ---
 def clean_filename(text): 
@@ -197,30 +204,11 @@ def get_room_logic(bsc_id):
     try: from utils import get_room_logic as u_grl; return u_grl(bsc_id)
     except: return "Unknown Room", "000", "", "Unknown Loc"
 
+# Shared with scan_logic: equipment paragraph (boilerplate cached per BSC pair, survives reruns) and Smart Justification
+from scan_logic import equipment_text, generate_smart_justification
+
 def generate_equipment_text():
-    t_room, t_suite, t_suffix, t_loc = get_room_logic(st.session_state.bsc_id)
-    c_room, c_suite, c_suffix, c_loc = get_room_logic(st.session_state.chgbsc_id)
-    
-    t_suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
-    c_suite_phrase = f"Suite {c_suite}{c_suffix}" if c_suite != "L-Suite" else "L-Suite"
-    
-    if st.session_state.bsc_id == st.session_state.chgbsc_id:
-        part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
-        part2 = f"The ISO 5 BSC E00{st.session_state.bsc_id}, located in the {t_loc}, ({t_suite_phrase}), was used for both testing and changeover steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{st.session_state.bsc_id} was certified and approved by both the Engineering and Quality Assurance teams. Sample processing and changeover were conducted in the ISO 5 BSC E00{st.session_state.bsc_id} in the {t_loc}, ({t_suite_phrase}) by {st.session_state.analyst_name} on {st.session_state.test_date}."
-        return f"{part1}\n\n{part2}"
-    else:
-        if t_suite == c_suite:
-             part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
-        else:
-             p1a = get_cleanroom_narrative(t_suite, t_room=t_room, action_text="testing", verb="consists of")
-             p1b = get_cleanroom_narrative(c_suite, t_room=c_room, action_text="changeover", verb="consists of")
-             part1 = f"{p1a}\n\n{p1b}"
-        intro = f"The ISO 5 BSC E00{st.session_state.bsc_id}, located in the {t_loc}, ({t_suite_phrase}), and ISO 5 BSC E00{st.session_state.chgbsc_id}, located in the {c_loc}, ({c_suite_phrase}), were thoroughly cleaned and disinfected prior to their respective procedures in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Furthermore, the BSCs used throughout testing, E00{st.session_state.bsc_id} for sample processing and E00{st.session_state.chgbsc_id} for the changeover step, were certified and approved by both the Engineering and Quality Assurance teams."
-        if st.session_state.analyst_name == st.session_state.changeover_name:
-            usage_sent = f"Sample processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{st.session_state.bsc_id}) and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{st.session_state.chgbsc_id}) by {st.session_state.analyst_name} on {st.session_state.test_date}."
-        else:
-            usage_sent = f"Sample processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{st.session_state.bsc_id}) by {st.session_state.analyst_name} and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{st.session_state.chgbsc_id}) by {st.session_state.changeover_name} on {st.session_state.test_date}."
-        return f"{part1}\n\n{intro} {usage_sent}"
+    return equipment_text(st.session_state.bsc_id, st.session_state.chgbsc_id, st.session_state.analyst_name, st.session_state.changeover_name, st.session_state.test_date)
 
 def generate_history_text():
     if st.session_state.incidence_count == 0 or st.session_state.has_prior_failures == "No": phrase = "no prior failures"
@@ -283,32 +271,11 @@ def generate_narrative_and_details():
     if not is_fail(st.session_state.obs_air): pass_wk_clean.append("weekly active air sampling")
     if not is_fail(st.session_state.obs_room): pass_wk_clean.append("weekly surface sampling")
 
-    narr_parts = []
-    if pass_daily_clean:
-        d_str = f"{pass_daily_clean[0]}" if len(pass_daily_clean)==1 else f"{pass_daily_clean[0]} and {pass_daily_clean[1]}" if len(pass_daily_clean)==2 else f"{pass_daily_clean[0]}, {pass_daily_clean[1]}, and {pass_daily_clean[2]}"
-        narr_parts.append(f"no microbial growth was observed in {d_str}")
-    if pass_wk_clean:
-        w_str = f"{pass_wk_clean[0]}" if len(pass_wk_clean)==1 else f"{pass_wk_clean[0]} and {pass_wk_clean[1]}" if len(pass_wk_clean)==2 else ", ".join(pass_wk_clean)
-        narr_parts.append(f"Additionally, {w_str} showed no microbial growth" if narr_parts else f"no microbial growth was observed in {w_str}")
-    narr = "Upon analyzing the environmental monitoring results, " + ". ".join(narr_parts) + "." if narr_parts else "Upon analyzing the environmental monitoring results, microbial growth was observed in all sampled areas."
-
-    det = ""
-    if failures:
-        daily_fails = [f["cat"] for f in failures if f['time'] == 'daily']
-        weekly_fails = [f["cat"] for f in failures if f['time'] == 'weekly']
-        intro_parts = []
-        if daily_fails: intro_parts.append(f"{' and '.join(daily_fails)} on the date")
-        if weekly_fails: intro_parts.append(f"{' and '.join(weekly_fails)} from week of testing")
-        fail_intro = f"However, microbial growth was observed during { ' and '.join(intro_parts) }." if intro_parts else ""
-        detail_sentences = []
-        for i, f in enumerate(failures):
-            is_plural = bool(re.search(r'\d+', f['obs']) and int(re.search(r'\d+', f['obs']).group()) > 1)
-            verb_detect = "were" if is_plural else "was"; noun_id = "organisms were" if is_plural else "organism was"
-            method_text = "differential staining" if "gram" in f['id'].lower() else "microbial identification"
-            base_sentence = f"{f['obs']} {verb_detect} detected during {f['cat']} and was submitted for {method_text} under sample ID {f['etx']}, where the {noun_id} identified as {f['id']}"
-            detail_sentences.append(f"Specifically, {base_sentence}." if i==0 else f"Additionally, {base_sentence}." if i==1 else f"Furthermore, {base_sentence}." if i==2 else f"Also, {base_sentence}.")
-        det = f"{fail_intro} {' '.join(detail_sentences)}"
-    return narr, det
+    for f in failures:
+        f["plural"] = bool(re.search(r'\d+', f['obs']) and int(re.search(r'\d+', f['obs']).group()) > 1)
+        f["gram"] = "gram" in f['id'].lower()
+    facts = {"pass_daily": pass_daily_clean, "pass_weekly": pass_wk_clean, "failures": failures}
+    return narratives.render_all(("scan_em_narrative", "scan_em_details"), facts)
 
 # --- INIT STATE LOOP ---
 def init_state(key, default=""): 
@@ -374,6 +341,7 @@ st.title("🦠 ScanRDI Investigation")
 st.header("📧 Smart Email Import / 💾 Restore")
 email_input = st.text_area("Paste Email OR Save File Content here:", height=150)
 if st.button("🪄 Parse / Restore"): parse_email_text(email_input); st.success("Updated!"); st.rerun()
+state_store.render_version_panel(STATE_MODULE, field_keys)
 
 st.header("1. General Test Details")
 c1, c2, c3 = st.columns(3)
@@ -459,6 +427,11 @@ with f2:
     st.text_input("Control Exp", key="control_exp", help="Required")
 
 st.header("4. EM Observations")
+if st.button("🗄️ Auto-Fill EM from Results Store"):
+    import em_store
+    bracket = em_store.query_bracket(st.session_state.test_date, st.session_state.bsc_id, st.session_state.get("analyst_initial", ""))
+    st.session_state.update(em_store.growth_event_fields(bracket))
+    st.rerun()
 st.radio("Microbial Growth Observed?", ["No","Yes"], key="em_growth_observed", horizontal=True)
 
 if st.session_state.em_growth_observed == "Yes":
@@ -479,6 +452,8 @@ with m2: st.text_input("Date of Weekly Monitoring", key="date_weekly", help="Req
 
 st.header("5. Investigation Details")
 st.subheader("Sample History")
+import oos_history
+oos_history.auto_fill_history(st.session_state, "ScanRDI")
 st.radio("Prior failures in last 6 months?", ["No", "Yes"], key="has_prior_failures", horizontal=True)
 if st.session_state.has_prior_failures == "Yes":
     count = st.number_input("Number of Prior Failures", 1, 10, key="incidence_count")
@@ -486,16 +461,20 @@ if st.session_state.has_prior_failures == "Yes":
         st.text_input(f"Prior Failure #{i+1} OOS ID", key=f"prior_oos_{i}")
 
 st.subheader("Cross Contamination")
+import processing_log
+cross_conflicts = processing_log.auto_fill_cross_contam(st.session_state, st.session_state.get("test_date", ""))
+for msg in processing_log.conflict_messages(cross_conflicts):
+    st.warning(f"⚠️ {msg}")
 st.radio("Other samples tested positive same day?", ["No", "Yes"], key="other_positives", horizontal=True)
 if st.session_state.other_positives == "Yes":
     st.number_input("Total Positive Samples that day", 2, 20, key="total_pos_count_num")
-    st.number_input(f"Order of THIS Sample ({st.session_state.sample_id})", 1, 20, key="current_pos_order")
+    st.number_input(f"Order of THIS Sample ({st.session_state.sample_id})", 1, 99, key="current_pos_order")
     num_others = st.session_state.total_pos_count_num - 1
     st.caption(f"Details for {num_others} other positive(s):")
     for i in range(num_others):
         c1, c2 = st.columns(2)
         with c1: st.text_input(f"Other Sample #{i+1} ID", key=f"other_id_{i}")
-        with c2: st.number_input(f"Other Sample #{i+1} Order", 1, 20, key=f"other_order_{i}")
+        with c2: st.number_input(f"Other Sample #{i+1} Order", 1, 99, key=f"other_order_{i}")
 
 if st.button("🔄 Update Summaries Preview"):
     fresh_narr, fresh_det = generate_narrative_and_details()
@@ -506,11 +485,13 @@ if st.button("🔄 Update Summaries Preview"):
 st.text_area("Narrative Preview", key="narrative_summary", height=100)
 if st.session_state.em_growth_observed == "Yes": st.text_area("Details Preview", key="em_details", height=150)
 
-save_current_state()
+state_store.autosave_page(STATE_MODULE, field_keys)
 
 st.divider()
 
 # --- VALIDATION & GENERATION LOGIC ---
+st.checkbox("⏳ Build reports in background", key="report_background",
+            help="Queue the Word / PDF rendering (P1 and P2) as a background job and keep editing; downloads appear under Background Reports.")
 if st.button("🚀 GENERATE REPORT"):
     import time
     ensure_dependencies()
@@ -521,8 +502,7 @@ if st.button("🚀 GENERATE REPORT"):
         st.session_state.submission_warnings = warnings
         st.rerun() 
     else:
-        st.session_state.report_generated = True
-        st.session_state.submission_warnings = [] 
+        confirm_report()
 
 # --- CONFIRMATION UI ---
 if st.session_state.submission_warnings:
@@ -530,13 +510,14 @@ if st.session_state.submission_warnings:
     st.write("**Do you want to proceed?**")
     col_yes, col_no = st.columns([1, 5])
     if col_yes.button("✅ Yes, Proceed Anyway"):
-        st.session_state.report_generated = True; st.session_state.submission_warnings = []; st.rerun()
+        confirm_report(); st.rerun()
     if col_no.button("❌ No, Let me Fix"):
         st.session_state.submission_warnings = []; st.rerun()
 
 # --- GENERATION & DOWNLOAD (P1) ---
 if st.session_state.report_generated:
     fresh_narr, fresh_det = generate_narrative_and_details()
+    fresh_just = generate_smart_justification()
     fresh_equip = generate_equipment_text()
     fresh_history = generate_history_text()
     fresh_cross = generate_cross_contam_text()
@@ -556,7 +537,7 @@ if st.session_state.report_generated:
     base_name = f"OOS-{st.session_state.oos_id} {st.session_state.client_name} - ScanRDI"
     safe_filename = clean_filename(base_name)
 
-    final_data_docx = {k: v for k, v in st.session_state.items()}
+    final_data_docx = {k: v for k, v in st.session_state.items() if not k.startswith("_")}  # internal trackers (autosave etc.) are not template fields
     final_data_docx.update({
         "equipment_summary": fresh_equip, "sample_history_paragraph": fresh_history, "cross_contamination_summary": fresh_cross,
         "test_record": tr_id, "organism_morphology": org_title, "control_positive": st.session_state.control_pos,
@@ -575,6 +556,7 @@ if st.session_state.report_generated:
     p8 = f"Table 2 (see attached tables) presents the environmental monitoring results for {st.session_state.sample_id}. The environmental monitoring (EM) plates were incubated for no less than 48 hours at 30-35°C and no less than an additional five days at 20-25°C as per SOP 2.600.002 (Environmental Monitoring of the Clean-room Facility)."
     p9 = fresh_narr
     if fresh_det: p9 += "\n\n" + fresh_det
+    if fresh_just: p9 += "\n\n" + fresh_just
     p10 = f"Monthly cleaning and disinfection, using H₂O₂, of the cleanroom (ISO 7) and its containing Biosafety Cabinets (BSCs, ISO 5) were performed on {st.session_state.monthly_cleaning_date}, as per SOP 2.600.018 Cleaning and Disinfection Procedure. It was documented that all H₂O₂ indicators passed."
     p11 = fresh_history
     p12 = f"To assess the potential for sample-to-sample contamination contributing to the positive results, a comprehensive review was conducted of all samples processed on the same day. {fresh_cross}"
@@ -638,24 +620,13 @@ if st.session_state.report_generated:
         f"To assess the potential for sample-to-sample contamination contributing to the positive results, a comprehensive review was conducted of all samples processed on the same day. {fresh_cross}\n\n"
         f"Based on the observations outlined above, it is unlikely that the failing results were due to reagents, supplies, the cleanroom environment, the process, or analyst involvement. Consequently, the possibility of laboratory error contributing to this failure is minimal and the original result is deemed to be valid."
     )
-    if fresh_det: p1_text = p1_text.replace(fresh_narr, fresh_narr + "\n\n" + fresh_det)
+    if fresh_det: p1_text = p1_text.replace(fresh_narr, "\n\n".join(p for p in (fresh_narr, fresh_det, fresh_just) if p))
     st.session_state.phase1_full_text = p1_text # Save for P2
  
-    docx_buf = None; tables_docx_buf = None; tables_pdf_buf = None; pdf_form_buf = None
-    if os.path.exists("ScanRDI OOS template 0.docx"):
-        try:
-            from docxtpl import DocxTemplate
-            doc = DocxTemplate("ScanRDI OOS template 0.docx"); doc.render(final_data_docx); docx_buf = io.BytesIO(); doc.save(docx_buf); docx_buf.seek(0)
-        except Exception as e: st.error(f"DOCX Error: {e}")
-    if os.path.exists("tables for scan.docx"):
-        try:
-            from docxtpl import DocxTemplate
-            doc_tbl = DocxTemplate("tables for scan.docx"); doc_tbl.render(final_data_docx); tables_docx_buf = io.BytesIO(); doc_tbl.save(tables_docx_buf); tables_docx_buf.seek(0)
-        except Exception as e: st.error(f"Tables DOCX Error: {e}")
+    tables_pdf_buf = None; pdf_map = None
     try: tables_pdf_buf = create_table_pdf(final_data_docx)
     except Exception as e: st.warning(f"Tables PDF generation failed: {e}")
     try:
-        from pypdf import PdfWriter, PdfReader
         analyst_sig_text = f"{st.session_state.analyst_name} (Written by: Qiyue Chen)"
         personnel_lines = []
         p_name = st.session_state.prepper_name.strip().lower()
@@ -677,13 +648,12 @@ if st.session_state.report_generated:
         smart_comment_samples = f"Yes, {st.session_state.sample_id}"
         smart_comment_records = f"Yes, See {tr_id} for more information."
         smart_comment_storage = f"Yes, Information is available in Eagle Trax Sample Location History under {st.session_state.sample_id}"
-        p1 = f"All analysts involved in the prepping, processing, and reading of the samples – {names_only_phrase} – were interviewed and their answers are recorded throughout this document."
-        p2 = f"The sample was stored upon arrival according to the Client’s instructions. {prep_proc_noun} {prep_proc_phrase} confirmed the integrity of the samples throughout both the preparation and processing stages. No leaks or turbidity were observed at any point, verifying the integrity of the sample."
-        p3 = "All reagents and supplies mentioned in the material section above were stored according to the suppliers’ recommendations, and their integrity was visually verified before utilization. Moreover, each reagent and supply had valid expiration dates."
-        p4 = f"During the preparation phase, {st.session_state.prepper_name} disinfected the samples using acidified bleach and placed them into a pre-disinfected storage bin. On {st.session_state.test_date}, prior to sample processing, {st.session_state.analyst_name} performed a second disinfection with acidified bleach, allowing a minimum contact time of 10 minutes before transferring the samples into the cleanroom suites. A final disinfection step was completed immediately before the samples were introduced into the ISO 5 Biological Safety Cabinet (BSC), E00{st.session_state.bsc_id}, located within the {t_loc}, (Suite {t_suite}{t_suffix}), All activities were performed in accordance with SOP 2.600.023, Rapid Scan RDI® Test Using FIFU Method."
-        p5 = fresh_equip
-        p6 = f"The analyst, {st.session_state.reader_name}, confirmed that the equipment was set up as per SOP 2.700.004 (Scan RDI® System – Operations (Standard C3 Quality Check and Microscope Setup and Maintenance), and the negative control and the positive control for the analyst, {st.session_state.reader_name}, yielded expected results."
-        smart_phase1_part1 = "\n\n".join([p1, p2, p3, p4, p5, p6])
+        smart_phase1_part1 = narratives.render("scan_phase1_part1", {
+            "names_only_phrase": names_only_phrase, "prep_proc_noun": prep_proc_noun, "prep_proc_phrase": prep_proc_phrase,
+            "prepper_name": st.session_state.prepper_name, "analyst_name": st.session_state.analyst_name, "reader_name": st.session_state.reader_name,
+            "test_date": st.session_state.test_date, "bsc_id": st.session_state.bsc_id,
+            "t_loc": t_loc, "t_suite": t_suite, "t_suffix": t_suffix, "equipment": fresh_equip,
+        })
         
         # 请确保 pdf_map 位于正确的缩进位置（通常在 st.button 下面）
         pdf_map = {
@@ -694,7 +664,7 @@ if st.session_state.report_generated:
             'Date Field3': pdf_date_str,
             'Text Field2': st.session_state.sample_id, 
             'Text Field6': st.session_state.lot_number, 
-            'Text Field4': st.session_state.sample_name + "\n\n\n\n", 
+            'Text Field4': st.session_state.sample_name, 
             'Text Field5': st.session_state.dosage_form, 
             'Text Field0': analyst_sig_text, 
             'Text Field3': smart_personnel_block, 
@@ -712,13 +682,26 @@ if st.session_state.report_generated:
             'Text Field49': smart_phase1_part1, 
             'Text Field50': smart_phase1_part2
         }
-        if os.path.exists("ScanRDI OOS template.pdf"):
-            writer = PdfWriter(clone_from="ScanRDI OOS template.pdf"); 
-            for p in writer.pages: writer.update_page_form_field_values(p, pdf_map)
-            pdf_form_buf = io.BytesIO(); writer.write(pdf_form_buf); pdf_form_buf.seek(0)
     except Exception as e: st.error(f"PDF Form Error: {e}")
 
-    st.success("✅ Reports Generated Successfully!")
+    # Word report, tables and PDF form in one report_service call (or one background job)
+    report_payload = {
+        "docx": [{"name": "report.docx", "label": "DOCX", "template": "scanrdi/p1/docx", "context": final_data_docx},
+                 {"name": "tables.docx", "label": "Tables DOCX", "template": "scanrdi/tables/docx", "context": final_data_docx}],
+        "pdf": [{"name": "report.pdf", "label": "PDF Form", "template": "scanrdi/p1/pdf", "fields": pdf_map}] if pdf_map else [],
+    }
+    docx_buf = tables_docx_buf = pdf_form_buf = None
+    submit_job = st.session_state.pop("report_submit", False)
+    if st.session_state.get("report_background"):
+        if submit_job:
+            st.session_state.report_job_id = report_jobs.submit("scanrdi", report_payload, owner=state_store.owner_id(), label=safe_filename)
+        if st.session_state.get("report_job_id"): st.info(f"⏳ Word / PDF reports queued as job {st.session_state.report_job_id}. Keep editing; they appear under Background Reports when ready.")
+        else: st.info("⏳ Click Generate again to queue the Word / PDF reports in the background.")
+    else:
+        artifacts, errors = report_service.render("scanrdi", report_payload)
+        for msg in errors: (st.warning if msg.startswith("⚠️") else st.error)(msg)
+        docx_buf, tables_docx_buf, pdf_form_buf = artifacts.get("report.docx"), artifacts.get("tables.docx"), artifacts.get("report.pdf")
+        st.success("✅ Reports Generated Successfully!")
     st.markdown("### 📂 Download Reports")
     c1, c2, c3 = st.columns(3)
     with c1:
@@ -740,35 +723,14 @@ st.markdown("---")
 st.subheader("🚦 Phase 2 Investigation (Retest)")
 st.checkbox("Include Phase 2 Investigation?", key="include_phase2")
 
+@mem_profile.profiled("ScanRDI generate_p2_docs")
 def generate_p2_docs():
-    from docxtpl import DocxTemplate; from pypdf import PdfWriter
-    def generate_retest_equipment_text(bsc_main, bsc_chg, analyst_main, analyst_chg, date_val):
-        t_room, t_suite, t_suffix, t_loc = get_room_logic(bsc_main); c_room, c_suite, c_suffix, c_loc = get_room_logic(bsc_chg)
-        
-        t_suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
-        c_suite_phrase = f"Suite {c_suite}{c_suffix}" if c_suite != "L-Suite" else "L-Suite"
-        
-        subj = "Retest sample"
-        if bsc_main == bsc_chg:
-            part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
-            part2 = f"The ISO 5 BSC E00{bsc_main}, located in the {t_loc}, ({t_suite_phrase}), was used for both testing and changeover steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{bsc_main} was certified and approved by both the Engineering and Quality Assurance teams. {subj} processing and changeover were conducted in the ISO 5 BSC E00{bsc_main} in the {t_loc}, ({t_suite_phrase}) by {analyst_main} on {date_val}."
-            return f"{part1}\n\n{part2}"
-        else:
-            if t_suite == c_suite: part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
-            else:
-                 p1a = get_cleanroom_narrative(t_suite, t_room=t_room, action_text="testing", verb="consists of")
-                 p1b = get_cleanroom_narrative(c_suite, t_room=c_room, action_text="changeover", verb="consists of")
-                 part1 = f"{p1a}\n\n{p1b}"
-            intro = f"The ISO 5 BSC E00{bsc_main}, located in the {t_loc}, ({t_suite_phrase}), and ISO 5 BSC E00{bsc_chg}, located in the {c_loc}, ({c_suite_phrase}), were thoroughly cleaned and disinfected prior to their respective procedures in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Furthermore, the BSCs used throughout testing, E00{bsc_main} for sample processing and E00{bsc_chg} for the changeover step, were certified and approved by both the Engineering and Quality Assurance teams."
-            usage_sent = f"{subj} processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{bsc_main}) and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{bsc_chg}) by {analyst_main} on {date_val}." if analyst_main == analyst_chg else f"{subj} processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{bsc_main}) by {analyst_main} and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{bsc_chg}) by {analyst_chg} on {date_val}."
-            return f"{part1}\n\n{intro} {usage_sent}"
-
     p_name = st.session_state.retest_prepper_name or get_full_name(st.session_state.retest_prepper_initial)
     a_name = st.session_state.retest_analyst_name or get_full_name(st.session_state.retest_analyst_initial)
     r_name = st.session_state.retest_reader_name or get_full_name(st.session_state.retest_reader_initial)
     c_name = st.session_state.retest_changeover_name or get_full_name(st.session_state.retest_changeover_initial)
 
-    retest_equip_sum = generate_retest_equipment_text(st.session_state.retest_bsc_id, st.session_state.retest_chgbsc_id, a_name, c_name, st.session_state.retest_date)
+    retest_equip_sum = equipment_text(st.session_state.retest_bsc_id, st.session_state.retest_chgbsc_id, a_name, c_name, st.session_state.retest_date, subj="Retest sample")
     r_room, r_suite, r_suffix, r_loc = get_room_logic(st.session_state.retest_bsc_id)
     rc_room, rc_suite, rc_suffix, rc_loc = get_room_logic(st.session_state.retest_chgbsc_id)
 
@@ -794,7 +756,7 @@ def generate_p2_docs():
         f"Based on the observations outlined above, laboratory error cannot be conclusively confirmed for either the original test or the retest. Therefore, both the failing result for {st.session_state.sample_id} and the passing result for {st.session_state.retest_sample_id} are considered valid.\n\n"
         f"The final disposition of the lot remains at the discretion of the client.")
 
-    data = {k: v for k, v in st.session_state.items()}
+    data = {k: v for k, v in st.session_state.items() if not k.startswith("_")}
     data.update({
         "whole_P1": st.session_state.get('phase1_full_text', 'See Phase 1 Report'),
         "retest_prepper_name": p_name, "retest_analyst_name": a_name, "retest_reader_name": r_name,
@@ -806,24 +768,27 @@ def generate_p2_docs():
         "smart_phase1_summary_block": smart_p1_block, "smart_phase2_narrative_block": smart_p2_narrative
     })
 
-    p2_docx_buf = None; p2_pdf_buf = None
-    if os.path.exists("ScanRDI OOS P2 template 0.docx"):
-        try: doc0 = DocxTemplate("ScanRDI OOS P2 template 0.docx"); doc0.render(data); p2_docx_buf = io.BytesIO(); doc0.save(p2_docx_buf); p2_docx_buf.seek(0)
-        except Exception as e: st.error(f"P2 Main DOCX Error: {e}")
-    if os.path.exists("ScanRDI OOS P2 template.pdf"):
-        try:
-            try: rd_obj = datetime.strptime(st.session_state.retest_date, "%d%b%y"); p2_pdf_date = rd_obj.strftime("%d-%b-%Y")
-            except: p2_pdf_date = st.session_state.retest_date
-            pdf_map = {
-                "Text Field0": data["sample_name"], "Text Field1": smart_pers, "Text Field2": smart_ids, "Text Field3": smart_retest_res,
-                "Text Field4": smart_orig_res, "Text Field30": data["oos_id"], "Date Field0": p2_pdf_date, "Text Field8": data["smart_retest_scan_id"],
-                "Text Field9": smart_bsc_list, "Text Field10": smart_suite_list, "Text Field22": smart_p1_block, "Text Field23": smart_p2_narrative
-            }
-            writer = PdfWriter(clone_from="ScanRDI OOS P2 template.pdf")
-            for p in writer.pages: writer.update_page_form_field_values(p, pdf_map)
-            p2_pdf_buf = io.BytesIO(); writer.write(p2_pdf_buf); p2_pdf_buf.seek(0)
-        except Exception as e: st.error(f"P2 PDF Error: {e}")
-    return p2_docx_buf, p2_pdf_buf
+    try: rd_obj = datetime.strptime(st.session_state.retest_date, "%d%b%y"); p2_pdf_date = rd_obj.strftime("%d-%b-%Y")
+    except: p2_pdf_date = st.session_state.retest_date
+    pdf_map = {
+        "Text Field0": data["sample_name"], "Text Field1": smart_pers, "Text Field2": smart_ids, "Text Field3": smart_retest_res,
+        "Text Field4": smart_orig_res, "Text Field30": data["oos_id"], "Date Field0": p2_pdf_date, "Text Field8": data["smart_retest_scan_id"],
+        "Text Field9": smart_bsc_list, "Text Field10": smart_suite_list, "Text Field22": smart_p1_block, "Text Field23": smart_p2_narrative
+    }
+    mem_profile.checkpoint("P2 context & narrative")
+    p2_payload = {
+        "docx": [{"name": "p2.docx", "label": "P2 Main DOCX", "template": "scanrdi/p2/docx", "context": data}],
+        "pdf": [{"name": "p2.pdf", "label": "P2 PDF", "template": "scanrdi/p2/pdf", "fields": pdf_map}],
+    }
+    submit_job = st.session_state.pop("p2_submit", False)
+    if st.session_state.get("report_background"):
+        if submit_job:
+            label = clean_filename(f"OOS-{st.session_state.oos_id} {st.session_state.client_name} - ScanRDI")
+            st.session_state.p2_job_id = report_jobs.submit("scanrdi", p2_payload, owner=state_store.owner_id(), label=label)
+        return None, None
+    artifacts, errors = report_service.render("scanrdi", p2_payload)
+    for msg in errors: (st.warning if msg.startswith("⚠️") else st.error)(msg)
+    return artifacts.get("p2.docx"), artifacts.get("p2.pdf")
 
 if st.session_state.include_phase2:
     st.markdown("💡 **Tip:** Enter Initials (e.g. DS) and press Enter. The system will auto-fill the full name if known.")
@@ -867,10 +832,13 @@ if st.session_state.include_phase2:
         if st.session_state.diff_retest_bsc == "Yes": st.selectbox("Retest Chg BSC", bsc_list, key="retest_chgbsc_id")
         else: st.session_state.retest_chgbsc_id = st.session_state.retest_bsc_id
 
-    if st.button("🚀 GENERATE PHASE 2 REPORTS"): st.session_state.p2_generated = True
+    if st.button("🚀 GENERATE PHASE 2 REPORTS"): st.session_state.p2_generated = True; st.session_state.p2_submit = True
     if st.session_state.p2_generated:
         p2_doc, p2_pdf = generate_p2_docs()
-        st.success("Phase 2 Reports Ready!")
+        if st.session_state.get("report_background"):
+            if st.session_state.get("p2_job_id"): st.info(f"⏳ Phase 2 reports queued as job {st.session_state.p2_job_id}; they appear under Background Reports when ready.")
+            else: st.info("⏳ Click Generate Phase 2 again to queue the reports in the background.")
+        else: st.success("Phase 2 Reports Ready!")
         c1, c2, c3 = st.columns(3)
         
         base_name = f"OOS-{st.session_state.oos_id} {st.session_state.client_name} - ScanRDI"
@@ -885,3 +853,9 @@ if st.session_state.include_phase2:
             current_data = {k: st.session_state[k] for k in field_keys if k in st.session_state}
             json_str = json.dumps(current_data, indent=2)
             st.download_button("💾 Save Full Session Data (.txt)", json_str, f"SAVE_{clean_filename(base_name)}.txt", "text/plain")
+
+# ================= BACKGROUND REPORT JOBS (P1 & P2) =================
+report_jobs.render_job_panel("scanrdi", state_store.owner_id(), job_ids=[st.session_state.get("report_job_id"), st.session_state.get("p2_job_id")])
+
+# ================= MEMORY PROFILE (OOS_MEM_PROFILE=1) =================
+mem_profile.render_panel()
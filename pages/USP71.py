@@ -10,7 +10,7 @@ from datetime import datetime, timedelta
 
 # --- 1. SAFE UTILS & LOGIC IMPORT ---
 try:
-    from utils import apply_eagle_style, get_room_logic, get_full_name, get_business_day_back, clean_analyst_name, get_monthly_cleaning_date, get_cleanroom_narrative
+    from utils import apply_eagle_style, get_room_logic, get_full_name, get_business_day_back, clean_analyst_name, get_monthly_cleaning_date, get_cleanroom_narrative, username_to_initials
     import usp71_logic as ul
 except ImportError as e:
     st.error(f"Import Error: {e}")
@@ -21,6 +21,7 @@ except ImportError as e:
     def clean_analyst_name(n): return n
     def get_monthly_cleaning_date(d): return ""
     def get_cleanroom_narrative(s, r=None, a="", v=""): return ""
+    def username_to_initials(u): return (u or "")[:2].upper()
 
 # --- 2. PAGE CONFIG & STYLING ---
 st.set_page_config(page_title="USP 71 Investigation", layout="wide")
@@ -51,26 +52,34 @@ def ensure_dependencies():
             time.sleep(1); st.rerun()
         except Exception as e: placeholder.error(f"Install failed: {e}")
 
-# --- 3. FILE PERSISTENCE & KEYS ---
-STATE_FILE = "usp71_investigation_state.json"
+# --- 3. STATE PERSISTENCE & KEYS ---
+import state_store
+import report_service
+import mem_profile
+STATE_MODULE = "USP71"
 field_keys = ul.FIELD_KEYS if hasattr(ul, 'FIELD_KEYS') else []
 
 def load_saved_state():
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f: saved_data = json.load(f)
-            for key, value in saved_data.items():
-                if key in st.session_state: st.session_state[key] = value
-        except: pass
+    try: state_store.load_session(st.session_state, STATE_MODULE, field_keys)
+    except: pass
 
-def save_current_state():
+NAME_FIELDS = ["prepper_name", "analyst_name", "reading_name", "subculture_name"]
+
+def save_current_state(label="Smart Parse / Restore"):
     try:
-        for field in ["prepper_name", "analyst_name", "reading_name", "subculture_name"]:
-            if field in st.session_state:
+        for field in NAME_FIELDS:
+            if field in st.session_state and clean_analyst_name(st.session_state[field]) != st.session_state[field]:
                 st.session_state[field] = clean_analyst_name(st.session_state[field])
-        data = {k: v for k, v in st.session_state.items() if k in field_keys}
-        with open(STATE_FILE, "w") as f: json.dump(data, f)
+        state_store.save_session(st.session_state, STATE_MODULE, field_keys)
     except: pass
+    state_store.snapshot_page(STATE_MODULE, field_keys, label)
+
+def confirm_report():
+    """Generate / "Proceed Anyway": everything done once per click (the report block reruns on every interaction)"""
+    st.session_state.report_generated = True
+    st.session_state.submission_warnings = []
+    oos_history.record_case(st.session_state.oos_id, st.session_state.client_name, st.session_state.sample_name, "USP71", st.session_state.test_date)
+    state_store.snapshot_page(STATE_MODULE, field_keys, "Report generated")
 
 def clean_filename(text): 
     return re.sub(r'[\\/*?:"<>|]', '_', str(text)).strip() if text else ""
@@ -91,42 +100,13 @@ if "submission_warnings" not in st.session_state: st.session_state.submission_wa
 if not st.session_state.get("testing_method"):
     st.session_state.testing_method = "Direct Inoculation"
 
-# --- HELPER: USERNAME TO INITIALS ---
-def username_to_initials(username):
-    if not username:
-        return ""
-    username = username.strip()
-    known = {
-        "gsurber": "GS", "GSurber": "GS",
-        "enioupin": "EN", "ENioupin": "EN",
-        "acarrillo": "AC", "ACarrillo": "AC",
-        "rseymour": "RS", "RSeymour": "RS",
-        "jowens": "JO", "JOwens": "JO"
-    }
-    if username in known:
-        return known[username]
-    if username.lower() in known:
-        return known[username.lower()]
-        
-    uppers = "".join([c for c in username if c.isupper()])
-    if len(uppers) >= 2:
-        return uppers[:3]
-    return username[0].upper() + (username[1].upper() if len(username) > 1 else "")
-
-
-# --- STATE FILE MERGING HELPERS ---
+# --- STATE STORE MERGING HELPERS ---
 def load_state_from_file():
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f:
-                return json.load(f)
-        except: pass
-    return {}
+    try: return state_store.load_saved_values(st.session_state, STATE_MODULE)
+    except: return {}
 
 def save_state_to_file(data):
-    try:
-        with open(STATE_FILE, "w") as f:
-            json.dump(data, f)
+    try: state_store.save_values(st.session_state, STATE_MODULE, data)
     except: pass
 
 # --- 5. SMART COMBINED PARSER ---
@@ -398,9 +378,20 @@ combined_input = st.text_area(
 if st.button("🪄 Smart Parse / Restore", key="combined_parse_btn"):
     if combined_input.strip():
         parse_combined_text(combined_input)
+        state_store.snapshot_page(STATE_MODULE, field_keys, "Smart Parse / Restore")
         st.success("✅ Content Parsed & Loaded!")
         time.sleep(1)
         st.rerun()
+state_store.render_version_panel(STATE_MODULE, field_keys)
+if st.button("🗄️ Auto-Fill from Trax Event Store", key="trax_fill_btn"):
+    import trax_import
+    trax_fields = trax_import.case_fields(st.session_state.get("sample_id", ""))
+    if trax_fields.get("process_date"):
+        trax_fields["monthly_cleaning_date"] = get_monthly_cleaning_date(trax_fields["process_date"]) or st.session_state.get("monthly_cleaning_date", "")
+    for k, v in trax_fields.items():
+        if k in field_keys: st.session_state[k] = v
+    save_current_state("Trax auto-fill")
+    st.rerun()
 
 def create_table_pdf(data):
     from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
@@ -579,6 +570,11 @@ for i in range(st.session_state.pos_bottle_count):
         st.text_input(f"Bottle #{i+1} Organism", key=f"pos_org_{i}", help="Pending or actual bug name")
 
 st.header("4. EM Observations")
+if st.button("🗄️ Auto-Fill EM from Results Store"):
+    import em_store
+    bracket = em_store.query_bracket(st.session_state.get("process_date") or st.session_state.test_date, st.session_state.bsc_id, st.session_state.get("analyst_initial", ""))
+    st.session_state.update(em_store.growth_event_fields(bracket))
+    st.rerun()
 st.radio("Microbial Growth Observed?", ["No","Yes"], key="em_growth_observed", horizontal=True)
 
 if st.session_state.em_growth_observed == "Yes":
@@ -597,6 +593,8 @@ with ev1: st.text_input("Event / Deviation Number", key="event_number")
 with ev2: st.text_input("Confirmation / CAPA Number", key="confirm_number")
 
 st.subheader("Sample History")
+import oos_history
+oos_history.auto_fill_history(st.session_state, "USP71")
 st.radio("Prior failures in last 6 months?", ["No", "Yes"], key="has_prior_failures", horizontal=True)
 if st.session_state.has_prior_failures == "Yes":
     count = st.number_input("Number of Prior Failures", 1, 10, key="incidence_count")
@@ -608,17 +606,21 @@ if st.session_state.has_prior_failures == "Yes":
         with h4: st.text_input(f"Prior #{i+1} Analyst", key=f"oos1_analyst_name_{i}" if i > 0 else "oos1_analyst_name")
 
 st.subheader("Cross Contamination")
+import processing_log
+cross_conflicts = processing_log.auto_fill_cross_contam(st.session_state, st.session_state.get("process_date") or st.session_state.get("test_date", ""))
+for msg in processing_log.conflict_messages(cross_conflicts):
+    st.warning(f"⚠️ {msg}")
 st.radio("Other samples tested positive same day?", ["No", "Yes"], key="other_positives", horizontal=True)
 if st.session_state.other_positives == "Yes":
     st.number_input("Total Positive Samples that day", 2, 20, key="total_pos_count_num")
-    st.number_input(f"Order of THIS Sample ({st.session_state.sample_id})", 1, 20, key="current_pos_order")
+    st.number_input(f"Order of THIS Sample ({st.session_state.sample_id})", 1, 99, key="current_pos_order")
     num_others = st.session_state.total_pos_count_num - 1
     for i in range(num_others):
         col1, col2 = st.columns(2)
         with col1: st.text_input(f"Other Sample #{i+1} ID", key=f"other_id_{i}")
-        with col2: st.number_input(f"Other Sample #{i+1} Order", 1, 20, key=f"other_order_{i}")
+        with col2: st.number_input(f"Other Sample #{i+1} Order", 1, 99, key=f"other_order_{i}")
 
-save_current_state()
+state_store.autosave_page(STATE_MODULE, field_keys, transforms={f: clean_analyst_name for f in NAME_FIELDS})
 st.divider()
 
 # --- 7. GENERATION & VALIDATION ---
@@ -631,18 +633,18 @@ if st.button("🚀 GENERATE USP 71 REPORT", type="primary"):
         st.session_state.submission_warnings = warnings
         st.rerun() 
     else:
-        st.session_state.report_generated = True
-        st.session_state.submission_warnings = [] 
+        confirm_report()
 
 if st.session_state.submission_warnings:
     st.warning(f"⚠️ The following fields are empty: {', '.join(st.session_state.submission_warnings)}")
     col_yes, col_no = st.columns([1, 5])
     if col_yes.button("✅ Yes, Proceed Anyway"):
-        st.session_state.report_generated = True; st.session_state.submission_warnings = []; st.rerun()
+        confirm_report(); st.rerun()
     if col_no.button("❌ No, Let me Fix"):
         st.session_state.submission_warnings = []; st.rerun()
 
 if st.session_state.report_generated:
+    mem_profile.begin("USP71 report handler")
     with st.spinner("Compiling USP 71 bulk insertion logic..."):
         
         pos_media_list = [st.session_state.get(f"pos_media_{i}", "") for i in range(st.session_state.pos_bottle_count)]
@@ -673,6 +675,7 @@ if st.session_state.report_generated:
 
         fresh_equip = ul.generate_usp71_equipment_text()
         fresh_narr, fresh_det = ul.generate_usp71_narrative_and_details()
+        fresh_just = ul.generate_usp71_smart_justification()
         fresh_history = ul.generate_usp71_history_text()
         fresh_cross = ul.generate_usp71_cross_contam_text()
         
@@ -775,6 +778,7 @@ if st.session_state.report_generated:
             
         p12 = fresh_narr
         if fresh_det: p12 += "\n\n" + fresh_det
+        if fresh_just: p12 += "\n\n" + fresh_just
         p13 = "The analysts confirmed full compliance with cleaning procedures as outlined in SOPs 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology) and 2.600.008 (USP <71> / EP 2.6.1 Sterility Test)."
         if "L-Suite" in t_suite:
             p14 = f"Monthly cleaning and disinfection of the outermost ISO 8 room, the ISO 8 anteroom, the ISO 7 buffer cleanroom, the innermost ISO 7 cleanroom, and its containing ISO 5 Biosafety Cabinets for {cr_phrase} was performed on {st.session_state.monthly_cleaning_date}, as per SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). During both cleaning cycles, it was documented that all H₂O₂ indicators passed. This confirms the efficient monthly cleaning of all four parts of {cleanroom_phrase}."
@@ -871,7 +875,7 @@ if st.session_state.report_generated:
             'Text Field57': st.session_state.oos_id, 'Date Field0': pdf_process_date_str, 'Date Field1': pdf_date_str, 
             'Date Field2': pdf_date_str, 'Date Field3': pdf_date_str,
             'Text Field2': st.session_state.sample_id, 'Text Field6': st.session_state.lot_number, 
-            'Text Field4': st.session_state.sample_name + "\n\n\n\n", 'Text Field5': st.session_state.dosage_form, 
+            'Text Field4': st.session_state.sample_name, 'Text Field5': st.session_state.dosage_form, 
             'Text Field0': analyst_sig_text, 'Text Field3': smart_personnel_block, 'Text Field7': smart_incident_opening + "\n\n",
             'Text Field13': word_data["smart_comment_interview"], 'Text Field14': word_data["smart_comment_samples"], 
             'Text Field17': word_data["smart_comment_records"], 'Text Field21': word_data["smart_comment_storage"],
@@ -932,41 +936,23 @@ if st.session_state.report_generated:
         table_data["positive_media"] = st.session_state.get("positive_media", "N/A")
         table_data["positive_org"] = st.session_state.get("positive_org", "N/A")
 
-        # --- 1. RENDER MAIN DOCX ---
-        target_template = "USP71 OOS P1 template.docx"
-        if not os.path.exists(target_template): target_template = "USP71 OOS P1 template 0.docx"
-        if os.path.exists(target_template):
-            try:
-                from docxtpl import DocxTemplate
-                doc = DocxTemplate(target_template)
-                doc.render(word_data); docx_buf = io.BytesIO(); doc.save(docx_buf); docx_buf.seek(0)
-            except Exception as e: st.error(f"DOCX Error: {e}")
-        else: st.warning(f"⚠️ Could not find {target_template}.")
-
-        # --- 2. RENDER TABLES DOCX ---
-        target_tables_template = "tables for 71.docx"
-        if not os.path.exists(target_tables_template): target_tables_template = "USP71 table.docx"
-        if os.path.exists(target_tables_template):
-            try:
-                from docxtpl import DocxTemplate
-                doc_tbl = DocxTemplate(target_tables_template)
-                doc_tbl.render(table_data); tables_docx_buf = io.BytesIO(); doc_tbl.save(tables_docx_buf); tables_docx_buf.seek(0)
-            except Exception as e: st.error(f"Tables DOCX Error: {e}")
-        else: st.warning(f"⚠️ Could not find {target_tables_template}.")
-            
-        # --- 3. RENDER MAIN PDF ---
-        if os.path.exists("USP71 OOS P1 template.pdf"):
-            try:
-                from pypdf import PdfWriter
-                writer = PdfWriter(clone_from="USP71 OOS P1 template.pdf") 
-                for p in writer.pages: writer.update_page_form_field_values(p, pdf_map)
-                pdf_form_buf = io.BytesIO(); writer.write(pdf_form_buf); pdf_form_buf.seek(0)
-            except Exception as e: st.error(f"PDF Form Error: {e}")
+        mem_profile.checkpoint("narratives & contexts")
+
+        # --- 1-3. RENDER MAIN DOCX, TABLES DOCX & MAIN PDF (report_service) ---
+        artifacts, errors = report_service.render("usp71", {
+            "docx": [{"name": "report.docx", "label": "DOCX", "template": "usp71/p1/docx", "context": word_data},
+                     {"name": "tables.docx", "label": "Tables DOCX", "template": "usp71/tables/docx", "context": table_data}],
+            "pdf": [{"name": "report.pdf", "label": "PDF Form", "template": "usp71/p1/pdf", "fields": pdf_map}],
+        })
+        for msg in errors: (st.warning if msg.startswith("⚠️") else st.error)(msg)
+        docx_buf, tables_docx_buf, pdf_form_buf = artifacts.get("report.docx"), artifacts.get("tables.docx"), artifacts.get("report.pdf")
+        mem_profile.checkpoint("DOCX / PDF render")
 
         # --- 4. RENDER TABLES PDF ---
         try:
             tables_pdf_buf = create_table_pdf(table_data)
         except Exception as e: st.error(f"Tables PDF Error: {e}")
+        mem_profile.checkpoint("tables PDF (ReportLab)")
 
         st.success("✅ USP 71 Reports and Tables Generated!")
         st.markdown("### 📂 Download Reports")
@@ -981,3 +967,8 @@ if st.session_state.report_generated:
         st.markdown("---")
         current_data = {k: st.session_state[k] for k in field_keys if k in st.session_state}
         st.download_button("💾 Save Session Data (.txt)", json.dumps(current_data, indent=2), f"SAVE_{safe_filename}.txt", "text/plain")
+        mem_profile.checkpoint("download buttons")
+    mem_profile.end()
+
+# --- 8. MEMORY PROFILE (OOS_MEM_PROFILE=1) ---
+mem_profile.render_panel()
@@ -0,0 +1,202 @@
+# filename: pdf_fit.py
+"""
+Auto-fit engine for long text in the PDF form fields (Text Field49/50/51 narratives, personnel
+blocks, sample names).
+The form fields use auto size ('/Helv 0 Tf'), so a viewer shrinks a long narrative until it is
+unreadable and cuts it off below that; the pages padded short fields with blank lines to push the
+auto size down. fit_text() wraps the text the way the viewer does, with the template's field rect
+(pdf_schema) and the real font metrics, and picks the largest size between MIN_SIZE and MAX_SIZE
+that fits. Text that does not fit at MIN_SIZE is cut at a line break, and the rest goes onto
+continuation pages appended after the form (ReportLab, like the EM Page 7 tables). Boxes too
+small for a continuation to make sense (one-line comments) shrink down to SMALL_MIN_SIZE instead.
+Widths, line wraps and fits are cached, so a repeated field costs one dict lookup.
+"""
+import io
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+import pdf_schema
+
+# --- 1. CONFIG ---
+MAX_SIZE = 10.0      # pt; never larger than the form's body text
+MIN_SIZE = 7.0       # pt; below this the text moves to a continuation page instead
+SMALL_MIN_SIZE = 4.0 # pt; fields with room for fewer than OVERFLOW_LINES lines shrink to this, never overflow
+OVERFLOW_LINES = 5
+STEP = 0.5
+LEADING = 1.15       # line height / font size of the viewers' multiline layout
+PADDING = 2.0        # pt inside the border on every side
+CONTINUED = "(continued on the attached continuation page)"
+
+# PDF standard-14 resource names used in /DA -> ReportLab font names
+FONTS = {"Helv": "Helvetica", "HeBo": "Helvetica-Bold", "TiRo": "Times-Roman", "TiBo": "Times-Bold",
+         "Cour": "Courier", "CoBo": "Courier-Bold"}
+
+class FitResult(NamedTuple):
+    size: float       # font size to write into the field's /DA
+    text: str         # what goes into the field
+    overflow: str     # what goes onto the continuation page ("" when it all fits)
+
+# --- 2. METRICS (cached) ---
+@lru_cache(maxsize=None)
+def _char_widths(font):
+    """Per-font {char: width at 1000 pt}, filled on first use of each character"""
+    return {}
+
+def _rl_font(font):
+    return FONTS.get(font, "Helvetica")
+
+def text_width(text, font="Helv", size=1.0):
+    """Width of text in pt at the given size (per-character widths cached per font)"""
+    widths = _char_widths(font)
+    total = 0.0
+    for ch in text:
+        w = widths.get(ch)
+        if w is None:
+            from reportlab.pdfbase.pdfmetrics import stringWidth
+            w = widths[ch] = stringWidth(ch, _rl_font(font), 1000)
+        total += w
+    return total * size / 1000
+
+@lru_cache(maxsize=8192)
+def wrap(text, font, width):
+    """
+    Line spans ((start, end), ...) of text wrapped at width (in units of the font size) the way a
+    viewer lays out a multiline field: explicit newlines, then words, then characters of a too-long word.
+    """
+    lines = []
+    pos = 0
+    for para in text.split("\n"):
+        start, line_w = pos, 0.0
+        space_w = text_width(" ", font)
+        for m in re.finditer(r"\S+", para):
+            w_start, w_end = pos + m.start(), pos + m.end()
+            word_w = text_width(m.group(), font)
+            gap = space_w * (w_start - last_end) if line_w else 0.0
+            if line_w and line_w + gap + word_w > width:
+                lines.append((start, last_end))
+                start, line_w = w_start, 0.0
+                gap = 0.0
+            if not line_w and word_w > width:  # break the word itself
+                s = w_start
+                while text_width(text[s:w_end], font) > width:
+                    e = s + 1
+                    while e < w_end and text_width(text[s:e + 1], font) <= width:
+                        e += 1
+                    lines.append((s, e))
+                    s = e
+                start, word_w = s, text_width(text[s:w_end], font)
+            line_w = (line_w + gap + word_w) if line_w else word_w
+            last_end = w_end
+        lines.append((start, last_end if line_w else start))
+        pos += len(para) + 1
+    return tuple(lines)
+
+@lru_cache(maxsize=4096)
+def _fit(text, font, width, height, max_size, min_size):
+    # A one- or two-line box (a Yes/No comment) shrinks like the viewer's auto size instead of overflowing
+    small = height < OVERFLOW_LINES * min_size * LEADING
+    size, floor = max_size, (SMALL_MIN_SIZE if small else min_size)
+    while size >= floor:
+        lines = wrap(text, font, round(width / size, 2))
+        if len(lines) * size * LEADING <= height:
+            return FitResult(size, text, "")
+        size -= STEP
+    if small:
+        return FitResult(floor, text, "")
+    # Does not fit at min_size: keep the lines that do (one left for the marker), the rest overflows
+    lines = wrap(text, font, round(width / min_size, 2))
+    keep = max(1, int(height // (min_size * LEADING)) - 1)
+    cut = lines[keep][0] if keep < len(lines) else len(text)
+    head, rest = text[:cut].rstrip(), text[cut:].strip()
+    if not rest:
+        return FitResult(min_size, text, "")
+    return FitResult(min_size, f"{head}\n{CONTINUED}", rest)
+
+def fit_text(text, rect, font="Helv", max_size=MAX_SIZE, min_size=MIN_SIZE):
+    """FitResult for a multiline field: the largest size that fits rect [x0, y0, x1, y1], else overflow"""
+    text = (text or "").rstrip()  # trailing blank lines do not change what is shown
+    width = abs(rect[2] - rect[0]) - 2 * PADDING
+    height = abs(rect[3] - rect[1]) - 2 * PADDING
+    if not text or width <= 0 or height <= 0:
+        return FitResult(max_size, text, "")
+    return _fit(text, font, round(width, 2), round(height, 2), max_size, min_size)
+
+# --- 3. FORM FILL ---
+_DA_SIZE = re.compile(r"(/[^\s/]+\s+)[\d.]+(\s+Tf)")
+
+def fit_pdf_map(template, pdf_map):
+    """
+    (values, sizes, overflow) for a pdf_map: the fitted value of every multiline text field, its
+    font size, and {field: (overflow text, form page)} for the ones that spill over.
+    """
+    fields = pdf_schema.load_schema(template)["fields"]
+    values, sizes, overflow = dict(pdf_map), {}, {}
+    for name, value in pdf_map.items():
+        f = fields.get(name)
+        if f is None or f["type"] != "text" or not f["multiline"] or not isinstance(value, str):
+            continue
+        fit = fit_text(value, f["rect"], f["font"] or "Helv")
+        values[name], sizes[name] = fit.text, fit.size
+        if fit.overflow:
+            overflow[name] = (fit.overflow, f["page"])
+    return values, sizes, overflow
+
+def _set_font_sizes(writer, sizes):
+    """Writes the fitted sizes into the widgets' /DA (the viewer and pypdf's appearance both read it)"""
+    from pypdf.generic import NameObject, TextStringObject
+    for page in writer.pages:
+        for ref in page.get("/Annots") or []:
+            annot = ref.get_object()
+            name = annot.get("/T") or (annot.get("/Parent").get_object().get("/T") if annot.get("/Parent") else None)
+            if name is None or str(name) not in sizes:
+                continue
+            da = str(annot.get("/DA") or (annot.get("/Parent").get_object().get("/DA", "") if annot.get("/Parent") else "")) or "/Helv 0 Tf 0 g"
+            annot[NameObject("/DA")] = TextStringObject(_DA_SIZE.sub(lambda m: f"{m.group(1)}{sizes[str(name)]:g}{m.group(2)}", da, count=1))
+
+def fill_form(writer, template, pdf_map):
+    """
+    Fills every page of writer with pdf_map, multiline text fields fitted to their rect.
+    Returns {field: (overflow text, form page)}; pass it to append_continuation() once the
+    writer has all its other pages.
+    """
+    values, sizes, overflow = fit_pdf_map(template, pdf_map)
+    _set_font_sizes(writer, sizes)
+    for page in writer.pages:
+        writer.update_page_form_field_values(page, values)
+    return overflow
+
+def continuation_pdf(overflow, labels=None):
+    """ReportLab continuation pages (BytesIO) with the overflow of every field, in form order"""
+    from xml.sax.saxutils import escape
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    labels = labels or {}
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=letter, leftMargin=36, rightMargin=36, topMargin=36, bottomMargin=36)
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle('ContTitle', parent=styles['Normal'], fontName='Helvetica-Bold', fontSize=9,
+                                 leading=11, textColor=colors.HexColor('#002060'), spaceAfter=4)
+    body_style = ParagraphStyle('ContBody', parent=styles['Normal'], fontName='Helvetica', fontSize=MAX_SIZE,
+                                leading=MAX_SIZE * LEADING, spaceAfter=6)
+    story = []
+    for name, (text, page) in sorted(overflow.items(), key=lambda kv: (kv[1][1], pdf_schema._natural(kv[0]))):
+        story.append(Paragraph(escape(f"Continuation of {labels.get(name, name)} (page {page})"), title_style))
+        for para in re.split(r"\n\s*\n", text):
+            story.append(Paragraph(escape(para.strip()).replace("\n", "<br/>"), body_style))
+        story.append(Spacer(1, 8))
+    doc.build(story)
+    buf.seek(0)
+    return buf
+
+def append_continuation(writer, overflow, labels=None):
+    """Appends the continuation pages of the overflowed fields to writer (nothing when there is none)"""
+    if not overflow:
+        return 0
+    from pypdf import PdfReader
+    reader = PdfReader(continuation_pdf(overflow, labels))
+    for page in reader.pages:
+        writer.add_page(page)
+    return len(reader.pages)
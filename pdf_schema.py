@@ -0,0 +1,239 @@
+# filename: pdf_schema.py
+"""
+Typed AcroForm schema of the PDF templates, and the pdf_map contract check built on it.
+extract_schema() reads every form field of a template: name, type (text / checkbox / radio /
+choice / signature / button), page, rect, font and font size (0 = auto), max length, multiline
+flag and, for check boxes and radios, their on-states. The schema is cached as JSON next to the
+template ('<template>.schema.json') and re-extracted when the template's sha256 changes.
+
+validate_pdf_map() runs when a pdf_map is loaded into its template (report_service and em_logic)
+and rejects keys the template does not have, check box values that are not one of the box's
+states and text longer than the field's max length. pypdf silently skips unknown keys, so a
+misspelled or renumbered field used to leave a blank box in the report.
+
+    python pdf_schema.py                                 # (re)build every template schema
+    python pdf_schema.py "EM OOS P1 template.pdf" --fields
+"""
+import io
+import os
+import re
+import sys
+import json
+import hashlib
+import difflib
+
+# --- 1. CONFIG ---
+SCHEMA_SUFFIX = ".schema.json"
+SCHEMA_VERSION = 1
+
+FIELD_TYPES = {"/Tx": "text", "/Ch": "choice", "/Sig": "signature"}
+FF_MULTILINE = 1 << 12
+FF_RADIO = 1 << 15
+FF_PUSHBUTTON = 1 << 16
+FF_COMB = 1 << 24
+OFF_VALUES = ("", "/Off", "Off", None)
+_DA_FONT = re.compile(r"/([^\s/]+)\s+([\d.]+)\s+Tf")
+
+class PdfMapError(ValueError):
+    pass
+
+def _natural(name):
+    return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", name)]
+
+# --- 2. EXTRACTION ---
+def _inherited(annot, key):
+    """A field attribute from the widget or the nearest parent field that sets it"""
+    node = annot
+    while node is not None:
+        if key in node:
+            return node[key]
+        node = node.get("/Parent")
+        node = node.get_object() if node is not None else None
+    return None
+
+def _full_name(annot):
+    parts, node = [], annot
+    while node is not None:
+        if "/T" in node:
+            parts.append(str(node["/T"]))
+        node = node.get("/Parent")
+        node = node.get_object() if node is not None else None
+    return ".".join(reversed(parts))
+
+def _field_type(ft, flags):
+    if ft == "/Btn":
+        return "button" if flags & FF_PUSHBUTTON else "radio" if flags & FF_RADIO else "checkbox"
+    return FIELD_TYPES.get(ft, "unknown")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def extract_schema(path, data=None):
+    """{"template", "sha256", "version", "pages", "fields": {name: {...}}} read from the PDF's widgets
+    (from data instead of the file when the bytes are given, e.g. a registry blob)"""
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data) if data is not None else path)
+    acro = reader.trailer["/Root"].get("/AcroForm")
+    default_da = str(acro.get_object().get("/DA", "")) if acro is not None else ""
+    fields = {}
+    for page_no, page in enumerate(reader.pages, start=1):
+        for ref in page.get("/Annots") or []:
+            annot = ref.get_object()
+            if annot.get("/Subtype") != "/Widget":
+                continue
+            name = _full_name(annot)
+            if not name:
+                continue
+            flags = int(_inherited(annot, "/Ff") or 0)
+            rect = [round(float(v), 2) for v in annot.get("/Rect", [0, 0, 0, 0])]
+            ap = annot.get("/AP")
+            states = sorted(str(k) for k in ap.get_object().get("/N", {}).keys() if k != "/Off") if ap is not None and hasattr(ap.get_object().get("/N"), "keys") else []
+            if name in fields:  # one field, several widgets (same name on several pages, radio kids)
+                f = fields[name]
+                f["widgets"] += 1
+                f["states"] = sorted(set(f["states"]) | set(states))
+                continue
+            ftype = _field_type(_inherited(annot, "/FT"), flags)
+            m = _DA_FONT.search(str(_inherited(annot, "/DA") or default_da))
+            max_len = _inherited(annot, "/MaxLen")
+            fields[name] = {
+                "type": ftype,
+                "page": page_no,
+                "rect": rect,
+                "font": m.group(1) if m else "",
+                "font_size": float(m.group(2)) if m else 0.0,
+                "max_len": int(max_len) if max_len is not None else None,
+                "multiline": bool(flags & FF_MULTILINE) if ftype == "text" else False,
+                "comb": bool(flags & FF_COMB) if ftype == "text" else False,
+                "states": states if ftype in ("checkbox", "radio") else [],
+                "widgets": 1,
+            }
+    digest = hashlib.sha256(data).hexdigest() if data is not None else file_sha256(path)
+    return {"template": os.path.basename(path), "sha256": digest, "version": SCHEMA_VERSION,
+            "pages": len(reader.pages), "fields": {k: fields[k] for k in sorted(fields, key=_natural)}}
+
+# --- 3. CACHE (JSON next to the template) ---
+def dump_schema(schema):
+    """JSON with one line per field, so a template change shows up as a readable diff"""
+    head = {k: v for k, v in schema.items() if k != "fields"}
+    lines = [f'  {json.dumps(k)}: {json.dumps(v)},' for k, v in head.items()]
+    body = ",\n".join(f"    {json.dumps(n)}: {json.dumps(f)}" for n, f in schema["fields"].items())
+    return "{\n" + "\n".join(lines) + '\n  "fields": {\n' + body + "\n  }\n}\n"
+
+_SCHEMAS = {}  # abspath -> (mtime, schema)
+_BLOB_SCHEMAS = {}  # sha256 -> schema; content-addressed, so never stale
+
+def schema_path(template):
+    return template + SCHEMA_SUFFIX
+
+def _read_cache(path, digest):
+    try:
+        with open(schema_path(path), encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("sha256") == digest and cached.get("version") == SCHEMA_VERSION:
+            return cached
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _write_cache(path, schema):
+    try:
+        with open(schema_path(path), "w", encoding="utf-8") as f:
+            f.write(dump_schema(schema))
+    except OSError:
+        pass  # read-only checkout: the schema is still used from memory
+
+def blob_schema(data, sha256, template):
+    """Schema of the exact bytes being filled (a registry blob), whatever the file on disk holds now.
+    The JSON cache next to the template is used (and refreshed) only while it describes those bytes."""
+    schema = _BLOB_SCHEMAS.get(sha256)
+    if schema is not None:
+        return schema
+    path = os.path.abspath(template)
+    schema = _read_cache(path, sha256)
+    if schema is None:
+        schema = extract_schema(path, data)
+        if os.path.exists(path) and file_sha256(path) == sha256:
+            _write_cache(path, schema)
+    _BLOB_SCHEMAS[sha256] = schema
+    return schema
+
+def load_schema(template):
+    """Schema of a template: memory, then the JSON cache (if its sha256 still matches), then extraction.
+    An already loaded schema (blob_schema()) is returned as is."""
+    if isinstance(template, dict):
+        return template
+    path = os.path.abspath(template)
+    mtime = os.path.getmtime(path)
+    hit = _SCHEMAS.get(path)
+    if hit and hit[0] == mtime:
+        return hit[1]
+    schema = _read_cache(path, file_sha256(path))
+    if schema is None:
+        schema = extract_schema(path)
+        _write_cache(path, schema)
+    _SCHEMAS[path] = (mtime, schema)
+    return schema
+
+def field_names(template, ftype=None):
+    """Field names of a template in natural order (only one type when ftype is given)"""
+    return [n for n, f in load_schema(template)["fields"].items() if ftype is None or f["type"] == ftype]
+
+# --- 4. PDF_MAP CONTRACT ---
+def check_pdf_map(template, pdf_map):
+    """[problem, ...] of a pdf_map against the template's schema (empty when every key fits);
+    template is a path or a loaded schema"""
+    schema = load_schema(template)
+    fields = schema["fields"]
+    problems = []
+    for key, value in pdf_map.items():
+        f = fields.get(key)
+        if f is None:
+            close = difflib.get_close_matches(key, fields, n=1)
+            problems.append(f"'{key}' is not a field of {schema['template']}" + (f" (did you mean '{close[0]}'?)" if close else ""))
+        elif f["type"] in ("checkbox", "radio"):
+            if value not in OFF_VALUES and value not in f["states"] and f"/{value}" not in f["states"]:
+                problems.append(f"'{key}' is a {f['type']}: value {value!r} is not one of {f['states'] + ['/Off']}")
+        elif f["max_len"] is not None and len(str(value)) > f["max_len"]:
+            problems.append(f"'{key}' holds at most {f['max_len']} characters, got {len(str(value))}")
+    return problems
+
+def validate_pdf_map(template, pdf_map):
+    """Raises PdfMapError listing every problem of the pdf_map (the form is not filled with it)"""
+    problems = check_pdf_map(template, pdf_map)
+    if problems:
+        raise PdfMapError(f"pdf_map does not match {load_schema(template)['template']}: " + "; ".join(problems))
+
+# --- 5. CLI ---
+def _print_fields(schema):
+    print(f"{'field':<16} {'type':<9} {'page':>4}  {'rect':<32} {'font':<10} {'size':>5} {'max':>5}  flags")
+    for name, f in schema["fields"].items():
+        flags = ",".join(x for x in ("multiline", "comb") if f[x]) + (f" states={'|'.join(f['states'])}" if f["states"] else "")
+        rect = "[" + ", ".join(f"{v:.1f}" for v in f["rect"]) + "]"
+        print(f"{name:<16} {f['type']:<9} {f['page']:>4}  {rect:<32} {f['font']:<10} {f['font_size']:>5g} {f['max_len'] or '-':>5}  {flags}")
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract / cache the AcroForm schema of the PDF templates")
+    parser.add_argument("templates", nargs="*", help="PDF templates (default: every .pdf next to this script)")
+    parser.add_argument("--fields", action="store_true", help="print the field table")
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    templates = args.templates or sorted(os.path.join(here, n) for n in os.listdir(here) if n.endswith(".pdf"))
+    for path in templates:
+        schema = load_schema(path)
+        counts = {}
+        for f in schema["fields"].values():
+            counts[f["type"]] = counts.get(f["type"], 0) + 1
+        print(f"[+] {os.path.basename(path)}: {schema['pages']} pages, {len(schema['fields'])} fields ("
+              + ", ".join(f"{n} {t}" for t, n in sorted(counts.items())) + f") -> {os.path.basename(schema_path(path))}")
+        if args.fields:
+            _print_fields(schema)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,254 @@
+# filename: processing_log.py
+"""
+Local sample-processing log index (SQLite).
+One row per processed sample keyed by (analyst, process date, BSC, manifold run), so the
+cross-contamination section (which samples that day, in what order, which were positive)
+comes from a single indexed query instead of manual entry.
+"""
+import os
+import re
+import sqlite3
+from collections import Counter
+
+from em_store import parse_date, read_spreadsheet
+
+# --- 1. CONFIG & SCHEMA ---
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "processing_log.db")
+DB_ENV = "PROCESSING_LOG_DB"  # overrides DB_FILE (load_test / golden scratch runs)
+MAX_OTHER_POSITIVES = 19  # "Total Positive Samples that day" input is capped at 20
+MAX_ORDER = 99             # the "Order" inputs are capped at 99
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_samples (
+    sample_id    TEXT NOT NULL,
+    analyst      TEXT NOT NULL,          -- upper-case initials or name as logged
+    process_date TEXT NOT NULL,          -- ISO YYYY-MM-DD
+    bsc          TEXT NOT NULL DEFAULT '', -- 4-digit E-number
+    manifold_run INTEGER NOT NULL DEFAULT 0,
+    seq          INTEGER NOT NULL,       -- processing order of the analyst's day (1-based)
+    positive     INTEGER NOT NULL DEFAULT 0,
+    test_method  TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (sample_id, process_date)
+);
+CREATE INDEX IF NOT EXISTS ix_processing_day ON processed_samples (analyst, process_date, bsc, manifold_run, seq);
+"""
+
+# Spreadsheet header aliases -> column
+COLUMN_ALIASES = {
+    "sample_id": ["sample id", "sample", "sample #", "eagle id"],
+    "analyst": ["analyst", "processor", "analyst initials", "processor initials"],
+    "process_date": ["date", "process date", "test date", "processing date"],
+    "bsc": ["bsc", "bsc id", "hood", "equipment"],
+    "manifold_run": ["manifold run", "run", "manifold", "run #"],
+    "seq": ["order", "processing order", "sequence", "seq"],
+    "positive": ["result", "positive", "outcome", "growth"],
+    "test_method": ["test method", "method", "test"],
+}
+
+def db_file():
+    """The processing log path: $PROCESSING_LOG_DB if set, else DB_FILE next to this module"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    """Opens (and creates if needed) the processing log index"""
+    conn = sqlite3.connect(db_path or db_file())
+    conn.executescript(SCHEMA)
+    return conn
+
+# --- 2. NORMALIZATION ---
+def normalize_analyst(text):
+    return re.sub(r"\s+", " ", str(text or "")).strip().upper()
+
+def normalize_bsc(text):
+    m = re.search(r"(\d{4})\s*$", str(text or "").strip())
+    return m.group(1) if m else str(text or "").strip()
+
+def normalize_sample_id(text):
+    return re.sub(r"\s+", "", str(text or "")).upper()
+
+def normalize_result(value):
+    """Positive / Growth / Yes / 1 -> 1, anything else -> 0"""
+    t = str(value or "").strip().lower()
+    if not t or t.startswith(("neg", "no")) or t in ("0", "pass", "ng"):
+        return 0
+    return 1 if t.startswith(("pos", "grow", "yes", "fail", "oos")) or t == "1" else 0
+
+def _to_int(value, default=0):
+    m = re.search(r"\d+", str(value or ""))
+    return int(m.group(0)) if m else default
+
+# --- 3. WRITE ---
+def record_sample(sample_id, analyst, process_date, seq, positive=False, bsc="", manifold_run=0, test_method="", db_path=None):
+    """Adds or updates one processed sample"""
+    d, sid = parse_date(process_date), normalize_sample_id(sample_id)
+    if not d or not sid or not analyst:
+        return False
+    conn = connect(db_path)
+    try:
+        conn.execute("INSERT OR REPLACE INTO processed_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (sid, normalize_analyst(analyst), d.isoformat(), normalize_bsc(bsc),
+                      _to_int(manifold_run), _to_int(seq, 1), 1 if positive else 0, test_method))
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def normalize_row(raw, day_counter, default_method=""):
+    """
+    Converts one spreadsheet row into a processed_samples record, or None if unusable.
+    Rows without an explicit order are numbered in file order within each analyst/day (day_counter is a Counter).
+    """
+    lowered = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+    rec = {col: next((lowered[a] for a in aliases if lowered.get(a) not in (None, "")), "")
+           for col, aliases in COLUMN_ALIASES.items()}
+    d, sid, analyst = parse_date(rec["process_date"]), normalize_sample_id(rec["sample_id"]), normalize_analyst(rec["analyst"])
+    if not d or not sid or not analyst:
+        return None
+    day = (analyst, d.isoformat())
+    day_counter[day] += 1
+    return (sid, analyst, d.isoformat(), normalize_bsc(rec["bsc"]), _to_int(rec["manifold_run"]),
+            _to_int(rec["seq"], day_counter[day]), normalize_result(rec["positive"]),
+            rec["test_method"] or default_method)
+
+def upsert_samples(conn, records):
+    """Inserts or replaces normalized records (no commit); returns the number written"""
+    records = [r for r in records if r]
+    conn.executemany("INSERT OR REPLACE INTO processed_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+    return len(records)
+
+def import_processing_log(path, default_method="", db_path=None):
+    """Loads an exported processing log (CSV / XLSX) into the index; returns the number of rows imported"""
+    day_counter = Counter()
+    conn = connect(db_path)
+    try:
+        n = upsert_samples(conn, (normalize_row(r, day_counter, default_method) for r in read_spreadsheet(path)))
+        conn.commit()
+    finally:
+        conn.close()
+    return n
+
+# --- 4. READ ---
+def processing_day(analyst, process_date, db_path=None):
+    """All samples the analyst processed that day in processing order: [{sample_id, bsc, manifold_run, seq, positive}]"""
+    d = parse_date(process_date)
+    if not d or not analyst:
+        return []
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT sample_id, bsc, manifold_run, seq, positive FROM processed_samples "
+            "WHERE analyst = ? AND process_date = ? ORDER BY seq, bsc, manifold_run",
+            (normalize_analyst(analyst), d.isoformat())).fetchall()
+    finally:
+        conn.close()
+    return [{"sample_id": r[0], "bsc": r[1], "manifold_run": r[2], "seq": r[3], "positive": bool(r[4])} for r in rows]
+
+def shared_run_conflicts(day, sample_id):
+    """
+    Other positives that share a BSC manifold run with the sample or were processed right before/after it.
+    The cross-contamination paragraph states neither happened, so these need a reviewer's attention.
+    """
+    sid = normalize_sample_id(sample_id)
+    current = next((r for r in day if r["sample_id"] == sid), None)
+    if not current:
+        return []
+    return [r["sample_id"] for r in day if r["positive"] and r["sample_id"] != sid and (
+        abs(r["seq"] - current["seq"]) <= 1 or
+        (r["manifold_run"] and r["bsc"] == current["bsc"] and r["manifold_run"] == current["manifold_run"]))]
+
+def order_conflicts(day, sample_id):
+    """
+    The sample and other positives whose processing order does not fit the 1-99 "Order" inputs;
+    their order is left for the reviewer instead of being filled in.
+    """
+    sid = normalize_sample_id(sample_id)
+    return [r["sample_id"] for r in day if (r["positive"] or r["sample_id"] == sid) and not 1 <= r["seq"] <= MAX_ORDER]
+
+def cross_contam_fields(analyst, process_date, sample_id, db_path=None):
+    """
+    session_state values for the Cross Contamination section
+    (other_positives / total_pos_count_num / current_pos_order / other_id_i / other_order_i).
+    Returns {} when the sample is not in the log for that analyst/day; orders outside 1-99 are left out.
+    """
+    day = processing_day(analyst, process_date, db_path=db_path)
+    sid = normalize_sample_id(sample_id)
+    current = next((r for r in day if r["sample_id"] == sid), None)
+    if not current:
+        return {}
+    others = [r for r in day if r["positive"] and r["sample_id"] != sid][:MAX_OTHER_POSITIVES]
+    if not others:
+        return {"other_positives": "No"}
+    fields = {"other_positives": "Yes", "total_pos_count_num": len(others) + 1}
+    if 1 <= current["seq"] <= MAX_ORDER:
+        fields["current_pos_order"] = current["seq"]
+    for i, r in enumerate(others):
+        fields[f"other_id_{i}"] = r["sample_id"]
+        if 1 <= r["seq"] <= MAX_ORDER:
+            fields[f"other_order_{i}"] = r["seq"]
+    return fields
+
+# Cross Contamination inputs at the pages' initial values (other_id_i / other_order_i only where present)
+CROSS_CONTAM_DEFAULTS = {"other_positives": "No", "total_pos_count_num": 1, "current_pos_order": 1}
+
+def reset_cross_contam(state):
+    """Puts the Cross Contamination inputs back to their initial values"""
+    state.update(CROSS_CONTAM_DEFAULTS)
+    for i in range(MAX_OTHER_POSITIVES):
+        for k, v in ((f"other_id_{i}", "N/A"), (f"other_order_{i}", 1)):
+            if k in state:
+                state[k] = v
+
+def dropped_positives(day, sample_id):
+    """Other positives of the day beyond the MAX_OTHER_POSITIVES the form holds"""
+    sid = normalize_sample_id(sample_id)
+    return [r["sample_id"] for r in day if r["positive"] and r["sample_id"] != sid][MAX_OTHER_POSITIVES:]
+
+def auto_fill_cross_contam(state, process_date, db_path=None):
+    """
+    Runs the processing-day lookup once per opened case (analyst + date + sample) and fills the
+    Cross Contamination fields when the sample is in the log; values filled for the previous case are
+    reset when the new one is not in the log. Returns {"shared_run", "order", "dropped"} sample IDs
+    (see conflict_messages).
+    """
+    signature = (state.get("analyst_initial", "") or state.get("analyst_name", ""), process_date or "", state.get("sample_id", ""))
+    if not all(signature) or state.get("_cross_contam_lookup") == list(signature):
+        return state.get("_cross_contam_conflicts", {})
+    state["_cross_contam_lookup"] = list(signature)
+    if state.pop("_cross_contam_filled", False):
+        reset_cross_contam(state)  # filled from the log for the previous case (manual entries are kept)
+    conflicts = {}
+    for analyst in dict.fromkeys(a for a in (state.get("analyst_initial", ""), state.get("analyst_name", "")) if a):
+        fields = cross_contam_fields(analyst, signature[1], signature[2], db_path=db_path)
+        if fields:
+            for k, v in fields.items():
+                state[k] = v
+            for k in ["current_pos_order"] + [f"other_order_{i}" for i in range(fields.get("total_pos_count_num", 1) - 1)]:
+                if k not in fields:
+                    state.pop(k, None)  # order out of the input's range: the reviewer fills it in
+            state["_cross_contam_filled"] = True
+            day = processing_day(analyst, signature[1], db_path=db_path)
+            conflicts = {"shared_run": shared_run_conflicts(day, signature[2]),
+                         "order": order_conflicts(day, signature[2]),
+                         "dropped": dropped_positives(day, signature[2])}
+            break
+    state["_cross_contam_conflicts"] = conflicts
+    return conflicts
+
+def conflict_messages(conflicts):
+    """One reviewer warning per kind of conflict returned by auto_fill_cross_contam"""
+    messages = []
+    if conflicts.get("shared_run"):
+        messages.append(f"Processing log: positive sample(s) {', '.join(conflicts['shared_run'])} shared a manifold run with this "
+                        "sample or were processed right before or after it. Review before using the cross-contamination statement.")
+    if conflicts.get("order"):
+        messages.append(f"Processing log: the processing order of {', '.join(conflicts['order'])} is outside 1-{MAX_ORDER}, "
+                        "so it was not filled in. Enter it by hand.")
+    if conflicts.get("dropped"):
+        messages.append(f"Processing log: {len(conflicts['dropped'])} more positive sample(s) that day than the form holds "
+                        f"({MAX_OTHER_POSITIVES} others): {', '.join(conflicts['dropped'])} not listed.")
+    return messages
+
+if __name__ == "__main__":
+    import sys
+    for export_path in sys.argv[1:]:
+        print(f"[+] {export_path}: imported {import_processing_log(export_path)} processed samples into {db_file()}")
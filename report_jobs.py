@@ -0,0 +1,273 @@
+# filename: report_jobs.py
+"""
+Persistent background queue for report generation (SQLite, WAL mode).
+A job is a report_service payload split into stages (one per artifact; the EM field payload is a
+single stage). Background worker threads render the stages in order, record progress after each
+one and keep the finished artifacts in the store. Pages poll while the user keeps editing, and a
+job stays retrievable by its ID after navigating away. Submitting the same payload again for the
+same owner returns the existing job instead of rendering twice.
+"""
+import io
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import report_service
+
+# --- 1. CONFIG & SCHEMA ---
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "report_jobs.db")
+DB_ENV = "REPORT_JOBS_DB"  # overrides DB_FILE (load_test / golden scratch runs)
+WORKERS = 2
+IDLE_WAIT = 5          # seconds a worker sleeps when the queue is empty (submit wakes it at once)
+STALE_SECONDS = 600    # a 'running' job not updated for this long lost its worker and is requeued
+POLL_SECONDS = 1.5     # page progress panel refresh
+KEEP_DAYS = 7
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_jobs (
+    job_id       TEXT PRIMARY KEY,
+    module       TEXT NOT NULL,
+    owner        TEXT NOT NULL DEFAULT '',
+    label        TEXT NOT NULL DEFAULT '',   -- file name stem for the artifacts
+    digest       TEXT NOT NULL,              -- sha256 of module + payload
+    status       TEXT NOT NULL,              -- queued / running / done / failed
+    stages_total INTEGER NOT NULL,
+    stages_done  INTEGER NOT NULL DEFAULT 0,
+    stage        TEXT NOT NULL DEFAULT '',   -- stage being rendered
+    errors       TEXT NOT NULL DEFAULT '[]', -- JSON list of messages
+    stages       TEXT NOT NULL,              -- JSON [[stage name, payload], ...]
+    created      TEXT NOT NULL,
+    updated      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_report_jobs_owner ON report_jobs (owner, module, created);
+CREATE INDEX IF NOT EXISTS ix_report_jobs_status ON report_jobs (status, created);
+CREATE TABLE IF NOT EXISTS report_artifacts (
+    job_id TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    data   BLOB NOT NULL,
+    PRIMARY KEY (job_id, name)
+) WITHOUT ROWID;
+"""
+
+def db_file():
+    """The job queue path: $REPORT_JOBS_DB if set, else DB_FILE next to this module"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    conn = sqlite3.connect(db_path or db_file(), timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+# --- 2. SUBMIT ---
+def split_stages(payload):
+    """[(stage name, payload)] - one stage per docx / pdf spec, the EM field payload as one stage"""
+    if "fields" in payload:
+        return [("report", payload)]
+    return [(spec.get("label") or spec.get("name") or kind, {kind: [spec]})
+            for kind in ("docx", "pdf") for spec in payload.get(kind, [])]
+
+def submit(module, payload, owner="", label="", db_path=None, start=True):
+    """Queues a job and returns its ID (the existing job's ID when this owner already submitted the same payload)"""
+    payload = json.loads(json.dumps(payload, default=str))
+    digest = hashlib.sha256(json.dumps([module, payload], sort_keys=True).encode("utf-8")).hexdigest()
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT job_id FROM report_jobs WHERE owner = ? AND digest = ? AND status != 'failed' "
+                           "ORDER BY created DESC LIMIT 1", (owner, digest)).fetchone()
+        if row:
+            return row[0]
+        job_id = uuid.uuid4().hex[:16]
+        stages = split_stages(payload)
+        now = _now()
+        with conn:
+            conn.execute("INSERT INTO report_jobs (job_id, module, owner, label, digest, status, stages_total, stages, created, updated) "
+                         "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                         (job_id, module, owner, label, digest, len(stages), json.dumps(stages), now, now))
+    finally:
+        conn.close()
+    if start:
+        start_workers(db_path=db_path)
+    _wake.set()
+    return job_id
+
+# --- 3. WORKERS ---
+_wake = threading.Event()
+_workers = {}  # db_path -> [threads]
+_workers_lock = threading.Lock()
+
+def _claim(conn):
+    """Atomically moves the oldest queued job to 'running'; (job_id, module, stages) or None"""
+    with conn:
+        row = conn.execute("UPDATE report_jobs SET status = 'running', updated = ? WHERE job_id = "
+                           "(SELECT job_id FROM report_jobs WHERE status = 'queued' ORDER BY created LIMIT 1) "
+                           "RETURNING job_id, module, stages", (_now(),)).fetchone()
+    return (row[0], row[1], json.loads(row[2])) if row else None
+
+def requeue_stale(conn, stale_seconds=STALE_SECONDS):
+    cutoff = (datetime.now() - timedelta(seconds=stale_seconds)).isoformat(timespec="seconds")
+    with conn:
+        return conn.execute("UPDATE report_jobs SET status = 'queued', stages_done = 0, stage = '' "
+                            "WHERE status = 'running' AND updated < ?", (cutoff,)).rowcount
+
+def run_job(conn, job_id, module, stages):
+    """Renders every stage through report_service, recording progress and artifacts after each one"""
+    errors = []
+    try:
+        for i, (name, payload) in enumerate(stages):
+            with conn:
+                conn.execute("UPDATE report_jobs SET stage = ?, updated = ? WHERE job_id = ?", (name, _now(), job_id))
+            artifacts, errs = report_service.render(module, payload)
+            errors.extend(errs)
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO report_artifacts VALUES (?, ?, ?)",
+                                 [(job_id, k, v.getvalue()) for k, v in artifacts.items()])
+                conn.execute("UPDATE report_jobs SET stages_done = ?, errors = ?, updated = ? WHERE job_id = ?",
+                             (i + 1, json.dumps(errors), _now(), job_id))
+        status = "done"
+    except Exception as e:
+        errors.append(f"Job Error: {e}")
+        status = "failed"
+    with conn:
+        conn.execute("UPDATE report_jobs SET status = ?, stage = '', errors = ?, updated = ? WHERE job_id = ?",
+                     (status, json.dumps(errors), _now(), job_id))
+    return status
+
+def run_pending(db_path=None, stop=None):
+    """Worker loop: claims and runs jobs until stop is set (runs forever without one)"""
+    conn = connect(db_path)
+    try:
+        requeue_stale(conn)
+        while stop is None or not stop.is_set():
+            job = _claim(conn)
+            if job is None:
+                _wake.wait(IDLE_WAIT)
+                _wake.clear()
+                continue
+            run_job(conn, *job)
+    finally:
+        conn.close()
+
+def start_workers(n=WORKERS, db_path=None):
+    """Starts the background worker threads of this process once (they live as long as the Streamlit server)"""
+    db_path = db_path or db_file()
+    with _workers_lock:
+        alive = [t for t in _workers.get(db_path, []) if t.is_alive()]
+        for i in range(len(alive), n):
+            t = threading.Thread(target=run_pending, args=(db_path,), name=f"report-job-{i}", daemon=True)
+            t.start()
+            alive.append(t)
+        _workers[db_path] = alive
+
+# --- 4. STATUS & ARTIFACTS ---
+_COLS = "job_id, module, owner, label, status, stages_total, stages_done, stage, errors, created, updated"
+
+def _job_dict(row):
+    job = dict(zip(_COLS.split(", "), row))
+    job["errors"] = json.loads(job["errors"])
+    job["progress"] = job["stages_done"] / job["stages_total"] if job["stages_total"] else 1.0
+    return job
+
+def job_status(job_id, db_path=None):
+    conn = connect(db_path)
+    try:
+        row = conn.execute(f"SELECT {_COLS} FROM report_jobs WHERE job_id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return _job_dict(row) if row else None
+
+def list_jobs(owner, module=None, limit=10, db_path=None):
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(f"SELECT {_COLS} FROM report_jobs WHERE owner = ? AND (? IS NULL OR module = ?) "
+                            "ORDER BY created DESC, rowid DESC LIMIT ?", (owner, module, module, limit)).fetchall()
+    finally:
+        conn.close()
+    return [_job_dict(r) for r in rows]
+
+def job_artifacts(job_id, db_path=None):
+    """{artifact name: BytesIO} of a job (the stages finished so far)"""
+    conn = connect(db_path)
+    try:
+        rows = conn.execute("SELECT name, data FROM report_artifacts WHERE job_id = ? ORDER BY name", (job_id,)).fetchall()
+    finally:
+        conn.close()
+    return {name: io.BytesIO(data) for name, data in rows}
+
+def artifact_filename(label, name):
+    """report.docx -> '<label>.docx', tables.pdf -> 'Tables <label>.pdf', p2.docx -> '<label> - P2.docx'"""
+    base, ext = os.path.splitext(name)
+    if base == "report":
+        return f"{label}{ext}"
+    if base == "tables":
+        return f"Tables {label}{ext}"
+    return f"{label} - {base.upper()}{ext}"
+
+def purge(days=KEEP_DAYS, db_path=None):
+    """Drops finished jobs (and their artifacts) older than `days`; returns the number removed"""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM report_artifacts WHERE job_id IN "
+                         "(SELECT job_id FROM report_jobs WHERE status IN ('done', 'failed') AND updated < ?)", (cutoff,))
+            return conn.execute("DELETE FROM report_jobs WHERE status IN ('done', 'failed') AND updated < ?", (cutoff,)).rowcount
+    finally:
+        conn.close()
+
+# --- 5. PAGE PANEL ---
+_MIME = {".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document", ".pdf": "application/pdf"}
+
+def render_job_panel(module, owner, job_ids=(), db_path=None):
+    """
+    Streamlit panel: progress of this owner's background jobs (polls while any is active, then reruns
+    the page once so the poll stops) and their downloads; the page's current jobs (job_ids, from its last Generate) are expanded.
+    """
+    import streamlit as st
+    db_path = db_path or db_file()
+    if not hasattr(st, "fragment") or not os.path.exists(db_path):
+        return
+    active = any(j["status"] in ("queued", "running") for j in list_jobs(owner, module, db_path=db_path))
+    current = [j for j in job_ids if j]
+
+    @st.fragment(run_every=POLL_SECONDS if active else None)
+    def _panel():
+        jobs = list_jobs(owner, module, db_path=db_path)
+        if active and not any(j["status"] in ("queued", "running") for j in jobs):
+            st.rerun()  # the last active job finished: a full rerun re-creates the panel without the timer
+        if not jobs:
+            return
+        st.markdown("### ⏳ Background Reports")
+        for job in jobs:
+            title = f"{job['label'] or job['module']} · {job['created'].replace('T', ' ')} · job {job['job_id']}"
+            if job["status"] in ("queued", "running"):
+                st.progress(job["progress"], text=f"{title}: {job['stage'] or job['status']} ({job['stages_done']}/{job['stages_total']})")
+                continue
+            with st.expander(f"{'✅' if job['status'] == 'done' else '❌'} {title}", expanded=job["job_id"] in current if current else job is jobs[0]):
+                for msg in job["errors"]:
+                    (st.warning if msg.startswith("⚠️") else st.error)(msg)
+                for name, buf in job_artifacts(job["job_id"], db_path).items():
+                    fname = artifact_filename(job["label"] or job["module"], name)
+                    st.download_button(f"⬇️ {fname}", buf, fname, _MIME.get(os.path.splitext(name)[1]),
+                                       key=f"_job_dl_{job['job_id']}_{name}", on_click="ignore")
+    _panel()
+
+if __name__ == "__main__":
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS
+    print(f"[+] Report job workers: {n} on {db_file()} (Ctrl+C to stop)")
+    start_workers(n)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
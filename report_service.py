@@ -0,0 +1,250 @@
+# filename: report_service.py
+"""
+Local report-generation service.
+POST /reports/{module} renders the DOCX / PDF artifacts of a case in a pool of worker processes
+that keep every template preloaded, so a slow PDF fill no longer blocks the Streamlit rerun that
+asked for it, and the pages, the CLI and other internal tools share one backend.
+
+Payload (JSON):
+    em only:     {"fields": {...}}  -- the Save Session field payload (em_logic.export_fields)
+    any module:  {"docx": [{"name", "label", "template": "usp71/p1/docx", "context": {...}}],
+                  "pdf":  [{"name", "label", "template": "usp71/p1/pdf", "fields": {...}, "labels": {...}}]}
+                 -- contexts / pdf_maps the page already assembled; "template" is a template_registry
+                 -- name ("templates": [file, ...] of older queued jobs still resolves, first registered wins);
+                 -- optional labels name the fields on the pdf_fit continuation page
+Response: {"artifacts": {name: base64}, "errors": [message, ...]}
+
+    python report_service.py serve --port 8765 --workers 2
+    python report_service.py render em SAVE_EM-001.txt --out reports/
+"""
+import os
+import io
+import sys
+import json
+import time
+import base64
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import template_registry
+
+# --- 1. CONFIG ---
+HOST = "127.0.0.1"
+PORT = 8765
+SERVICE_URL = os.environ.get("REPORT_SERVICE_URL", f"http://{HOST}:{PORT}")
+WORKERS = 2
+TEMPLATE_DIR = template_registry.TEMPLATE_DIR
+TEMPLATE_EXT = (".docx", ".pdf")
+RENDER_TIMEOUT = 120     # seconds per request
+RETRY_AFTER = 30         # seconds to keep rendering in-process after the service was unreachable
+MAX_BODY = 32 * 1024 * 1024
+
+# --- 2. TEMPLATES (template_registry: logical name -> content-addressed blob) ---
+def _template(name):
+    """Registry Template of a logical name ('usp71/p1/docx') or a bare file name; None when absent"""
+    if name in template_registry.MANIFEST:
+        return template_registry.resolve(name)
+    # Bare file names only: the service never reads outside the template directory
+    if os.path.dirname(name) or "\\" in name or not name.endswith(TEMPLATE_EXT):
+        raise ValueError(f"Invalid template name: {name!r}")
+    return template_registry.resolve_file(name)
+
+def template_exists(name):
+    return _template(name) is not None
+
+def load_template(name):
+    """Template as a fresh in-memory stream (DocxTemplate / PdfWriter(clone_from=...) accept it)"""
+    tpl = _template(name)
+    if tpl is None:
+        raise FileNotFoundError(f"⚠️ Could not find {name!r}.")
+    return io.BytesIO(template_registry.blob(tpl.sha256))
+
+def preload():
+    """Worker initializer: load every registered template and import the rendering stack once"""
+    import pdf_schema
+    loaded = 0
+    for key in template_registry.MANIFEST:
+        tpl = template_registry.resolve(key)
+        if tpl is None:
+            continue
+        data = template_registry.blob(tpl.sha256)
+        if key.endswith("/pdf"):
+            pdf_schema.blob_schema(data, tpl.sha256, tpl.path)
+        loaded += 1
+    import docxtpl, pypdf  # noqa: F401
+    try:
+        import em_logic  # noqa: F401
+    except ImportError:
+        pass
+    return loaded
+
+# --- 3. RENDERING (runs in the workers, or in-process as fallback) ---
+def _spec_template(spec):
+    """Template of a docx / pdf spec: its "template" key, or the first registered file of a legacy "templates" list"""
+    names = [spec["template"]] if "template" in spec else spec["templates"]
+    for name in names:
+        tpl = _template(name)
+        if tpl is not None:
+            return tpl
+    files = template_registry.MANIFEST.get(spec.get("template"), names)
+    raise FileNotFoundError(f"⚠️ Could not find {' or '.join(repr(n) for n in files)}.")
+
+def _render_docx(spec):
+    from docxtpl import DocxTemplate
+    tpl = _spec_template(spec)
+    doc = DocxTemplate(io.BytesIO(template_registry.blob(tpl.sha256)))
+    doc.render(spec.get("context", {}))
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+def _render_pdf(spec):
+    from pypdf import PdfWriter
+    import pdf_schema, pdf_fit
+    tpl = _spec_template(spec)
+    data = template_registry.blob(tpl.sha256)
+    schema = pdf_schema.blob_schema(data, tpl.sha256, tpl.path)  # the bytes being filled, not the file on disk
+    pdf_schema.validate_pdf_map(schema, spec.get("fields", {}))
+    writer = PdfWriter(clone_from=io.BytesIO(data))
+    overflow = pdf_fit.fill_form(writer, schema, spec.get("fields", {}))
+    pdf_fit.append_continuation(writer, overflow, spec.get("labels"))
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def render_job(module, payload):
+    """({artifact name: bytes}, [error messages]) for one payload"""
+    artifacts, errors = {}, []
+    if "fields" in payload:
+        if module != "em":
+            return artifacts, [f"Module {module!r} has no field payload renderer; send docx/pdf specs."]
+        import em_logic
+        docx_buf, pdf_buf = em_logic.generate_em_reports(payload["fields"], report_error=errors.append, load_template=load_template)
+        for name, buf in (("report.docx", docx_buf), ("report.pdf", pdf_buf)):
+            if buf is not None:
+                artifacts[name] = buf.getvalue()
+        return artifacts, errors
+    for kind, render_one in (("docx", _render_docx), ("pdf", _render_pdf)):
+        for i, spec in enumerate(payload.get(kind, [])):
+            name = spec.get("name") or f"{kind}_{i}.{kind}"
+            try:
+                artifacts[name] = render_one(spec)
+            except FileNotFoundError as e:
+                errors.append(str(e))
+            except Exception as e:
+                errors.append(f"{spec.get('label', name)} Error: {e}")
+    return artifacts, errors
+
+def _encode(artifacts, errors):
+    return {"artifacts": {k: base64.b64encode(v).decode("ascii") for k, v in artifacts.items()}, "errors": errors}
+
+def _decode(body):
+    return {k: io.BytesIO(base64.b64decode(v)) for k, v in body.get("artifacts", {}).items()}, list(body.get("errors", []))
+
+# --- 4. HTTP SERVER ---
+class _Handler(BaseHTTPRequestHandler):
+    def _send(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self._send(200, {"status": "ok", "workers": self.server.workers})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "reports" or not parts[1]:
+            return self._send(404, {"error": "use POST /reports/{module}"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            return self._send(413, {"error": "payload too large"})
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            return self._send(400, {"error": f"invalid JSON: {e}"})
+        try:
+            artifacts, errors = self.server.pool.submit(render_job, parts[1].lower(), payload).result(RENDER_TIMEOUT)
+        except Exception as e:
+            return self._send(500, {"error": str(e)})
+        self._send(200, _encode(artifacts, errors))
+
+def serve(host=HOST, port=PORT, workers=WORKERS):
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=preload)
+    # Start every worker now so the first request does not pay for the template preload
+    for f in [pool.submit(template_exists, "x.pdf") for _ in range(workers)]:
+        f.result()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.pool, server.workers = pool, workers
+    print(f"[+] Report service on http://{host}:{port} ({workers} workers, templates from {TEMPLATE_DIR})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown(cancel_futures=True)
+
+# --- 5. CLIENT (pages / CLI / tools) ---
+_down_until = 0.0
+
+def _normalize(payload):
+    # Same JSON round trip as the HTTP path, so both give identical output
+    return json.loads(json.dumps(payload, default=str))
+
+def render(module, payload, url=None):
+    """
+    ({artifact name: BytesIO}, [error messages]). Posts to the running service; when it is not
+    reachable the payload is rendered in-process with the same code and cached templates.
+    """
+    global _down_until
+    payload = _normalize(payload)
+    if time.monotonic() >= _down_until:
+        req = urllib.request.Request(f"{url or SERVICE_URL}/reports/{module}", data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=RENDER_TIMEOUT) as resp:
+                return _decode(json.loads(resp.read()))
+        except (OSError, ValueError):
+            _down_until = time.monotonic() + RETRY_AFTER
+    artifacts, errors = render_job(module, payload)
+    return {k: io.BytesIO(v) for k, v in artifacts.items()}, errors
+
+def _cli(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="OOS report-generation service")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_serve = sub.add_parser("serve", help="run the HTTP service")
+    p_serve.add_argument("--host", default=HOST)
+    p_serve.add_argument("--port", type=int, default=PORT)
+    p_serve.add_argument("--workers", type=int, default=WORKERS)
+    p_render = sub.add_parser("render", help="render payload files through the service")
+    p_render.add_argument("module")
+    p_render.add_argument("payloads", nargs="+", help="JSON payloads (an EM Save Session .txt is a field payload)")
+    p_render.add_argument("--out", default=".")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "serve":
+        return serve(args.host, args.port, args.workers)
+    os.makedirs(args.out, exist_ok=True)
+    for path in args.payloads:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+        if not ({"fields", "docx", "pdf"} & payload.keys()):
+            payload = {"fields": payload}
+        artifacts, errors = render(args.module, payload)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        for name, buf in artifacts.items():
+            with open(os.path.join(args.out, f"{stem} {name}"), "wb") as f:
+                f.write(buf.getvalue())
+        print(f"[+] {path}: {len(artifacts)} artifacts" + "".join(f"\n    {e}" for e in errors))
+
+if __name__ == "__main__":
+    _cli(sys.argv[1:])
@@ -8,11 +8,14 @@ import sys
 import subprocess
 import time
 from datetime import datetime, timedelta
+import narratives
+import justification
 
 # --- 1. 从中央后勤部 (utils.py) 调取共享工具 ---
 try:
-    from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative
+    from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative, fragment
 except ImportError:
+    def fragment(maxsize=None): return lambda fn: fn
     def u_grl(i): return "Unknown", "000", "", "Unknown"
     def get_full_name(i): return i
     def ordinal(n): return str(n)
@@ -97,30 +100,42 @@ def clean_filename(text):
     return re.sub(r'[\\/*?:"<>|]', '_', str(text)).strip() if text else ""
 
 # --- 4. TEXT GENERATION LOGIC (重型报告生成引擎) ---
-def generate_equipment_text():
-    t_room, t_suite, t_suffix, t_loc = u_grl(st.session_state.bsc_id)
-    c_room, c_suite, c_suffix, c_loc = u_grl(st.session_state.chgbsc_id)
+@fragment()
+def equipment_boilerplate(bsc_main, bsc_chg):
+    """Cleanroom + BSC cleaning / certification paragraphs; depend only on the two BSCs (cached, shared by P1 and the P2 retest)"""
+    t_room, t_suite, t_suffix, t_loc = u_grl(bsc_main)
+    c_room, c_suite, c_suffix, c_loc = u_grl(bsc_chg)
     
     t_suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
     c_suite_phrase = f"Suite {c_suite}{c_suffix}" if c_suite != "L-Suite" else "L-Suite"
     
-    if st.session_state.bsc_id == st.session_state.chgbsc_id:
+    if bsc_main == bsc_chg:
+        part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
+        return f"{part1}\n\nThe ISO 5 BSC E00{bsc_main}, located in the {t_loc}, ({t_suite_phrase}), was used for both testing and changeover steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{bsc_main} was certified and approved by both the Engineering and Quality Assurance teams."
+    if t_suite == c_suite:
         part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
-        part2 = f"The ISO 5 BSC E00{st.session_state.bsc_id}, located in the {t_loc}, ({t_suite_phrase}), was used for both testing and changeover steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{st.session_state.bsc_id} was certified and approved by both the Engineering and Quality Assurance teams. Sample processing and changeover were conducted in the ISO 5 BSC E00{st.session_state.bsc_id} in the {t_loc}, ({t_suite_phrase}) by {st.session_state.analyst_name} on {st.session_state.test_date}."
-        return f"{part1}\n\n{part2}"
     else:
-        if t_suite == c_suite:
-             part1 = get_cleanroom_narrative(t_suite, action_text="testing and changeover procedures", verb="comprises")
-        else:
-             p1a = get_cleanroom_narrative(t_suite, t_room=t_room, action_text="testing", verb="consists of")
-             p1b = get_cleanroom_narrative(c_suite, t_room=c_room, action_text="changeover", verb="consists of")
-             part1 = f"{p1a}\n\n{p1b}"
-        intro = f"The ISO 5 BSC E00{st.session_state.bsc_id}, located in the {t_loc}, ({t_suite_phrase}), and ISO 5 BSC E00{st.session_state.chgbsc_id}, located in the {c_loc}, ({c_suite_phrase}), were thoroughly cleaned and disinfected prior to their respective procedures in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Furthermore, the BSCs used throughout testing, E00{st.session_state.bsc_id} for sample processing and E00{st.session_state.chgbsc_id} for the changeover step, were certified and approved by both the Engineering and Quality Assurance teams."
-        if st.session_state.analyst_name == st.session_state.changeover_name:
-            usage_sent = f"Sample processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{st.session_state.bsc_id}) and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{st.session_state.chgbsc_id}) by {st.session_state.analyst_name} on {st.session_state.test_date}."
-        else:
-            usage_sent = f"Sample processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{st.session_state.bsc_id}) by {st.session_state.analyst_name} and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{st.session_state.chgbsc_id}) by {st.session_state.changeover_name} on {st.session_state.test_date}."
-        return f"{part1}\n\n{intro} {usage_sent}"
+        p1a = get_cleanroom_narrative(t_suite, t_room=t_room, action_text="testing", verb="consists of")
+        p1b = get_cleanroom_narrative(c_suite, t_room=c_room, action_text="changeover", verb="consists of")
+        part1 = f"{p1a}\n\n{p1b}"
+    return f"{part1}\n\nThe ISO 5 BSC E00{bsc_main}, located in the {t_loc}, ({t_suite_phrase}), and ISO 5 BSC E00{bsc_chg}, located in the {c_loc}, ({c_suite_phrase}), were thoroughly cleaned and disinfected prior to their respective procedures in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Furthermore, the BSCs used throughout testing, E00{bsc_main} for sample processing and E00{bsc_chg} for the changeover step, were certified and approved by both the Engineering and Quality Assurance teams."
+
+def equipment_text(bsc_main, bsc_chg, analyst_main, analyst_chg, date_val, subj="Sample"):
+    """Equipment paragraph: cached boilerplate + the per-case usage sentence"""
+    t_room, t_suite, t_suffix, t_loc = u_grl(bsc_main)
+    c_room, c_suite, c_suffix, c_loc = u_grl(bsc_chg)
+    t_suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
+    c_suite_phrase = f"Suite {c_suite}{c_suffix}" if c_suite != "L-Suite" else "L-Suite"
+    if bsc_main == bsc_chg:
+        usage_sent = f"{subj} processing and changeover were conducted in the ISO 5 BSC E00{bsc_main} in the {t_loc}, ({t_suite_phrase}) by {analyst_main} on {date_val}."
+    elif analyst_main == analyst_chg:
+        usage_sent = f"{subj} processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{bsc_main}) and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{bsc_chg}) by {analyst_main} on {date_val}."
+    else:
+        usage_sent = f"{subj} processing was conducted within the ISO 5 BSC in the innermost section of the cleanroom ({t_suite_phrase}, BSC E00{bsc_main}) by {analyst_main} and the changeover step was conducted within the ISO 5 BSC in the middle section of the cleanroom ({c_suite_phrase}, BSC E00{bsc_chg}) by {analyst_chg} on {date_val}."
+    return f"{equipment_boilerplate(bsc_main, bsc_chg)} {usage_sent}"
+
+def generate_equipment_text():
+    return equipment_text(st.session_state.bsc_id, st.session_state.chgbsc_id, st.session_state.analyst_name, st.session_state.changeover_name, st.session_state.test_date)
 
 def generate_history_text():
     if st.session_state.incidence_count == 0 or st.session_state.has_prior_failures == "No": phrase = "no prior failures"
@@ -182,32 +197,26 @@ def generate_narrative_and_details():
     if not is_fail(st.session_state.obs_air): pass_wk_clean.append("weekly active air sampling")
     if not is_fail(st.session_state.obs_room): pass_wk_clean.append("weekly surface sampling")
 
-    narr_parts = []
-    if pass_daily_clean:
-        d_str = f"{pass_daily_clean[0]}" if len(pass_daily_clean)==1 else f"{pass_daily_clean[0]} and {pass_daily_clean[1]}" if len(pass_daily_clean)==2 else f"{pass_daily_clean[0]}, {pass_daily_clean[1]}, and {pass_daily_clean[2]}"
-        narr_parts.append(f"no microbial growth was observed in {d_str}")
-    if pass_wk_clean:
-        w_str = f"{pass_wk_clean[0]}" if len(pass_wk_clean)==1 else f"{pass_wk_clean[0]} and {pass_wk_clean[1]}" if len(pass_wk_clean)==2 else ", ".join(pass_wk_clean)
-        narr_parts.append(f"Additionally, {w_str} showed no microbial growth" if narr_parts else f"no microbial growth was observed in {w_str}")
-    narr = "Upon analyzing the environmental monitoring results, " + ". ".join(narr_parts) + "." if narr_parts else "Upon analyzing the environmental monitoring results, microbial growth was observed in all sampled areas."
+    for f in failures:
+        f["plural"] = bool(re.search(r'\d+', f['obs']) and int(re.search(r'\d+', f['obs']).group()) > 1)
+        f["gram"] = "gram" in f['id'].lower()
+    facts = {"pass_daily": pass_daily_clean, "pass_weekly": pass_wk_clean, "failures": failures}
+    return narratives.render_all(("scan_em_narrative", "scan_em_details"), facts)
+
+# Fixed EM fields for the Smart Justification engine: (observation, organism ID, daily)
+SCAN_EM_FIELDS = (
+    ("obs_pers", "id_pers", True), ("obs_surf", "id_surf", True), ("obs_sett", "id_sett", True),
+    ("obs_air", "id_air_weekly", False), ("obs_room", "id_room_wk_of", False),
+)
+
+def scan_justification_case(state):
+    # ScanRDI reports the organism shape only, so the isolate-identity rule (Rule 1) is not evaluated
+    return justification.JustificationCase("ScanRDI", None, justification.fixed_field_failures(state, SCAN_EM_FIELDS),
+                                           justification.other_samples_clean(state))
 
-    det = ""
-    if failures:
-        daily_fails = [f["cat"] for f in failures if f['time'] == 'daily']
-        weekly_fails = [f["cat"] for f in failures if f['time'] == 'weekly']
-        intro_parts = []
-        if daily_fails: intro_parts.append(f"{' and '.join(daily_fails)} on the date")
-        if weekly_fails: intro_parts.append(f"{' and '.join(weekly_fails)} from week of testing")
-        fail_intro = f"However, microbial growth was observed during { ' and '.join(intro_parts) }." if intro_parts else ""
-        detail_sentences = []
-        for i, f in enumerate(failures):
-            is_plural = bool(re.search(r'\d+', f['obs']) and int(re.search(r'\d+', f['obs']).group()) > 1)
-            verb_detect = "were" if is_plural else "was"; noun_id = "organisms were" if is_plural else "organism was"
-            method_text = "differential staining" if "gram" in f['id'].lower() else "microbial identification"
-            base_sentence = f"{f['obs']} {verb_detect} detected during {f['cat']} and was submitted for {method_text} under sample ID {f['etx']}, where the {noun_id} identified as {f['id']}"
-            detail_sentences.append(f"Specifically, {base_sentence}." if i==0 else f"Additionally, {base_sentence}." if i==1 else f"Furthermore, {base_sentence}." if i==2 else f"Also, {base_sentence}.")
-        det = f"{fail_intro} {' '.join(detail_sentences)}"
-    return narr, det
+def generate_smart_justification():
+    """4-step shielding justification for EM excursions (empty when EM was clean); run after generate_narrative_and_details"""
+    return justification.justify(scan_justification_case(st.session_state))
 
 def create_table_pdf(data):
     from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
@@ -0,0 +1,353 @@
+# filename: state_store.py
+"""
+Per-session investigation state store (SQLite, WAL mode).
+Replaces the shared *_investigation_state.json files: every field is one row keyed by
+(module, owner, case), where owner is the user / browser session and case is the OOS ID,
+so concurrent sessions no longer overwrite each other. Saves upsert only the fields that
+changed since the last save, each batch in one transaction.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+from datetime import datetime
+
+# --- 1. CONFIG & SCHEMA ---
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "investigation_state.db")
+DB_ENV = "INVESTIGATION_STATE_DB"  # overrides DB_FILE (load_test / golden scratch runs)
+DRAFT_CASE = "draft"  # fields saved before an OOS ID is entered
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS case_fields (
+    module  TEXT NOT NULL,               -- ScanRDI / Celsis / USP71
+    owner   TEXT NOT NULL,               -- user or session id
+    case_id TEXT NOT NULL,               -- OOS number or 'draft'
+    field   TEXT NOT NULL,
+    value   TEXT NOT NULL,               -- JSON
+    updated TEXT NOT NULL,
+    PRIMARY KEY (module, owner, case_id, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS active_cases (
+    module  TEXT NOT NULL,
+    owner   TEXT NOT NULL,
+    case_id TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (module, owner)
+) WITHOUT ROWID;
+"""
+
+def db_file():
+    """The state store path: $INVESTIGATION_STATE_DB if set, else DB_FILE next to this module"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    """Opens the state store; WAL lets one session write while others read"""
+    conn = sqlite3.connect(db_path or db_file(), timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def case_key(oos_id):
+    """OOS-261401 / 261401 -> '261401'; empty -> draft"""
+    m = re.search(r"(\d+)", str(oos_id or ""))
+    return m.group(1) if m else DRAFT_CASE
+
+def owner_id():
+    """
+    Identifies the browser session: ?user=<name> if given, else a random id kept in the
+    page URL (?sid=...) so a refresh reopens the same state.
+    """
+    import streamlit as st
+    params = st.query_params
+    if params.get("user"):
+        return f"user:{params['user'].strip().lower()}"
+    if not params.get("sid"):
+        params["sid"] = uuid.uuid4().hex[:12]
+    return f"sid:{params['sid']}"
+
+# --- 2. LOW-LEVEL READ / WRITE ---
+def active_case(conn, module, owner):
+    row = conn.execute("SELECT case_id FROM active_cases WHERE module = ? AND owner = ?", (module, owner)).fetchone()
+    return row[0] if row else None
+
+def read_case(conn, module, owner, case_id):
+    rows = conn.execute("SELECT field, value FROM case_fields WHERE module = ? AND owner = ? AND case_id = ?",
+                        (module, owner, case_id)).fetchall()
+    return {f: json.loads(v) for f, v in rows}
+
+def write_fields(conn, module, owner, case_id, changes):
+    """Upserts changed fields and marks the case active, in one transaction; returns the number written"""
+    now = datetime.now().isoformat(timespec="seconds")
+    with conn:
+        conn.executemany(
+            "INSERT INTO case_fields VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (module, owner, case_id, field) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+            [(module, owner, case_id, k, json.dumps(v), now) for k, v in changes.items()])
+        conn.execute("INSERT OR REPLACE INTO active_cases VALUES (?, ?, ?, ?)", (module, owner, case_id, now))
+    return len(changes)
+
+# --- 3. SESSION HELPERS (used by the module pages) ---
+def _snapshot_key(module):
+    return f"_saved_fields_{module}"
+
+def load_session(state, module, field_keys, owner=None, db_path=None):
+    """Restores the owner's active case into session_state (existing keys only); returns the loaded dict"""
+    owner = owner or owner_id()
+    conn = connect(db_path)
+    try:
+        case_id = active_case(conn, module, owner)
+        data = read_case(conn, module, owner, case_id) if case_id else {}
+    finally:
+        conn.close()
+    for k, v in data.items():
+        if k in state and k in field_keys:
+            state[k] = v
+    state[_snapshot_key(module)] = {"case_id": case_id, "values": dict(data)}
+    return data
+
+def save_session(state, module, field_keys, owner=None, db_path=None):
+    """Writes the field_keys values that differ from the last save; returns the number of fields written"""
+    return save_values(state, module, {k: state[k] for k in field_keys if k in state}, owner, db_path)
+
+def save_values(state, module, values, owner=None, db_path=None):
+    """Like save_session for an explicit dict (e.g. parser results merged over the saved state)"""
+    owner = owner or owner_id()
+    snap = state.get(_snapshot_key(module)) or {"case_id": None, "values": {}}
+    case_id = case_key(values.get("oos_id", state.get("oos_id", "")))
+    moved = case_id != snap["case_id"]
+    saved = {} if moved else snap["values"]
+    changes = {k: v for k, v in values.items() if k not in saved or saved[k] != v}
+    if not changes and not moved:
+        return 0
+    if moved:
+        changes = dict(values)
+    conn = connect(db_path)
+    try:
+        n = write_fields(conn, module, owner, case_id, changes)
+        if moved and snap["case_id"] == DRAFT_CASE:
+            with conn:
+                conn.execute("DELETE FROM case_fields WHERE module = ? AND owner = ? AND case_id = ?", (module, owner, DRAFT_CASE))
+    finally:
+        conn.close()
+    state[_snapshot_key(module)] = {"case_id": case_id, "values": {**saved, **changes}}
+    tr = state.get(f"_autosave_{module}")
+    if tr is not None:  # an explicit save also settles those fields for the autosave tracker
+        for k, v in changes.items():
+            tr["seen"][k] = v
+            tr["pending"].pop(k, None)
+    return n
+
+def load_saved_values(state, module, owner=None, db_path=None):
+    """The last saved values of the active case (what load_state_from_file used to return)"""
+    snap = state.get(_snapshot_key(module))
+    if snap is not None:
+        return dict(snap["values"])
+    owner = owner or owner_id()
+    conn = connect(db_path)
+    try:
+        case_id = active_case(conn, module, owner)
+        return read_case(conn, module, owner, case_id) if case_id else {}
+    finally:
+        conn.close()
+
+# --- 4. DIRTY TRACKING & DEBOUNCED AUTOSAVE ---
+AUTOSAVE_DEBOUNCE = 2.0  # seconds without further edits before pending fields are flushed
+
+def _tracker(state, module, field_keys=None):
+    key = f"_autosave_{module}"
+    if key not in state:
+        snap = state.get(_snapshot_key(module)) or {"values": {}}
+        state[key] = {"seen": dict(snap["values"]), "pending": {}, "changed_at": 0.0, "field_keys": list(field_keys or [])}
+    elif field_keys is not None:
+        state[key]["field_keys"] = list(field_keys)
+    return state[key]
+
+def track_changes(state, module, field_keys, transforms=None):
+    """
+    Moves fields whose value changed since they were last seen into the pending set
+    (transforms: {field: fn} applied to the stored value of dirty fields only).
+    Returns the keys that became dirty on this run.
+    """
+    tr = _tracker(state, module, field_keys)
+    seen, dirty = tr["seen"], []
+    for k in field_keys:
+        if k in state:
+            v = state[k]
+            if k not in seen or seen[k] != v:
+                seen[k] = v
+                tr["pending"][k] = transforms[k](v) if transforms and k in transforms else v
+                dirty.append(k)
+    if dirty:
+        tr["changed_at"] = time.monotonic()
+    return dirty
+
+def flush(state, module, force=False, owner=None, db_path=None):
+    """
+    Writes pending fields once AUTOSAVE_DEBOUNCE seconds have passed since the last edit
+    (or immediately with force=True); returns the number of fields written.
+    """
+    tr = _tracker(state, module)
+    if not tr["pending"] or (not force and time.monotonic() - tr["changed_at"] < AUTOSAVE_DEBOUNCE):
+        return 0
+    snap = state.get(_snapshot_key(module)) or {"case_id": None, "values": {}}
+    pending, tr["pending"] = tr["pending"], {}
+    if case_key(state.get("oos_id", "")) != snap["case_id"]:
+        # New case (e.g. OOS ID just entered): the full field set goes under the new key
+        full = {k: state[k] for k in tr["field_keys"] if k in state}
+        return save_values(state, module, {**full, **pending}, owner, db_path)
+    return save_values(state, module, pending, owner, db_path)
+
+def autosave(state, module, field_keys, transforms=None, owner=None, db_path=None):
+    """End-of-run hook: track this run's edits and flush them if the debounce window has passed"""
+    track_changes(state, module, field_keys, transforms)
+    return flush(state, module, owner=owner, db_path=db_path)
+
+def autosave_page(module, field_keys, transforms=None):
+    """
+    Page hook at the end of every run: autosave() on session_state, then, only on runs that left
+    edits pending, an st.fragment tick that flushes them once typing pauses. The tick never reruns
+    the page; after the flush it is a no-op (no store access) until the next run, which registers
+    the timer again only if that run left new edits pending.
+    """
+    import streamlit as st
+    state = st.session_state
+    try:
+        autosave(state, module, field_keys, transforms)
+    except Exception:
+        return
+    if not _tracker(state, module)["pending"] or not hasattr(st, "fragment"):
+        return
+
+    @st.fragment(run_every=AUTOSAVE_DEBOUNCE)
+    def _autosave_tick():
+        if not _tracker(state, module)["pending"]:
+            return
+        try:
+            flush(state, module)
+        except Exception:
+            pass
+    _autosave_tick()
+
+# --- 5. VERSIONED CASE SNAPSHOTS ---
+# Each field change is one row valid for versions [from_version, to_version), so a snapshot stores
+# only the changed fields and restoring any version is one index seek per field (no history replay).
+VERSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS case_versions (
+    module   TEXT NOT NULL,
+    case_id  TEXT NOT NULL,
+    version  INTEGER NOT NULL,
+    owner    TEXT NOT NULL,
+    label    TEXT NOT NULL DEFAULT '',
+    changed  INTEGER NOT NULL,           -- number of fields that differ from the previous version
+    created  TEXT NOT NULL,
+    PRIMARY KEY (module, case_id, version)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS field_history (
+    module       TEXT NOT NULL,
+    case_id      TEXT NOT NULL,
+    field        TEXT NOT NULL,
+    from_version INTEGER NOT NULL,
+    to_version   INTEGER,                -- NULL while current
+    value        TEXT NOT NULL,          -- JSON
+    PRIMARY KEY (module, case_id, field, from_version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_field_history_current ON field_history (module, case_id, to_version);
+"""
+
+def _version_conn(db_path):
+    conn = connect(db_path)
+    conn.executescript(VERSION_SCHEMA)
+    return conn
+
+def _current_fields(conn, module, case_id):
+    rows = conn.execute("SELECT field, value FROM field_history WHERE module = ? AND case_id = ? AND to_version IS NULL",
+                        (module, case_id)).fetchall()
+    return dict(rows)
+
+def snapshot_case(state, module, field_keys, label="", owner=None, db_path=None):
+    """
+    Records a new version of the case (OOS ID) if any field differs from the latest version;
+    returns the new version number, or None when nothing changed or no OOS ID is set yet.
+    """
+    case_id = case_key(state.get("oos_id", ""))
+    if case_id == DRAFT_CASE:
+        return None
+    values = {k: json.dumps(state[k]) for k in field_keys if k in state}
+    conn = _version_conn(db_path)
+    try:
+        current = _current_fields(conn, module, case_id)
+        changes = {k: v for k, v in values.items() if current.get(k) != v}
+        if not changes:
+            return None
+        with conn:
+            latest = conn.execute("SELECT MAX(version) FROM case_versions WHERE module = ? AND case_id = ?", (module, case_id)).fetchone()[0] or 0
+            version = latest + 1
+            conn.executemany("UPDATE field_history SET to_version = ? WHERE module = ? AND case_id = ? AND field = ? AND to_version IS NULL",
+                             [(version, module, case_id, k) for k in changes])
+            conn.executemany("INSERT INTO field_history VALUES (?, ?, ?, ?, NULL, ?)",
+                             [(module, case_id, k, version, v) for k, v in changes.items()])
+            conn.execute("INSERT INTO case_versions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (module, case_id, version, owner or owner_id(), label, len(changes), datetime.now().isoformat(timespec="seconds")))
+        return version
+    finally:
+        conn.close()
+
+def snapshot_page(module, field_keys, label):
+    """Page hook: snapshot_case() on session_state; a store error never breaks the page"""
+    import streamlit as st
+    try:
+        return snapshot_case(st.session_state, module, field_keys, label)
+    except Exception:
+        return None
+
+def list_versions(module, oos_id, db_path=None):
+    """[(version, created, owner, label, changed)] newest first"""
+    conn = _version_conn(db_path)
+    try:
+        return conn.execute("SELECT version, created, owner, label, changed FROM case_versions WHERE module = ? AND case_id = ? "
+                            "ORDER BY version DESC", (module, case_key(oos_id))).fetchall()
+    finally:
+        conn.close()
+
+def restore_version(module, oos_id, version, db_path=None):
+    """Field values as of `version`: one seek per field, independent of how many versions exist"""
+    conn = _version_conn(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT c.field, (SELECT h.value FROM field_history h WHERE h.module = c.module AND h.case_id = c.case_id "
+            "AND h.field = c.field AND h.from_version <= ? ORDER BY h.from_version DESC LIMIT 1) "
+            "FROM field_history c WHERE c.module = ? AND c.case_id = ? AND c.to_version IS NULL",
+            (version, module, case_key(oos_id))).fetchall()
+    finally:
+        conn.close()
+    return {f: json.loads(v) for f, v in rows if v is not None}
+
+def diff_versions(module, oos_id, old_version, new_version, db_path=None):
+    """{field: (old value, new value)} for fields that differ between two versions"""
+    old = restore_version(module, oos_id, old_version, db_path)
+    new = restore_version(module, oos_id, new_version, db_path)
+    return {k: (old.get(k), new.get(k)) for k in sorted(set(old) | set(new)) if old.get(k) != new.get(k)}
+
+def render_version_panel(module, field_keys, db_path=None):
+    """Streamlit expander: version list, diff against the previous version, and restore"""
+    import streamlit as st
+    oos_id = st.session_state.get("oos_id", "")
+    with st.expander("🕘 Case Versions"):
+        versions = list_versions(module, oos_id, db_path) if case_key(oos_id) != DRAFT_CASE else []
+        if not versions:
+            st.caption("No saved versions for this OOS ID yet. Versions are recorded on Smart Parse / Restore and report generation.")
+            return
+        labels = {v[0]: f"v{v[0]} · {v[1]} · {v[3] or 'saved'} ({v[4]} field(s) changed)" for v in versions}
+        picked = st.selectbox("Version", list(labels), format_func=labels.get, key=f"_version_pick_{module}")
+        if picked > 1:
+            changes = diff_versions(module, oos_id, picked - 1, picked, db_path)
+            st.dataframe([{"field": k, f"v{picked - 1}": str(a), f"v{picked}": str(b)} for k, (a, b) in changes.items()], hide_index=True)
+
+        def _restore():
+            for k, v in restore_version(module, oos_id, picked, db_path).items():
+                if k in field_keys:
+                    st.session_state[k] = v
+        st.button(f"⏪ Restore v{picked}", on_click=_restore, key=f"_version_restore_{module}")
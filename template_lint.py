@@ -0,0 +1,333 @@
+# filename: template_lint.py
+"""
+Linter for every .docx template in the repo (replaces the one-file check_tags.py scan).
+Each template is checked in a worker process, part by part: the body (tables and text boxes
+included), every header and footer, plus footnotes / endnotes / comments (docxtpl does not render
+those, so a tag there is reported too). It finds:
+  - malformed tags ('{ {', '{name}}', '{{ subculture _name }}', empty or unparsable expressions)
+  - tags left open in one paragraph or closed in another (split across paragraphs), and tags
+    split across runs (docxtpl re-joins those, but they are where Word edits corrupt tags)
+  - Jinja block errors of the whole part, after the same XML patching docxtpl renders with
+  - unknown variables: used by a template but missing from the context its module passes
+  - unused context keys: passed by a module but read by none of the templates it renders
+The module contexts are captured by driving each page headless with its fixtures/ email (the same
+flow as load_test.py) and recording the report_service payloads. Results are cached in
+template_lint_cache.json: a template whose content hash is unchanged is not re-linted, and the
+contexts are re-captured only when a .py file or fixture changes.
+
+    python template_lint.py
+    python template_lint.py "USP71 OOS P1 template 0.docx" --no-contexts
+    python template_lint.py --force --json lint.json
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+if ROOT not in sys.path:  # the capture workers import the pages' logic modules from the repo root
+    sys.path.insert(0, ROOT)
+
+import template_registry  # noqa: E402
+
+# --- 1. CONFIG ---
+CACHE_FILE = os.path.join(ROOT, "template_lint_cache.json")
+LINT_VERSION = 1  # bump when the checks change, so cached results are redone
+WORKERS = min(8, os.cpu_count() or 2)
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+RENDERED_PARTS = re.compile(r"^word/(document|header\d*|footer\d*)\.xml$")
+UNRENDERED_PARTS = re.compile(r"^word/(footnotes|endnotes|comments)\.xml$")
+
+TOKEN = re.compile(r"\{\{|\}\}|\{%|%\}|\{#|#\}")
+CLOSER = {"{{": "}}", "{%": "%}", "{#": "#}"}
+NEAR_MISS = (
+    (re.compile(r"(?<!\{)\{\s+\{[^{}]*\}{0,2}"), "'{ {' (space between the braces)"),
+    (re.compile(r"\{{0,2}[^{}]*\}\s+\}(?!\})"), "'} }' (space between the braces)"),
+    (re.compile(r"(?<![{%])\{\s*[A-Za-z_]\w*\s*\}\}"), "single '{' before a name closed with '}}'"),
+    (re.compile(r"\{\{\s*[A-Za-z_]\w*\s*\}(?!\})"), "'{{' closed with a single '}'"),
+)
+DOCXTPL_PREFIX = re.compile(r"^(?:tr|tc|p|r)\s")
+QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+# --- 2. PART SCAN (paragraphs, runs, tags) ---
+def _owner_paragraph(el):
+    el = el.getparent()
+    while el is not None and el.tag != W + "p":
+        el = el.getparent()
+    return el
+
+def _paragraphs(root):
+    """(index, kind, [run texts]) for every paragraph, nested text-box paragraphs on their own"""
+    for i, p in enumerate(root.iter(W + "p")):
+        ancestors = {a.tag for a in p.iterancestors()}
+        if MC_FALLBACK in ancestors:
+            continue  # VML copy of a text box that mc:Choice already holds
+        kind = "text box" if W + "txbxContent" in ancestors else "table" if W + "tc" in ancestors else "body"
+        runs = [t.text or "" for t in p.iter(W + "t") if _owner_paragraph(t) is p]
+        if any(runs):
+            yield i, kind, runs
+
+def _issue(severity, part, where, message):
+    return {"severity": severity, "part": part, "where": where, "message": message}
+
+def _snippet(text, start, end):
+    return text[max(0, start - 10):end + 10].strip()
+
+def scan_paragraph(part, index, kind, runs, env):
+    """Issues and variables of one paragraph's tags"""
+    from jinja2 import meta, TemplateSyntaxError
+    text = "".join(runs)
+    where = f"¶{index} ({kind})"
+    issues, variables = [], set()
+    bounds, pos = [], 0
+    for r in runs:
+        pos += len(r)
+        bounds.append(pos)
+
+    near = []  # spans already reported as malformed, so their braces are not reported twice
+    for pattern, what in NEAR_MISS:
+        for m in pattern.finditer(text):
+            if not any(a < m.end() and m.start() < b for a, b in near):
+                near.append(m.span())
+                issues.append(_issue("error", part, where, f"malformed tag, {what}: {_snippet(text, m.start(), m.end())!r}"))
+
+    open_tok, open_at = None, 0
+    for m in TOKEN.finditer(text):
+        tok = m.group()
+        if tok in CLOSER:
+            if open_tok:
+                issues.append(_issue("error", part, where, f"'{open_tok}' is not closed before the next '{tok}': {_snippet(text, open_at, m.start())!r}"))
+            open_tok, open_at = tok, m.start()
+            continue
+        if open_tok is None or CLOSER[open_tok] != tok:
+            if open_tok is None and not any(a <= m.start() < b for a, b in near):
+                issues.append(_issue("error", part, where, f"'{tok}' without an opening tag (split across paragraphs?): {_snippet(text, m.start(), m.end())!r}"))
+            continue
+        start, end = open_at, m.end()
+        tag = text[start:end]
+        open_tok = None
+        spans = sum(1 for b in bounds if start < b < end)
+        if spans:
+            issues.append(_issue("info", part, where, f"{tag!r} is split across {spans + 1} runs"))
+        if tag.startswith("{#"):
+            continue
+        inner = DOCXTPL_PREFIX.sub("", tag[2:-2].translate(QUOTES).strip())
+        if not inner:
+            issues.append(_issue("error", part, where, f"empty tag {tag!r}"))
+        elif tag.startswith("{{"):
+            try:
+                variables |= meta.find_undeclared_variables(env.parse("{{ " + inner + " }}"))
+            except TemplateSyntaxError as e:
+                issues.append(_issue("error", part, where, f"malformed tag {tag!r}: {e.message}"))
+    if open_tok and not any(a <= open_at < b for a, b in near):
+        issues.append(_issue("error", part, where, f"'{open_tok}' is not closed in this paragraph (split across paragraphs?): {_snippet(text, open_at, len(text))!r}"))
+    return issues, variables
+
+def lint_docx(path):
+    """{'issues': [...], 'variables': [...]} of one template (no context needed, so it is cached by content hash)"""
+    from lxml import etree
+    from jinja2 import Environment, meta, TemplateSyntaxError
+    from docxtpl import DocxTemplate
+    env = Environment()
+    tpl = DocxTemplate(path)  # only for patch_xml(): the preprocessing docxtpl renders with
+    issues, variables = [], set()
+    try:
+        zf = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError) as e:
+        return {"issues": [_issue("error", "", "", f"not a readable .docx: {e}")], "variables": []}
+    with zf:
+        for part in sorted(n for n in zf.namelist() if RENDERED_PARTS.match(n) or UNRENDERED_PARTS.match(n)):
+            xml = zf.read(part)
+            rendered = bool(RENDERED_PARTS.match(part))
+            part_vars = set()
+            for index, kind, runs in _paragraphs(etree.fromstring(xml)):
+                found, names = scan_paragraph(part, index, kind, runs, env)
+                issues.extend(found)
+                part_vars |= names
+                if not rendered and TOKEN.search("".join(runs)):
+                    issues.append(_issue("warning", part, f"¶{index} ({kind})", "tag in a part docxtpl does not render; it is printed as-is"))
+            if not rendered:
+                continue
+            try:
+                part_vars = meta.find_undeclared_variables(env.parse(tpl.patch_xml(xml.decode("utf-8"))))
+            except TemplateSyntaxError as e:
+                issues.append(_issue("error", part, f"line {e.lineno}", f"Jinja parse error of the whole part: {e.message}"))
+            variables |= part_vars
+    return {"issues": issues, "variables": sorted(variables)}
+
+# --- 3. MODULE CONTEXTS (captured from the pages) ---
+def capture_contexts(module):
+    """
+    Drives the module page headless with its fixture email and returns {template: {"context", "keys"}}
+    for every DOCX the page renders (ScanRDI also generates Phase 2).
+    """
+    import load_test
+    payloads = [r["payload"] for r in load_test.capture_reports(module)]
+
+    contexts = {}
+    with load_test.scratch():  # resolve_file() below reads a scratch registry, not the repo's templates.db
+        for payload in payloads:
+            if "fields" in payload:
+                import em_logic
+                specs = [{"name": "report.docx", "template": "em/p1/docx", "context": em_logic.build_em_context(payload["fields"])}]
+            else:
+                specs = payload.get("docx", [])
+            for s in specs:
+                names = template_registry.MANIFEST[s["template"]] if "template" in s else s["templates"]
+                for name in names:
+                    entry = contexts.setdefault(name, {"context": f"{module} {s['name']}", "keys": set(), "rendered": False})
+                    entry["keys"] |= set(s.get("context", {}))
+                first = next((n for n in names if template_registry.resolve_file(n)), None)
+                if first:
+                    contexts[first]["rendered"] = True
+    return {k: {**v, "keys": sorted(v["keys"])} for k, v in contexts.items()}
+
+def _sources_digest():
+    """Hash of every .py file and fixture: the captured contexts are redone when any of them changes"""
+    h = hashlib.sha256()
+    for folder in (ROOT, os.path.join(ROOT, "pages"), os.path.join(ROOT, "fixtures")):
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and (name.endswith(".py") or folder.endswith("fixtures")):
+                h.update(name.encode("utf-8"))
+                with open(path, "rb") as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+# --- 4. CACHE ---
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_cache(path=CACHE_FILE):
+    """Cached results (path None: none, nothing is read)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("version") == LINT_VERSION:
+            return cache
+    except (OSError, ValueError, TypeError):
+        pass
+    return {"version": LINT_VERSION, "files": {}, "contexts": {}}
+
+def save_cache(cache, path=CACHE_FILE):
+    if path is None:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=1, ensure_ascii=False)
+    os.replace(tmp, path)
+
+# --- 5. RUN ---
+def all_templates():
+    return sorted(n for n in os.listdir(ROOT) if n.endswith(".docx") and not n.startswith("~$"))
+
+def lint(names=None, contexts=True, force=False, workers=WORKERS, cache_path=CACHE_FILE):
+    """
+    {"files": {name: {"issues", "variables", "context", "cached"}}, "unused": {context: [keys]}}.
+    Templates and context captures run concurrently in one process pool; unchanged ones come from the cache
+    (cache_path None: no cache is read or written).
+    """
+    names = names or all_templates()
+    cache = load_cache(cache_path)
+    cache["files"] = {k: v for k, v in cache["files"].items() if os.path.exists(os.path.join(ROOT, k))}
+    digests = {n: file_sha256(os.path.join(ROOT, n)) for n in names}
+    todo = [n for n in names if force or cache["files"].get(n, {}).get("sha256") != digests[n]]
+    src_digest = _sources_digest() if contexts else None
+    ctx_cache = cache.get("contexts", {})
+    capture = contexts and (force or ctx_cache.get("digest") != src_digest)
+
+    import load_test
+    modules = list(load_test.MODULES) if capture else []
+    captured, capture_errors = {}, []
+    if todo or modules:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(todo) + len(modules)))) as pool:
+            lint_jobs = {n: pool.submit(lint_docx, os.path.join(ROOT, n)) for n in todo}
+            ctx_jobs = {m: pool.submit(capture_contexts, m) for m in modules}
+            for n, job in lint_jobs.items():
+                cache["files"][n] = {"sha256": digests[n], "result": job.result()}
+            for m, job in ctx_jobs.items():
+                try:
+                    captured.update(job.result())
+                except Exception as e:
+                    capture_errors.append(f"{m}: context capture failed: {type(e).__name__}: {e}")
+    if capture:
+        # A page that fails with its fixture keeps failing until the code changes: cache the error too
+        cache["contexts"] = ctx_cache = {"digest": src_digest, "templates": captured, "errors": capture_errors}
+    save_cache(cache, cache_path)
+    capture_errors = ctx_cache.get("errors", []) if contexts else []
+
+    templates = ctx_cache.get("templates", {}) if contexts else {}
+    files, used_by_context, keys_by_context = {}, {}, {}
+    for n in names:
+        result = dict(cache["files"][n]["result"])
+        issues = list(result["issues"])
+        ctx = templates.get(n)
+        if ctx:
+            keys = set(ctx["keys"])
+            for var in sorted(set(result["variables"]) - keys):
+                issues.append(_issue("warning", "", "", f"unknown variable '{var}': not in the {ctx['context']} context (renders empty)"))
+            keys_by_context[ctx["context"]] = keys
+            if ctx["rendered"]:
+                used_by_context.setdefault(ctx["context"], set()).update(result["variables"])
+        files[n] = {"issues": issues, "variables": result["variables"], "context": ctx["context"] if ctx else None, "cached": n not in todo}
+    unused = {c: sorted(keys - used_by_context.get(c, set())) for c, keys in keys_by_context.items()}
+    return {"files": files, "unused": unused, "contexts": bool(contexts), "errors": capture_errors}
+
+def print_report(report, verbose=False):
+    counts = {"error": 0, "warning": 0, "info": 0}
+    for name, r in report["files"].items():
+        for i in r["issues"]:
+            counts[i["severity"]] += 1
+        n_err = sum(i["severity"] == "error" for i in r["issues"])
+        n_info = sum(i["severity"] == "info" for i in r["issues"])
+        ctx = f", context: {r['context']}" if r["context"] else ", not rendered by any module" if report["contexts"] else ""
+        runs = f", {n_info} tags split across runs" if n_info and not verbose else ""
+        print(f"[{'-' if n_err else '+'}] {name}{' (cached)' if r['cached'] else ''}: {len(r['variables'])} variables{ctx}{runs}")
+        for i in r["issues"]:
+            if i["severity"] == "info" and not verbose:
+                continue
+            loc = " ".join(x for x in (i["part"], i["where"]) if x)
+            print(f"    {i['severity'].upper():8} {loc + ': ' if loc else ''}{i['message']}")
+    for ctx, keys in report["unused"].items():
+        if keys:
+            shown = keys if verbose else keys[:15]
+            print(f"[i] {ctx} context: {len(keys)} keys no template reads: {', '.join(shown)}{' ...' if len(shown) < len(keys) else ''}")
+    for e in report["errors"]:
+        print(f"[!] {e}")
+    print(f"[=] {len(report['files'])} templates, {counts['error']} errors, {counts['warning']} warnings, {counts['info']} split tags (-v lists them)")
+    return counts["error"]
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Lint the .docx report templates")
+    parser.add_argument("templates", nargs="*", help="template file names (default: every .docx in the repo)")
+    parser.add_argument("--no-contexts", action="store_true", help="tags only: skip the module context capture")
+    parser.add_argument("--force", action="store_true", help="ignore the cache")
+    parser.add_argument("--jobs", type=int, default=WORKERS)
+    parser.add_argument("--json", help="also write the full report to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="list tags split across runs and every unused context key")
+    args = parser.parse_args(argv)
+
+    names = [os.path.basename(t) for t in args.templates] or None
+    report = lint(names, contexts=not args.no_contexts, force=args.force, workers=args.jobs)
+    errors = print_report(report, args.verbose)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    # Run from the importable module: the capture workers run AppTest, which swaps sys.modules["__main__"]
+    import template_lint
+    sys.exit(template_lint.main())
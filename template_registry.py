@@ -0,0 +1,334 @@
+# filename: template_registry.py
+"""
+Template registry: logical template names -> content-addressed, versioned blobs (SQLite, WAL mode).
+A logical template is "module/phase/kind" (e.g. 'usp71/p1/docx', 'scanrdi/tables/docx'). MANIFEST
+lists the files that may provide each one, in the order the pages used to probe them with
+os.path.exists. sync() hashes the template files of the repo and the .history backups, stores
+every distinct content once (identical files such as 'ScanRDI OOS template.pdf' and
+'ScanRDI OOS P1 template.pdf' share one blob) and appends a new version when the file providing a
+logical template changes. sync() runs on the first use of a registry in a process (startup), from
+the CLI and from the tools that rewrite templates; a resolve also re-syncs when a cheap stat (mtime,
+size) of the MANIFEST files changes, checked at most every RELOAD_SECONDS. Rendering reads the bytes
+from the registry DB, and every cache keyed by the blob's sha256 is correct by construction. TEMPLATE_REGISTRY_DB overrides
+the registry path (load_test / golden / template_lint scratch runs).
+
+    python template_registry.py sync
+    python template_registry.py list
+    python template_registry.py history usp71/p1/docx
+    python template_registry.py export usp71/p1/docx --version 2 --out old.docx
+"""
+import io
+import os
+import re
+import sys
+import time
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+from typing import NamedTuple
+
+# --- 1. CONFIG & SCHEMA ---
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_DIR = os.path.join(TEMPLATE_DIR, ".history")
+DB_FILE = os.path.join(TEMPLATE_DIR, "templates.db")
+DB_ENV = "TEMPLATE_REGISTRY_DB"  # overrides DB_FILE
+TEMPLATE_EXT = (".docx", ".pdf")
+RELOAD_SECONDS = 5  # a resolve re-reads the current versions from the DB at most this often
+
+# Logical template -> files that may provide it, first existing wins (the order the code used to probe)
+MANIFEST = {
+    "em/p1/docx": ["EM OOS P1 template.docx", "EM OOS P1 template 0.docx"],
+    "em/p1/pdf": ["EM OOS P1 template.pdf"],
+    "em/tables/docx": ["tables for em.docx"],
+    "scanrdi/p1/docx": ["ScanRDI OOS template 0.docx"],
+    "scanrdi/p1/pdf": ["ScanRDI OOS template.pdf", "ScanRDI OOS P1 template.pdf"],
+    "scanrdi/tables/docx": ["tables for scan.docx"],
+    "scanrdi/p2/docx": ["ScanRDI OOS P2 template 0.docx"],
+    "scanrdi/p2/pdf": ["ScanRDI OOS P2 template.pdf"],
+    "usp71/p1/docx": ["USP71 OOS P1 template.docx", "USP71 OOS P1 template 0.docx"],
+    "usp71/p1/pdf": ["USP71 OOS P1 template.pdf"],
+    "usp71/tables/docx": ["tables for 71.docx", "USP71 table.docx"],
+    "celsis/p1/docx": ["Celsis OOS P1 template 0.docx", "Celsis OOS P1 template.docx"],
+    "celsis/p1/pdf": ["Celsis OOS P1 template.pdf"],
+    "celsis/tables/docx": ["tables for celsis.docx"],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS template_blobs (
+    sha256 TEXT PRIMARY KEY,
+    ext    TEXT NOT NULL,
+    size   INTEGER NOT NULL,
+    data   BLOB NOT NULL,
+    added  TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS template_versions (
+    key     TEXT NOT NULL,              -- module/phase/kind
+    version INTEGER NOT NULL,
+    sha256  TEXT NOT NULL,
+    source  TEXT NOT NULL,              -- file that provided it (or the backup / copy it was imported from)
+    added   TEXT NOT NULL,              -- file time (backup time stamp for .history copies)
+    PRIMARY KEY (key, version)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS template_files (
+    path   TEXT PRIMARY KEY,            -- relative to the template directory
+    mtime  REAL NOT NULL,
+    size   INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+class Template(NamedTuple):
+    key: str
+    version: int
+    sha256: str
+    source: str
+    added: str
+
+    @property
+    def path(self):
+        """File the version came from (still used where a tool needs a path, e.g. the pdf schema cache)"""
+        return os.path.join(TEMPLATE_DIR, self.source)
+
+def template_key(module, phase, kind):
+    return f"{module.lower()}/{phase.lower()}/{kind.lower().lstrip('.')}"
+
+def db_file():
+    """The registry path: $TEMPLATE_REGISTRY_DB if set, else DB_FILE in the template directory"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    conn = sqlite3.connect(db_path or db_file(), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+# --- 2. SYNC (files -> blobs & versions) ---
+_BACKUP_NAME = re.compile(r"^(?P<base>.+?)(?P<ext1>\.docx|\.pdf)?_backup(?:_(?P<ts>\d{8}_\d{6}))?(?P<ext2>\.docx|\.pdf)?$")
+_COPY_NAME = re.compile(r"^(?P<base>.+?) - Copy(?: \(\d+\))?(?P<ext1>\.docx|\.pdf)$")
+
+def _backup_source(name):
+    """
+    File a backup / copy was taken of, and its time stamp when the name has one:
+    'EM OOS P1 template.docx_backup_20260818_115313' -> ('EM OOS P1 template.docx', '2026-08-18T11:53:13'),
+    'USP71 OOS P1 template 0 - Copy.docx' -> ('USP71 OOS P1 template 0.docx', None)
+    """
+    m = _BACKUP_NAME.match(name) or _COPY_NAME.match(name)
+    if not m or not (m.group("ext1") or m.groupdict().get("ext2")):
+        return None, None
+    base = m.group("base") + (m.group("ext1") or m.group("ext2"))
+    if base not in _FILE_KEYS:
+        base = base.replace("_", " ")
+    ts = m.groupdict().get("ts")
+    return base, datetime.strptime(ts, "%Y%m%d_%H%M%S").isoformat() if ts else None
+
+_FILE_KEYS = {name: key for key, names in MANIFEST.items() for name in names}
+
+def _scan():
+    """[(relative path, absolute path)] of every template file and .history backup"""
+    found = [(n, os.path.join(TEMPLATE_DIR, n)) for n in sorted(os.listdir(TEMPLATE_DIR))
+             if n.endswith(TEMPLATE_EXT) and not n.startswith("~$")]
+    if os.path.isdir(HISTORY_DIR):
+        found += [(f".history/{n}", os.path.join(HISTORY_DIR, n)) for n in sorted(os.listdir(HISTORY_DIR))]
+    return found
+
+def _store_file(conn, rel, path):
+    """sha256 of a file, hashing and storing its blob only when its mtime / size changed since the last sync"""
+    st = os.stat(path)
+    row = conn.execute("SELECT mtime, size, sha256 FROM template_files WHERE path = ?", (rel,)).fetchone()
+    if row and row[0] == st.st_mtime and row[1] == st.st_size:
+        return row[2]
+    with open(path, "rb") as f:
+        data = f.read()
+    sha = hashlib.sha256(data).hexdigest()
+    ext = os.path.splitext(rel.split("_backup")[0])[1] or os.path.splitext(rel)[1]
+    conn.execute("INSERT OR IGNORE INTO template_blobs VALUES (?, ?, ?, ?, ?)",
+                 (sha, ext, len(data), data, datetime.now().isoformat(timespec="seconds")))
+    conn.execute("INSERT OR REPLACE INTO template_files VALUES (?, ?, ?, ?)", (rel, st.st_mtime, st.st_size, sha))
+    return sha
+
+def _add_version(conn, key, sha, source, added):
+    version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM template_versions WHERE key = ?", (key,)).fetchone()[0]
+    conn.execute("INSERT INTO template_versions VALUES (?, ?, ?, ?, ?)", (key, version, sha, source, added))
+
+def _manifest_stat():
+    """(name, mtime, size) of every MANIFEST file: a cheap signature of the templates on disk"""
+    sig = []
+    for name in _FILE_KEYS:
+        try:
+            st = os.stat(os.path.join(TEMPLATE_DIR, name))
+            sig.append((name, st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append((name, None, None))
+    return tuple(sig)
+
+def sync(db_path=None):
+    """
+    Registers the template files: new contents become blobs, .history backups become earlier
+    versions, and a logical template whose providing file changed gets a new version.
+    Returns {"files", "blobs", "new_versions"}.
+    """
+    db_path = db_path or db_file()
+    stat = _manifest_stat()  # taken before the scan: a write during the sync triggers the next one
+    conn = connect(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")  # one syncing process at a time (pages, service workers, CLI)
+        files = _scan()
+        shas = {rel: _store_file(conn, rel, path) for rel, path in files}
+        mtimes = {rel: datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec="seconds") for rel, path in files}
+        new = 0
+        # Backups and copies first (oldest first), so a fresh registry numbers them before the current file
+        backups = []
+        for rel in shas:
+            if rel not in _FILE_KEYS:
+                base, ts = _backup_source(os.path.basename(rel))
+                if base in _FILE_KEYS:
+                    backups.append((ts or mtimes[rel], _FILE_KEYS[base], rel))
+        for added, key, rel in sorted(backups):
+            known = {r[0] for r in conn.execute("SELECT sha256 FROM template_versions WHERE key = ?", (key,))}
+            if shas[rel] not in known:
+                _add_version(conn, key, shas[rel], rel, added)
+                new += 1
+        for key, names in MANIFEST.items():
+            source = next((n for n in names if n in shas), None)
+            if source is None:
+                continue
+            last = conn.execute("SELECT sha256, source FROM template_versions WHERE key = ? ORDER BY version DESC LIMIT 1", (key,)).fetchone()
+            if last is None or last[0] != shas[source] or last[1] != source:
+                _add_version(conn, key, shas[source], source, mtimes[source])
+                new += 1
+        conn.commit()
+        blobs = conn.execute("SELECT COUNT(*) FROM template_blobs").fetchone()[0]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    _synced[db_path] = stat
+    return {"files": len(shas), "blobs": blobs, "new_versions": new}
+
+# --- 3. RESOLVE & LOAD ---
+_lock = threading.Lock()
+_synced = {}  # registry -> _manifest_stat() of its last sync in this process (first use = startup)
+_state = {"db": None, "loaded": 0.0, "current": {}, "files": {}}   # key -> Template, file name -> sha256
+_BLOBS = {}  # sha256 -> bytes; content-addressed, so never stale
+
+def _refresh(db_path=None):
+    """Current versions from the DB; the first use of a registry in this process syncs it, and so does
+    any later change of a MANIFEST file (fix_tags.py, bootstrap_template.py or a hand edit)"""
+    db_path = db_path or db_file()
+    with _lock:
+        if _state["db"] == db_path and time.monotonic() - _state["loaded"] < RELOAD_SECONDS:
+            return
+        if _synced.get(db_path) != _manifest_stat():
+            sync(db_path)
+        conn = connect(db_path)
+        try:
+            rows = conn.execute("SELECT v.key, v.version, v.sha256, v.source, v.added FROM template_versions v "
+                                "JOIN (SELECT key, MAX(version) AS version FROM template_versions GROUP BY key) m "
+                                "ON v.key = m.key AND v.version = m.version").fetchall()
+            files = dict(conn.execute("SELECT path, sha256 FROM template_files WHERE path NOT LIKE '.history/%'").fetchall())
+        finally:
+            conn.close()
+        # A key whose files were all removed keeps its last version in history but no longer resolves
+        present = {r[0]: r for r in rows if r[3] in files}
+        _state.update(db=db_path, loaded=time.monotonic(), current={k: Template(*r) for k, r in present.items()}, files=files)
+
+def resolve(key, db_path=None):
+    """Current Template of a logical name ('usp71/p1/docx'), or None when no file provides it"""
+    _refresh(db_path)
+    return _state["current"].get(key)
+
+def resolve_file(name, db_path=None):
+    """Template for a bare file name (payloads queued before the registry named their templates that way)"""
+    _refresh(db_path)
+    key = _FILE_KEYS.get(name)
+    current = _state["current"].get(key)
+    if current is not None and current.source == name:
+        return current
+    sha = _state["files"].get(name)
+    return Template(key or "", 0, sha, name, "") if sha else None
+
+def blob(sha256, db_path=None):
+    """Bytes of a stored template (kept in memory after the first read)"""
+    data = _BLOBS.get(sha256)
+    if data is None:
+        conn = connect(db_path)
+        try:
+            row = conn.execute("SELECT data FROM template_blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            raise KeyError(f"Template blob {sha256[:12]} is not in the registry")
+        data = _BLOBS[sha256] = row[0]
+    return data
+
+def open_template(key):
+    """Fresh stream of a logical template (DocxTemplate / PdfWriter(clone_from=...) accept it)"""
+    tpl = resolve(key)
+    if tpl is None:
+        raise FileNotFoundError(f"⚠️ Could not find a template for {key!r} ({' or '.join(MANIFEST.get(key, []))}).")
+    return io.BytesIO(blob(tpl.sha256))
+
+# --- 4. HISTORY & DUPLICATES ---
+def history(key, db_path=None):
+    conn = connect(db_path)
+    try:
+        rows = conn.execute("SELECT key, version, sha256, source, added FROM template_versions WHERE key = ? ORDER BY version", (key,)).fetchall()
+    finally:
+        conn.close()
+    return [Template(*r) for r in rows]
+
+def version_blob(key, version, db_path=None):
+    tpl = next((t for t in history(key, db_path) if t.version == version), None)
+    if tpl is None:
+        raise KeyError(f"{key} has no version {version}")
+    return blob(tpl.sha256, db_path)
+
+def duplicates(db_path=None):
+    """{sha256: [files]} for contents present under more than one file name (backups included)"""
+    conn = connect(db_path)
+    try:
+        rows = conn.execute("SELECT sha256, path FROM template_files ORDER BY path").fetchall()
+    finally:
+        conn.close()
+    groups = {}
+    for sha, path in rows:
+        groups.setdefault(sha, []).append(path)
+    return {sha: paths for sha, paths in groups.items() if len(paths) > 1}
+
+def _cli(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Versioned, content-addressed template registry")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("sync", help="register new / changed template files")
+    sub.add_parser("list", help="current version of every logical template, plus duplicate files")
+    p_hist = sub.add_parser("history", help="versions of one logical template")
+    p_hist.add_argument("key")
+    p_exp = sub.add_parser("export", help="write a stored version to a file")
+    p_exp.add_argument("key")
+    p_exp.add_argument("--version", type=int, help="default: current")
+    p_exp.add_argument("--out", required=True)
+    args = parser.parse_args(argv)
+
+    stats = sync()
+    if args.cmd == "sync":
+        print(f"[+] {stats['files']} files, {stats['blobs']} distinct blobs, {stats['new_versions']} new versions")
+    elif args.cmd == "list":
+        for key in MANIFEST:
+            tpl = resolve(key)
+            print(f"{key:<20} " + (f"v{tpl.version:<3} {tpl.sha256[:12]}  {tpl.source}" if tpl else "-- no file --"))
+        for sha, paths in duplicates().items():
+            print(f"[=] identical ({sha[:12]}): " + ", ".join(paths))
+    elif args.cmd == "history":
+        for t in history(args.key):
+            print(f"v{t.version:<3} {t.sha256[:12]}  {t.added:<19}  {t.source}")
+    else:
+        data = version_blob(args.key, args.version) if args.version else blob(resolve(args.key).sha256)
+        with open(args.out, "wb") as f:
+            f.write(data)
+        print(f"[+] {args.key} -> {args.out} ({len(data)} bytes)")
+
+if __name__ == "__main__":
+    _cli(sys.argv[1:])
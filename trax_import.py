@@ -0,0 +1,299 @@
+# filename: trax_import.py
+"""
+Streaming bulk importer for Eagle Trax exports (CSV / XLSX).
+Sample logs go to processing_log, EM reads to em_store and event audit trails to the
+trax_events table. Rows are streamed, upserted in batched transactions, and a per-file
+checkpoint (row count + fingerprint of the last row) makes re-runs incremental.
+"""
+import os
+import re
+import hashlib
+import sqlite3
+from collections import Counter
+from datetime import datetime, timedelta
+
+import em_store
+import processing_log
+from em_store import parse_date, read_spreadsheet
+
+try:
+    from utils import get_full_name, clean_analyst_name, username_to_initials
+except ImportError:
+    def get_full_name(i): return i
+    def clean_analyst_name(n): return n
+    def username_to_initials(u): return (u or "")[:2].upper()
+
+# --- 1. CONFIG & SCHEMA ---
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trax_events.db")
+DB_ENV = "TRAX_EVENTS_DB"  # overrides DB_FILE (load_test / golden scratch runs)
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trax_events (
+    sample_id      TEXT NOT NULL,
+    event_time     TEXT NOT NULL,        -- ISO YYYY-MM-DDTHH:MM[:SS]
+    event_kind     TEXT NOT NULL,        -- see EVENT_RULES
+    username       TEXT NOT NULL DEFAULT '',
+    initials       TEXT NOT NULL DEFAULT '',
+    incubation_day INTEGER,
+    media          TEXT NOT NULL DEFAULT '',
+    description    TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (sample_id, event_time, event_kind, username)
+);
+CREATE INDEX IF NOT EXISTS ix_trax_sample_kind ON trax_events (sample_id, event_kind, event_time);
+"""
+
+# Lives in each target database so a batch and its checkpoint share a commit
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_checkpoints (
+    source           TEXT PRIMARY KEY,   -- absolute path of the export
+    kind             TEXT NOT NULL,
+    rows_done        INTEGER NOT NULL,
+    last_fingerprint TEXT NOT NULL,
+    updated          TEXT NOT NULL
+);
+"""
+
+# Event audit trail header aliases -> column
+EVENT_COLUMN_ALIASES = {
+    "description": ["event", "description", "activity", "event description", "action"],
+    "event_time": ["date", "date/time", "timestamp", "event date", "time"],
+    "username": ["user", "username", "user name", "performed by"],
+    "sample_id": ["sample id", "sample", "etx", "etx id"],
+}
+
+def db_file():
+    """The event audit trail path: $TRAX_EVENTS_DB if set, else DB_FILE next to this module"""
+    return os.environ.get(DB_ENV) or DB_FILE
+
+def connect(db_path=None):
+    """Opens (and creates if needed) the event audit trail store"""
+    conn = sqlite3.connect(db_path or db_file())
+    conn.executescript(SCHEMA)
+    return conn
+
+# --- 2. EVENT SEMANTICS (same phrases the USP71 Smart Parser keys on) ---
+# First matching rule wins; every phrase in the tuple must appear in the event text.
+EVENT_RULES = [
+    ("sample_positive", ("status changed", "sample positive")),
+    ("sample_analysis", ("status changed", "sample analysis")),
+    ("read_positive", ("sterility read", "positive")),
+    ("read_inconclusive", ("sterility read", "inconclusive")),
+    ("inconclusive", ("inconclusive",)),
+    ("sample_prep", ("sample prep",)),
+    ("incubation_started", ("incubation started",)),
+]
+
+def classify_event(description):
+    t = str(description or "").lower()
+    return next((kind for kind, phrases in EVENT_RULES if all(p in t for p in phrases)), "")
+
+def parse_event_time(value):
+    """Trax exports use MM/DD/YYYY HH:MM[:SS] or ISO; returns an ISO string or ''"""
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="minutes")
+    raw = str(value or "").strip()
+    for fmt in ("%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M", "%m/%d/%Y %I:%M:%S %p", "%m/%d/%Y %I:%M %p",
+                "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M"):
+        try:
+            return datetime.strptime(raw, fmt).isoformat(timespec="minutes")
+        except ValueError:
+            continue
+    d = parse_date(raw)
+    return f"{d.isoformat()}T00:00" if d else ""
+
+def normalize_event(raw, default_sample_id=""):
+    """Converts one audit trail row into a trax_events record, or None if it is not a tracked event"""
+    lowered = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+    rec = {col: str(next((lowered[a] for a in aliases if lowered.get(a) not in (None, "")), "")).strip()
+           for col, aliases in EVENT_COLUMN_ALIASES.items()}
+    kind = classify_event(rec["description"])
+    when = parse_event_time(rec["event_time"])
+    m_id = re.search(r"(ETX-\d{6}-\d{4})", rec["sample_id"] or rec["description"], re.I)
+    sample_id = m_id.group(1).upper() if m_id else (rec["sample_id"] or default_sample_id).upper()
+    if not kind or not when or not sample_id:
+        return None
+    day = re.search(r"Day:\s*(\d+)", rec["description"], re.I)
+    media = re.search(r"Media:\s*(\w+)", rec["description"], re.I)
+    return (sample_id, when, kind, rec["username"], username_to_initials(rec["username"]),
+            int(day.group(1)) if day else None, media.group(1) if media else "", rec["description"])
+
+def upsert_events(conn, records):
+    """Inserts or replaces normalized events (no commit); returns the number written"""
+    records = [r for r in records if r]
+    conn.executemany("INSERT OR REPLACE INTO trax_events VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+    return len(records)
+
+# --- 3. EXPORT KINDS ---
+def detect_kind(header):
+    """events / em / samples from the export's header row"""
+    cols = {str(h).strip().lower() for h in header if h is not None}
+    if cols & set(EVENT_COLUMN_ALIASES["description"]) and cols & set(EVENT_COLUMN_ALIASES["username"]):
+        return "events"
+    if cols & set(em_store.COLUMN_ALIASES["category"]):
+        return "em"
+    return "samples"
+
+class _DaySeq(Counter):
+    """Processing-order counter that resumes from the highest order already in the index"""
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+
+    def __missing__(self, day):
+        row = self.conn.execute("SELECT MAX(seq) FROM processed_samples WHERE analyst = ? AND process_date = ?", day).fetchone()
+        return row[0] or 0
+
+def _target(kind, db_path=None, default_sample_id="", resume=False):
+    """(connection, row normalizer, batch writer) for one export kind"""
+    if kind == "events":
+        conn = connect(db_path)
+        return conn, lambda raw: normalize_event(raw, default_sample_id), upsert_events
+    if kind == "em":
+        conn = em_store.connect(db_path)
+        return conn, em_store.normalize_row, lambda c, batch: em_store.upsert_results(c, batch, commit=False)
+    conn = processing_log.connect(db_path)
+    day_seq = _DaySeq(conn) if resume else Counter()
+    return conn, lambda raw: processing_log.normalize_row(raw, day_seq), processing_log.upsert_samples
+
+# --- 4. CHECKPOINTED STREAMING IMPORT ---
+def _fingerprint(raw):
+    return hashlib.sha1(repr(sorted((str(k), str(v)) for k, v in raw.items())).encode("utf-8")).hexdigest()
+
+def _load_checkpoint(conn, source):
+    row = conn.execute("SELECT rows_done, last_fingerprint FROM import_checkpoints WHERE source = ?", (source,)).fetchone()
+    return (row[0], row[1]) if row else (0, "")
+
+def _save_checkpoint(conn, source, kind, rows_done, fingerprint):
+    conn.execute("INSERT OR REPLACE INTO import_checkpoints VALUES (?, ?, ?, ?, ?)",
+                 (source, kind, rows_done, fingerprint, datetime.now().isoformat(timespec="seconds")))
+
+def _header(path):
+    for raw in read_spreadsheet(path):
+        return list(raw.keys())
+    return []
+
+def import_export(path, kind="", db_path=None, batch_size=BATCH_SIZE, default_sample_id="", progress=None):
+    """
+    Streams one Trax export into its store; returns {"kind", "read", "imported", "skipped"}.
+    Rows already covered by the file's checkpoint are skipped; if the row at the checkpoint no
+    longer matches (export regenerated), the whole file is re-imported (upserts are idempotent).
+    progress(rows_read) is called after every committed batch.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    kind = kind or detect_kind(_header(path))
+    source = os.path.abspath(path)
+    rows_done, last_fp = _checkpoint(source, kind, db_path)
+    conn, normalize, write = _target(kind, db_path, default_sample_id, resume=rows_done > 0)
+    stats = {"kind": kind, "read": 0, "imported": 0, "skipped": 0}
+    batch, fp, stale = [], last_fp, False
+    try:
+        for i, raw in enumerate(read_spreadsheet(path)):
+            stats["read"] = i + 1
+            if i < rows_done:
+                if i == rows_done - 1 and _fingerprint(raw) != last_fp:
+                    stale = True
+                    break
+                stats["skipped"] += 1
+                continue
+            fp = _fingerprint(raw)
+            batch.append(normalize(raw))
+            if len(batch) >= batch_size:
+                stats["imported"] += _commit_batch(conn, write, batch, source, kind, i + 1, fp)
+                batch = []
+                if progress:
+                    progress(stats["read"])
+        if batch:
+            stats["imported"] += _commit_batch(conn, write, batch, source, kind, stats["read"], fp)
+            if progress:
+                progress(stats["read"])
+    finally:
+        conn.close()
+    if stale or stats["read"] < rows_done:
+        _reset_checkpoint(source, kind, db_path)
+        return import_export(path, kind, db_path, batch_size, default_sample_id, progress)
+    return stats
+
+def _commit_batch(conn, write, batch, source, kind, rows_done, fingerprint):
+    n = write(conn, batch)
+    _save_checkpoint(conn, source, kind, rows_done, fingerprint)
+    conn.commit()
+    return n
+
+def _checkpoint(source, kind, db_path=None):
+    conn = _target(kind, db_path)[0]
+    try:
+        conn.executescript(CHECKPOINT_SCHEMA)
+        return _load_checkpoint(conn, source)
+    finally:
+        conn.close()
+
+def _reset_checkpoint(source, kind, db_path=None):
+    conn = _target(kind, db_path)[0]
+    try:
+        conn.execute("DELETE FROM import_checkpoints WHERE source = ?", (source,))
+        conn.commit()
+    finally:
+        conn.close()
+
+# --- 5. READ (audit trail -> session_state keys) ---
+def sample_events(sample_id, db_path=None):
+    """All tracked events for a sample in time order: [(event_time, event_kind, initials, incubation_day, media)]"""
+    conn = connect(db_path)
+    try:
+        return conn.execute(
+            "SELECT event_time, event_kind, initials, incubation_day, media FROM trax_events "
+            "WHERE sample_id = ? ORDER BY event_time", (str(sample_id or "").strip().upper(),)).fetchall()
+    finally:
+        conn.close()
+
+def case_fields(sample_id, db_path=None):
+    """
+    USP71 fields from a sample's stored audit trail, with the same rules as the Smart Parser's
+    event history branch (processor falls back to prepper, process date = read date - incubation day).
+    """
+    events = sample_events(sample_id, db_path)
+    if not events:
+        return {}
+    first = {}
+    for when, kind, initials, day, media in events:
+        first.setdefault(kind, (when, initials, day, media))
+
+    def person(prefix, kind, fallback=None):
+        ev = first.get(kind) or (first.get(fallback) if fallback else None)
+        init = ev[1] if ev else ""
+        return {f"{prefix}_initial": init, f"{prefix}_name": clean_analyst_name(get_full_name(init)) if init else ""}
+
+    fields = {}
+    fields.update(person("prepper", "sample_prep"))
+    if "sample_analysis" in first or "sample_prep" in first:
+        fields.update(person("analyst", "sample_analysis", "sample_prep"))
+    if "read_positive" in first:
+        fields.update(person("reading", "read_positive"))
+    fields.update(person("subculture", "read_inconclusive", "inconclusive"))
+
+    fmt = lambda iso: datetime.fromisoformat(iso).strftime("%d%b%y")
+    read, inc = first.get("read_positive"), first.get("incubation_started")
+    inc_days = read[2] if read and read[2] is not None else None
+    if inc_days is not None:
+        fields["incubation_time"] = str(inc_days)
+    if read:
+        fields["test_date"] = fmt(read[0])
+        if inc_days is not None:
+            fields["process_date"] = (datetime.fromisoformat(read[0]) - timedelta(days=inc_days)).strftime("%d%b%y")
+    elif inc:
+        fields["process_date"] = fmt(inc[0])
+        if inc_days is not None:
+            fields["test_date"] = (datetime.fromisoformat(inc[0]) + timedelta(days=inc_days)).strftime("%d%b%y")
+    if inc and inc[3]:
+        fields["positive_media"] = inc[3]
+    if "sample_positive" in first:
+        fields["sample_id"] = str(sample_id).strip().upper()
+    return fields
+
+if __name__ == "__main__":
+    import sys
+    for export_path in sys.argv[1:]:
+        s = import_export(export_path)
+        print(f"[+] {export_path} ({s['kind']}): read {s['read']} rows, imported {s['imported']}, skipped {s['skipped']} already imported")
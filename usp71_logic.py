@@ -1,7 +1,9 @@
 import streamlit as st
 import re
+import narratives
+import justification
 from datetime import datetime
-from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative
+from utils import get_room_logic as u_grl, get_full_name, ordinal, num_to_words, get_cleanroom_narrative, fragment
 
 # --- 1. USP 71 FIELD_KEYS (Data Contract with Step 1) ---
 FIELD_KEYS = [
@@ -58,6 +60,13 @@ def validate_inputs():
     return errors, warnings
 
 # --- 3. TEXT GENERATION LOGIC ---
+@fragment()
+def usp71_bsc_paragraph(bsc_id_str):
+    """BSC cleaning / certification paragraph; depends only on the BSC, cached per BSC"""
+    t_room, t_suite, t_suffix, t_loc = u_grl(bsc_id_str)
+    suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
+    return f"The ISO 5 BSC E00{bsc_id_str}, located in the {t_loc}, ({suite_phrase}), was used for sample processing steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{bsc_id_str} was certified and approved by both the Engineering and Quality Assurance teams."
+
 def generate_usp71_equipment_text():
     t_room, t_suite, t_suffix, t_loc = u_grl(st.session_state.bsc_id)
     p_date = st.session_state.get("process_date", "[Process Date]")
@@ -68,7 +77,7 @@ def generate_usp71_equipment_text():
     
     bsc_id_str = str(st.session_state.bsc_id).strip()
     suite_phrase = f"Suite {t_suite}{t_suffix}" if t_suite != "L-Suite" else "L-Suite"
-    part2 = f"The ISO 5 BSC E00{bsc_id_str}, located in the {t_loc}, ({suite_phrase}), was used for sample processing steps. It was thoroughly cleaned and disinfected prior to each procedure in accordance with SOP 2.600.018 (Cleaning and Disinfecting Procedure for Microbiology). Additionally, BSC E00{bsc_id_str} was certified and approved by both the Engineering and Quality Assurance teams."
+    part2 = usp71_bsc_paragraph(bsc_id_str)
     
     usage_sent = f"Sample processing was conducted in the ISO 5 BSC E00{bsc_id_str} in the {t_loc}, ({suite_phrase}) by {analyst} on {p_date} as per SOP 2.600.008 (USP <71> / EP 2.6.1 Sterility Test)."
         
@@ -112,34 +121,25 @@ def generate_usp71_narrative_and_details():
     if not is_fail(st.session_state.obs_air_wk_of): pass_wk_clean.append("weekly active air sampling")
     if not is_fail(st.session_state.obs_room_wk_of): pass_wk_clean.append("weekly surface sampling")
 
-    narr_parts = []
-    if pass_daily_clean:
-        d_str = f"{pass_daily_clean[0]}" if len(pass_daily_clean)==1 else f"{pass_daily_clean[0]} and {pass_daily_clean[1]}" if len(pass_daily_clean)==2 else f"{pass_daily_clean[0]}, {pass_daily_clean[1]}, and {pass_daily_clean[2]}"
-        narr_parts.append(f"no microbial growth was observed in {d_str} during the processing and testing steps")
-    if pass_wk_clean:
-        w_str = f"{pass_wk_clean[0]}" if len(pass_wk_clean)==1 else f"{pass_wk_clean[0]} and {pass_wk_clean[1]}" if len(pass_wk_clean)==2 else ", ".join(pass_wk_clean)
-        narr_parts.append(f"Additionally, {w_str} showed no microbial growth" if narr_parts else f"no microbial growth was observed in {w_str}")
-    
-    narrative = "Upon analyzing the environmental monitoring results, " + ". ".join(narr_parts) + "." if narr_parts else "Upon analyzing the environmental monitoring results, microbial growth was observed in all sampled areas."
+    for f in failures:
+        f["plural"] = "s" in str(f['obs']).lower() or bool(re.search(r'\d+', str(f['obs'])) and int(re.search(r'\d+', str(f['obs'])).group()) > 1)
+    facts = {"pass_daily": pass_daily_clean, "pass_weekly": pass_wk_clean, "failures": failures}
+    return narratives.render_all(("usp71_em_narrative", "usp71_em_details"), facts)
 
-    details = ""
-    if failures:
-        daily_fails = [f["cat"] for f in failures if f['time'] == 'daily']
-        weekly_fails = [f["cat"] for f in failures if f['time'] == 'weekly']
-        intro_parts = []
-        if daily_fails: intro_parts.append(f"{' and '.join(daily_fails)} during the processing and testing steps")
-        if weekly_fails: intro_parts.append(f"{' and '.join(weekly_fails)}")
-        fail_intro = f"However, microbial growth was observed during { ' and '.join(intro_parts) }." if intro_parts else ""
-        
-        detail_sentences = []
-        for i, f in enumerate(failures):
-            is_plural = "s" in str(f['obs']).lower() or (re.search(r'\d+', str(f['obs'])) and int(re.search(r'\d+', str(f['obs'])).group()) > 1)
-            verb = "were" if is_plural else "was"; noun = "organisms were" if is_plural else "organism was"
-            prefix = "Specifically, " if i == 0 else "Additionally, "
-            detail_sentences.append(f"{prefix}{f['obs']} {verb} detected during {f['cat']} and {verb} submitted for microbial identification under sample ID {f['etx']}, where the {noun} identified as {f['id']}.")
-        details = f"{fail_intro} {' '.join(detail_sentences)}"
+# Fixed EM fields for the Smart Justification engine: (observation, organism ID, daily)
+USP71_EM_FIELDS = (
+    ("obs_pers_dur", "id_pers_dur", True), ("obs_surf_dur", "id_surf_dur", True), ("obs_sett_dur", "id_sett_dur", True),
+    ("obs_air_wk_of", "id_air_wk_of", False), ("obs_room_wk_of", "id_room_wk_of", False),
+)
+
+def usp71_justification_case(state):
+    positive_org = str(state.get("positive_org", "") or "").strip()
+    return justification.JustificationCase("USP71", positive_org or None, justification.fixed_field_failures(state, USP71_EM_FIELDS),
+                                           justification.other_samples_clean(state))
 
-    return narrative, details
+def generate_usp71_smart_justification():
+    """4-step shielding justification for EM excursions (empty when EM was clean); run after generate_usp71_narrative_and_details"""
+    return justification.justify(usp71_justification_case(st.session_state))
 
 def generate_usp71_history_text():
     if st.session_state.get("incidence_count", 0) == 0 or st.session_state.get("has_prior_failures") == "No": 
@@ -1,7 +1,13 @@
 # filename: utils.py
 import streamlit as st
+import os
 import re
-from datetime import datetime, timedelta
+import json
+import calendar
+from array import array
+from bisect import bisect_right
+from datetime import datetime, date, timedelta
+from functools import lru_cache
 
 # --- 1. 统一的界面样式函数 ---
 def apply_eagle_style():
@@ -75,6 +81,7 @@ def apply_eagle_style():
             st.page_link("pages/USP71.py", label="USP <71>")
             st.page_link("pages/Celsis.py", label="Celsis")
             st.page_link("pages/EM.py", label="EM")
+            st.page_link("pages/EM_Trends.py", label="EM Trends")
 
 # --- 2. 业务逻辑工具函数 ---
 
@@ -105,93 +112,247 @@ def clean_analyst_name(name):
         return "Gabrielle Surber"
     return n
 
+def username_to_initials(username):
+    """Eagle Trax 用户名 -> 缩写 (gsurber -> GS)"""
+    if not username:
+        return ""
+    username = username.strip()
+    known = {
+        "gsurber": "GS", "GSurber": "GS",
+        "enioupin": "EN", "ENioupin": "EN",
+        "acarrillo": "AC", "ACarrillo": "AC",
+        "rseymour": "RS", "RSeymour": "RS",
+        "jowens": "JO", "JOwens": "JO"
+    }
+    if username in known:
+        return known[username]
+    if username.lower() in known:
+        return known[username.lower()]
+        
+    uppers = "".join([c for c in username if c.isupper()])
+    if len(uppers) >= 2:
+        return uppers[:3]
+    return username[0].upper() + (username[1].upper() if len(username) > 1 else "")
+
+# 月度清洁日 (每月最后一个星期天) 预计算表，年份范围可配置
+CLEANING_TABLE_YEARS = (2020, 2040)
+
+def build_cleaning_date_table(start_year, end_year):
+    """预计算 [start_year, end_year] 内每月最后一个星期天，返回升序的 ordinal 数组"""
+    table = array("l")
+    for year in range(start_year, end_year + 1):
+        for month in range(1, 13):
+            last_day = date(year, month, calendar.monthrange(year, month)[1])
+            # Python weekday: 0=Monday, 6=Sunday
+            offset = (last_day.weekday() - 6) % 7
+            table.append(last_day.toordinal() - offset)
+    return table
+
+_CLEANING_TABLE = build_cleaning_date_table(*CLEANING_TABLE_YEARS)
+
+def _parse_process_date(process_date_str):
+    process_date_str = str(process_date_str).strip()
+    fmt = "%d%b%y" if len(process_date_str) <= 7 else "%d%b%Y"
+    return datetime.strptime(process_date_str, fmt)
+
+def _cleaning_ordinal(p_ord):
+    """二分查找 <= p_ord 的最后一个月末星期天；超出表范围时返回 None"""
+    idx = bisect_right(_CLEANING_TABLE, p_ord) - 1
+    if idx < 0 or p_ord > date(CLEANING_TABLE_YEARS[1], 12, 31).toordinal():
+        return None
+    return _CLEANING_TABLE[idx]
+
+def _compute_cleaning_ordinal(p_date):
+    """表外日期的兜底计算：当月最后一个星期天已发生则取当月，否则取上月"""
+    for year, month in ((p_date.year, p_date.month),
+                        (p_date.year - 1, 12) if p_date.month == 1 else (p_date.year, p_date.month - 1)):
+        last_day = date(year, month, calendar.monthrange(year, month)[1])
+        sunday = last_day.toordinal() - (last_day.weekday() - 6) % 7
+        if sunday <= p_date.toordinal():
+            return sunday
+    return None
+
 def get_monthly_cleaning_date(process_date_str):
     """根据接种日期计算最邻近且已发生（<= process_date）的当月或上月最后一个星期天"""
     if not process_date_str:
         return ""
     try:
-        process_date_str = str(process_date_str).strip()
-        fmt = "%d%b%y" if len(process_date_str) <= 7 else "%d%b%Y"
-        p_date = datetime.strptime(process_date_str, fmt)
+        p_date = _parse_process_date(process_date_str)
     except Exception:
         return ""
 
-    def last_sunday_of_month(year, month):
-        import calendar
-        last_day = calendar.monthrange(year, month)[1]
-        dt = datetime(year, month, last_day)
-        # Python weekday: 0=Monday, 6=Sunday
-        offset = (dt.weekday() - 6) % 7
-        return dt - timedelta(days=offset)
-
-    # 1. 检查当月最后一个星期天是否已发生
-    s_current = last_sunday_of_month(p_date.year, p_date.month)
-    if s_current <= p_date:
-        res_date = s_current
-    else:
-        # 2. 如果未发生，则取上个月最后一个星期天
-        if p_date.month == 1:
-            prev_year = p_date.year - 1
-            prev_month = 12
+    res_ord = _cleaning_ordinal(p_date.toordinal())
+    if res_ord is None:
+        res_ord = _compute_cleaning_ordinal(p_date)
+    return date.fromordinal(res_ord).strftime("%d%b%y")
+
+# 洁净室拓扑模型 (BSC -> 房间 -> 套间 -> E 编号 / 认证有效期 / 气流顺序)，从数据文件加载一次
+FACILITY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "facility_topology.json")
+_FACILITY = None
+
+def load_facility():
+    """加载 facility_topology.json 并建立索引 (只加载一次)"""
+    global _FACILITY
+    if _FACILITY is None:
+        with open(FACILITY_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        _FACILITY = {
+            "suites": data.get("suites", {}),
+            "rooms": data.get("rooms", {}),
+            "bscs": data.get("bscs", {}),
+        }
+    return _FACILITY
+
+def get_suite_info(suite):
+    """按套间号 ('115' / 'L-Suite') 查询套间信息，未知返回 None"""
+    return load_facility()["suites"].get(str(suite).strip())
+
+def resolve_bsc(bsc_id):
+    """按 BSC 编号 ('1314' 或 'BSC E001314') 查询所在房间及套间，未知返回 None"""
+    bsc_str = re.sub(r"^(?:BSC)?\s*(?:E00)?", "", str(bsc_id).strip().upper())
+    fac = load_facility()
+    room_label = fac["bscs"].get(bsc_str)
+    if not room_label:
+        return None
+    room = fac["rooms"][room_label]
+    return {"bsc": bsc_str, "room": room_label, "suite": room["suite"], **room}
+
+@lru_cache(maxsize=1)
+def get_equipment_matcher():
+    """由拓扑模型生成的单一预编译正则：BSC/E00 编号、4 位数字、房间号及 L-Suite"""
+    rooms = sorted(load_facility()["rooms"], key=len, reverse=True)
+    return re.compile(
+        r"(?P<prefixed>(?:BSC|E00)\s*(?P<pnum>\d{4}))"
+        r"|(?<!\d)(?P<num>\d{4})(?!\d)"
+        r"|(?P<lsuite>L-SUITE)"
+        r"|(?<!\d)(?P<room>" + "|".join(map(re.escape, rooms)) + r")(?!\d)",
+        re.IGNORECASE,
+    )
+
+@lru_cache(maxsize=1)
+def _e_number_index():
+    """洁净室 E 编号 -> 房间号 (如 1737 -> 115, 1979 -> 145)"""
+    fac = load_facility()
+    index = {info["e_number"]: info["cr_room"] for info in fac["suites"].values()}
+    index.update({info["e_number"]: label for label, info in fac["rooms"].items() if info.get("e_number")})
+    return index
+
+def scan_equipment_tokens(text):
+    """
+    一次扫描提取文本中所有设备 / 房间标记，按出现顺序返回:
+    kind = bsc (已登记 BSC) / equipment (其他 E00 编号) / number (未登记 4 位数字) / room
+    prefixed = 编号前带 BSC / E00；年份 (20xx) 自动排除。
+    """
+    fac = load_facility()
+    e_rooms = _e_number_index()
+    tokens = []
+    for m in get_equipment_matcher().finditer(str(text)):
+        if m.group("lsuite"):
+            tokens.append({"kind": "room", "value": "L-Suite", "suite": "L-Suite", "room": ""})
+            continue
+        if m.group("room"):
+            label = m.group("room").upper()
+            tokens.append({"kind": "room", "value": label, "suite": fac["rooms"][label]["suite"], "room": label})
+            continue
+        num = m.group("pnum") or m.group("num")
+        if num.startswith("20"):
+            continue
+        if num in fac["bscs"]:
+            tokens.append({"kind": "bsc", "value": num, "suite": fac["rooms"][fac["bscs"][num]]["suite"], "room": fac["bscs"][num],
+                           "prefixed": bool(m.group("pnum"))})
+        elif m.group("pnum") and num in e_rooms:
+            label = e_rooms[num]
+            tokens.append({"kind": "room", "value": label, "suite": fac["rooms"][label]["suite"], "room": label})
         else:
-            prev_year = p_date.year
-            prev_month = p_date.month - 1
-        res_date = last_sunday_of_month(prev_year, prev_month)
+            tokens.append({"kind": "equipment" if m.group("pnum") else "number", "value": num, "suite": "", "room": "",
+                           "prefixed": bool(m.group("pnum"))})
+    return tokens
 
-    return res_date.strftime("%d%b%y")
+def find_bsc_number(text, kinds=("bsc", "equipment")):
+    """返回文本中第一个 BSC 编号 (按 kinds 优先级)，找不到返回 ''"""
+    tokens = scan_equipment_tokens(text)
+    for kind in kinds:
+        for tok in tokens:
+            if tok["kind"] == kind:
+                return tok["value"]
+    return ""
 
 def get_room_logic(bsc_id):
     """根据 BSC ID 自动推断洁净室及房间信息"""
     bsc_str = str(bsc_id).strip()
-    
-    # 1. 强制拦截 Celsis 专属设备 (1798 是偶数，但它在 A 房)
-    if bsc_str == "1798":
-        return "1736", "114", "A", "middle ISO 7 buffer room"
-        
-    # 2. L-Suite 专属设备拦截 (145 房为内间, 144 房为外/缓冲间)
-    l_suite_145 = ["1938", "1317", "1319"]
-    l_suite_144 = ["1988", "1937"]
-    if bsc_str in l_suite_145:
-        return "145", "L-Suite", "", "innermost ISO 7 cleanroom"
-    elif bsc_str in l_suite_144:
-        return "144", "L-Suite", "", "adjacent ISO 7 buffer cleanroom"
-        
-    # 3. 常规 3-room suite 逻辑
+    info = resolve_bsc(bsc_str)
+    if info:
+        suite = info["suite"]
+        # L-Suite 每个房间有独立 E 编号；3-room suite 使用套间的 CR 编号
+        room_id = info.get("e_number") or get_suite_info(suite)["e_number"]
+        return room_id, suite, info["suffix"], info["location"]
+
+    # 未登记的 BSC：沿用奇偶规则推断 A/B 房
     try:
         num = int(bsc_str)
         suffix = "B" if num % 2 == 0 else "A"
         location = "innermost ISO 7 room" if suffix == "B" else "middle ISO 7 buffer room"
     except: 
         suffix, location = "B", "innermost ISO 7 room"
-    
-    if bsc_str in ["1310", "1309"]: suite = "117"
-    elif bsc_str in ["1311", "1312"]: suite = "116"
-    elif bsc_str in ["1314", "1313"]: suite = "115"
-    elif bsc_str in ["1316"]: suite = "114"
-    else: suite = "Unknown"
-    
-    room_id = {"117": "1739", "116": "1738", "115": "1737", "114": "1736"}.get(suite, "Unknown")
-    return room_id, suite, suffix, location
+    return "Unknown", "Unknown", suffix, location
+
+# 重复样板段落的片段缓存：同一 suite / BSC 的文案只格式化一次，批量重生成报告时直接复用
+FRAGMENT_CACHE_SIZE = 512
+_FRAGMENTS = {}
+
+def fragment(maxsize=FRAGMENT_CACHE_SIZE):
+    """
+    片段缓存装饰器 (lru_cache + 登记)。只用于参数完全决定文案的纯函数：
+    缓存键 = 实际变化的参数 (suite / room / BSC)，人员与日期不要放进片段。
+    """
+    def wrap(fn):
+        cached = lru_cache(maxsize=maxsize)(fn)
+        _FRAGMENTS[f"{fn.__module__}.{fn.__qualname__}"] = cached
+        return cached
+    return wrap
+
+def fragment_cache_stats():
+    """{片段名: {hits, misses, size, maxsize, hit_rate}}"""
+    stats = {}
+    for name, fn in _FRAGMENTS.items():
+        info = fn.cache_info()
+        calls = info.hits + info.misses
+        stats[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize,
+                       "hit_rate": round(info.hits / calls, 3) if calls else None}
+    return stats
+
+def clear_fragment_cache():
+    """清空所有片段缓存 (例如修改 facility_topology.json 后)"""
+    for fn in _FRAGMENTS.values():
+        fn.cache_clear()
 
 def get_cleanroom_narrative(suite, t_room=None, action_text="processing procedures", verb="comprises"):
     """
     根据 suite ('L-Suite' 或 114/115/116/117) 动态生成洁净室套间描述。
     """
-    suite_str = str(suite).strip()
+    return _build_cleanroom_narrative(str(suite).strip(), t_room, action_text, verb)
+
+@fragment(maxsize=256)
+def _build_cleanroom_narrative(suite_str, t_room, action_text, verb):
+    """按 (suite, room, action_text, verb) 缓存的洁净室描述"""
     opens_or_connects = "opens into" if verb == "consists of" else "connects to"
+    suite_info = get_suite_info(suite_str)
     
     if suite_str == "L-Suite":
         if t_room:
             header = f"The cleanroom used for {action_text} (E00{t_room})"
         else:
             header = f"The cleanroom used for {action_text} (L-Suite)"
-            
+
+        rooms = load_facility()["rooms"]
+        r1, r2, r3, r4 = suite_info["airflow"]
+        e1, e2, e3, e4 = (rooms[r]["e_number"] for r in (r1, r2, r3, r4))
         return (
-            f"{header} {verb} four interconnected rooms: the innermost ISO 7 cleanroom E001979 (145), "
-            f"which {opens_or_connects} the adjacent ISO 7 buffer cleanroom E001978 (144), followed by "
-            f"ISO 8 anteroom E001977 (143) and the outermost ISO 8 room E001976 (142). A positive air pressure system "
-            f"is maintained throughout the suite to ensure controlled, unidirectional airflow from 145 "
-            f"through 144 and 143 into 142."
+            f"{header} {verb} four interconnected rooms: the innermost ISO 7 cleanroom E00{e1} ({r1}), "
+            f"which {opens_or_connects} the adjacent ISO 7 buffer cleanroom E00{e2} ({r2}), followed by "
+            f"ISO 8 anteroom E00{e3} ({r3}) and the outermost ISO 8 room E00{e4} ({r4}). A positive air pressure system "
+            f"is maintained throughout the suite to ensure controlled, unidirectional airflow from {r1} "
+            f"through {r2} and {r3} into {r4}."
         )
     else:
         if t_room:
@@ -200,13 +361,14 @@ def get_cleanroom_narrative(suite, t_room=None, action_text="processing procedur
         else:
             header = f"The cleanroom used for {action_text} (Suite {suite_str})"
             and_then = "and then to"
-            
+
+        inner, middle, outer = suite_info["airflow"] if suite_info else (f"{suite_str}B", f"{suite_str}A", suite_str)
         return (
-            f"{header} {verb} three interconnected sections: the innermost ISO 7 cleanroom ({suite_str}B), "
-            f"which {opens_or_connects} the middle ISO 7 buffer room ({suite_str}A), {and_then} "
-            f"the outermost ISO 8 anteroom ({suite_str}). A positive air pressure system is maintained "
-            f"throughout the suite to ensure controlled, unidirectional airflow from {suite_str}B "
-            f"through {suite_str}A and into {suite_str}."
+            f"{header} {verb} three interconnected sections: the innermost ISO 7 cleanroom ({inner}), "
+            f"which {opens_or_connects} the middle ISO 7 buffer room ({middle}), {and_then} "
+            f"the outermost ISO 8 anteroom ({outer}). A positive air pressure system is maintained "
+            f"throughout the suite to ensure controlled, unidirectional airflow from {inner} "
+            f"through {middle} and into {outer}."
         )
 
 def num_to_words(n):